@@ -0,0 +1,322 @@
+import os
+import sqlite3
+import datetime
+import threading
+import logging
+from pathlib import Path
+import pandas as pd
+
+_log = logging.getLogger(name="core_log")
+
+alarm_log_columns = ["datetime", "glider", "mission", "cycle", "security_level", "action", "alarm_source"]
+action_columns = ["datetime", "platform_id", "glider", "mission", "cycle", "security_level", "action", "alarm_source"]
+time_format = "%Y-%m-%d %H:%M:%S"
+# the alarm sources of the sailbuoy files are the variables that raised them, grouped together in the latency report
+sailbuoy_sources = ["Leak", "BigLeak", "SailRotation", "Warning", "WithinTrackRadius"]
+
+
+def format_time(value):
+    """A datetime, or an ISO string as passed through the outbox, in the store's time format. None stays None"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return value.strftime(time_format)
+
+
+class AlarmStore:
+    """
+    Actions taken on alarms, in an indexed SQLite database. This replaces reading back the per-platform CSV alarm
+    logs, which are still written for compatibility. The CSV log of a platform is imported the first time the
+    platform is looked up, so no history is lost when switching over.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.RLock()
+        self.pid = None
+        self._connection = None
+
+    @property
+    def connection(self):
+        # sqlite connections can't be shared with forked worker processes
+        if self.pid != os.getpid():
+            self._connection = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self.create_tables(self._connection)
+            self.pid = os.getpid()
+        return self._connection
+
+    @staticmethod
+    def create_tables(connection):
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS actions ("
+                "datetime TEXT, platform_id TEXT, glider TEXT, mission INTEGER, cycle INTEGER, "
+                "security_level INTEGER, action TEXT, alarm_source TEXT)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS actions_alarm "
+                "ON actions (platform_id, mission, cycle, security_level, alarm_source, datetime)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS actions_time ON actions (platform_id, datetime)")
+            # when the alarm happened and when it was dispatched, for alert latency. Added to existing stores
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(actions)")]
+            for column in ["event_time", "dispatch_time"]:
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE actions ADD COLUMN {column} TEXT")
+            # texts and calls are recorded when they are queued and sent_time is set once they go out. Those
+            # recorded before this column were recorded as they went out
+            if "sent_time" not in columns:
+                connection.execute("ALTER TABLE actions ADD COLUMN sent_time TEXT")
+                connection.execute(
+                    "UPDATE actions SET sent_time = datetime WHERE action LIKE 'text_%' OR action LIKE 'call_%'"
+                )
+            connection.execute("CREATE TABLE IF NOT EXISTS imported (platform_id TEXT PRIMARY KEY)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS escalations ("
+                "platform_id TEXT, glider TEXT, mission INTEGER, cycle INTEGER, security_level INTEGER, "
+                "alarm_source TEXT, due TEXT, state TEXT, "
+                "PRIMARY KEY (platform_id, mission, cycle, security_level))"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS escalations_state ON escalations (state, due)")
+
+    def execute(self, sql, parameters=()):
+        with self.lock:
+            with self.connection as connection:
+                return connection.execute(sql, parameters).fetchall()
+
+    def add_action(self, ddict, action, when=None, sent_time=None):
+        when = when or datetime.datetime.now()
+        self.execute(
+            f"INSERT INTO actions ({', '.join(action_columns)}, event_time, dispatch_time, sent_time) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                when.strftime(time_format),
+                str(ddict["platform_id"]),
+                str(ddict["glider"]),
+                int(ddict["mission"]),
+                int(ddict["cycle"]),
+                int(ddict["security_level"]),
+                action,
+                ddict["alarm_source"],
+                format_time(ddict.get("event_time")),
+                format_time(ddict.get("dispatch_time")),
+                format_time(sent_time),
+            ),
+        )
+
+    def mark_sent(self, ddict, action, when=None):
+        """Note that a queued text or call of an alarm has gone out"""
+        when = when or datetime.datetime.now()
+        self.execute(
+            "UPDATE actions SET sent_time = ? WHERE rowid = (SELECT rowid FROM actions WHERE platform_id = ? "
+            "AND mission = ? AND cycle = ? AND security_level = ? AND alarm_source = ? AND action = ? "
+            "AND sent_time IS NULL ORDER BY datetime LIMIT 1)",
+            (
+                when.strftime(time_format),
+                str(ddict["platform_id"]),
+                int(ddict["mission"]),
+                int(ddict["cycle"]),
+                int(ddict["security_level"]),
+                ddict["alarm_source"],
+                action,
+            ),
+        )
+
+    def import_alarm_log(self, platform_id, alarm_log):
+        """Replace the actions of platform_id with those in its CSV alarm log"""
+        platform_id = str(platform_id)
+        rows = []
+        if Path(alarm_log).exists():
+            df = pd.read_csv(alarm_log, names=alarm_log_columns, dtype=str)
+            df["datetime"] = pd.to_datetime(df["datetime"])
+            for row in df.itertuples(index=False):
+                rows.append(
+                    (
+                        row.datetime.strftime(time_format),
+                        platform_id,
+                        row.glider,
+                        int(row.mission),
+                        int(row.cycle),
+                        int(row.security_level),
+                        row.action,
+                        row.alarm_source if isinstance(row.alarm_source, str) else None,
+                    )
+                )
+        with self.lock:
+            with self.connection as connection:
+                connection.execute("DELETE FROM actions WHERE platform_id = ?", (platform_id,))
+                connection.executemany(
+                    f"INSERT INTO actions ({', '.join(action_columns)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+                )
+                connection.execute("INSERT OR IGNORE INTO imported VALUES (?)", (platform_id,))
+        _log.info(f"imported {len(rows)} actions for {platform_id} from {alarm_log}")
+        return len(rows)
+
+    def ensure_imported(self, platform_id, alarm_log):
+        if not self.execute("SELECT 1 FROM imported WHERE platform_id = ?", (str(platform_id),)):
+            self.import_alarm_log(platform_id, alarm_log)
+
+    def previous_action(self, platform_id, mission, cycle, security_level):
+        """The latest action for this alarm, excluding surfacing alerts, as a dict. None if there is none"""
+        rows = self.execute(
+            "SELECT datetime, action, alarm_source FROM actions "
+            "WHERE platform_id = ? AND mission = ? AND cycle = ? AND security_level = ? "
+            "AND COALESCE(alarm_source, '') NOT LIKE '%surf%' ORDER BY datetime DESC LIMIT 1",
+            (str(platform_id), int(mission), int(cycle), int(security_level)),
+        )
+        if not rows:
+            return None
+        when, action, alarm_source = rows[0]
+        return {
+            "datetime": datetime.datetime.strptime(when, time_format),
+            "action": action,
+            "alarm_source": alarm_source,
+        }
+
+    def last_action_time(self, platform_id):
+        rows = self.execute(
+            "SELECT MAX(datetime) FROM actions WHERE platform_id = ? AND COALESCE(alarm_source, '') NOT LIKE '%surf%'",
+            (str(platform_id),),
+        )
+        if not rows or rows[0][0] is None:
+            return None
+        return datetime.datetime.strptime(rows[0][0], time_format)
+
+    def has_action(self, platform_id, mission, alarm_source, since=None):
+        """Whether any action has been taken for this mission and alarm source, optionally only since a time"""
+        sql = "SELECT 1 FROM actions WHERE platform_id = ? AND mission = ? AND alarm_source = ?"
+        parameters = (str(platform_id), int(mission), alarm_source)
+        if since is not None:
+            sql += " AND datetime > ?"
+            parameters += (since.strftime(time_format),)
+        return bool(self.execute(sql + " LIMIT 1", parameters))
+
+    def schedule_escalation(self, ddict, due):
+        """Record that the supervisor is to be contacted at due if the alarm is still active. Existing ones are kept"""
+        self.execute(
+            "INSERT OR IGNORE INTO escalations VALUES (?, ?, ?, ?, ?, ?, ?, 'pending')",
+            (
+                str(ddict["platform_id"]),
+                str(ddict["glider"]),
+                int(ddict["mission"]),
+                int(ddict["cycle"]),
+                int(ddict["security_level"]),
+                ddict["alarm_source"],
+                due.strftime(time_format),
+            ),
+        )
+
+    def pending_escalations(self):
+        """Escalations still to be made, as alarm dicts with their due time, soonest first"""
+        rows = self.execute(
+            "SELECT platform_id, glider, mission, cycle, security_level, alarm_source, due FROM escalations "
+            "WHERE state = 'pending' ORDER BY due"
+        )
+        pending = []
+        for platform_id, glider, mission, cycle, security_level, alarm_source, due in rows:
+            pending.append(
+                {
+                    "platform_id": platform_id,
+                    "glider": glider,
+                    "mission": mission,
+                    "cycle": cycle,
+                    "security_level": security_level,
+                    "alarm_source": alarm_source,
+                    "due": datetime.datetime.strptime(due, time_format),
+                }
+            )
+        return pending
+
+    def claim_escalation(self, platform_id, mission, cycle, security_level):
+        """
+        Mark a pending escalation as made, so only one process contacts the supervisor. Returns "claimed" if this
+        call did so, else the state it was already in, or "missing" if none was scheduled.
+        """
+        key = (str(platform_id), int(mission), int(cycle), int(security_level))
+        with self.lock:
+            with self.connection as connection:
+                cursor = connection.execute(
+                    "UPDATE escalations SET state = 'escalated' WHERE platform_id = ? AND mission = ? AND cycle = ? "
+                    "AND security_level = ? AND state = 'pending'",
+                    key,
+                )
+                if cursor.rowcount:
+                    return "claimed"
+                rows = connection.execute(
+                    "SELECT state FROM escalations WHERE platform_id = ? AND mission = ? AND cycle = ? "
+                    "AND security_level = ?",
+                    key,
+                ).fetchall()
+        return rows[0][0] if rows else "missing"
+
+    def cancel_escalations(self, platform_id, mission, cycle):
+        """Cancel the pending escalations of a platform for alarms up to and including this cycle"""
+        with self.lock:
+            with self.connection as connection:
+                cursor = connection.execute(
+                    "UPDATE escalations SET state = 'cancelled' WHERE platform_id = ? AND state = 'pending' "
+                    "AND (mission < ? OR (mission = ? AND cycle <= ?))",
+                    (str(platform_id), int(mission), int(mission), int(cycle)),
+                )
+                return cursor.rowcount
+
+    def latency_report(self, since=None):
+        """
+        Latency of the alerts since a time, per alarm source: detection from the alarm happening to it being
+        dispatched, and notification from it happening to the first text or call going out. Only alarms with their
+        times recorded are included. Returns a DataFrame of the count, p50, p95 and max of each, in seconds.
+        """
+        sql = (
+            "SELECT platform_id, mission, cycle, security_level, alarm_source, MIN(event_time), MIN(dispatch_time), "
+            "MIN(sent_time) FROM actions WHERE event_time IS NOT NULL AND (action LIKE 'text_%' OR action LIKE 'call_%')"
+        )
+        parameters = ()
+        if since is not None:
+            sql += " AND datetime >= ?"
+            parameters = (since.strftime(time_format),)
+        sql += " GROUP BY platform_id, mission, cycle, security_level, alarm_source"
+        df = pd.DataFrame(
+            self.execute(sql, parameters),
+            columns=["platform_id", "mission", "cycle", "security_level", "alarm_source", "event_time", "dispatch_time", "first_action"],
+        )
+        for column in ["event_time", "dispatch_time", "first_action"]:
+            df[column] = pd.to_datetime(df[column], format=time_format)
+        df["source"] = df.alarm_source.where(~df.alarm_source.isin(sailbuoy_sources), "sailbuoy")
+        df["detection"] = (df.dispatch_time - df.event_time).dt.total_seconds()
+        df["notification"] = (df.first_action - df.event_time).dt.total_seconds()
+        rows = []
+        for source, group in df.groupby("source"):
+            row = {"source": source, "alarms": len(group)}
+            for latency in ["detection", "notification"]:
+                seconds = group[latency].dropna()
+                row[f"{latency}_p50"] = seconds.quantile(0.5) if len(seconds) else None
+                row[f"{latency}_p95"] = seconds.quantile(0.95) if len(seconds) else None
+                row[f"{latency}_max"] = seconds.max() if len(seconds) else None
+            rows.append(row)
+        columns = ["source", "alarms"] + [
+            f"{latency}_{stat}" for latency in ["detection", "notification"] for stat in ["p50", "p95", "max"]
+        ]
+        return pd.DataFrame(rows, columns=columns)
+
+
+if __name__ == "__main__":
+    import argparse
+    from alert_utils import log_dir, alarm_db
+
+    parser = argparse.ArgumentParser(description="manage the alarm store")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("import", help="one off import of all the CSV alarm logs (default)")
+    report_parser = subparsers.add_parser("report", help="alert latency per alarm source, in seconds")
+    report_parser.add_argument("--days", type=float, default=30, help="report on the alerts of the last days")
+    args = parser.parse_args()
+
+    store = AlarmStore(alarm_db)
+    if args.command == "report":
+        report = store.latency_report(datetime.datetime.now() - datetime.timedelta(days=args.days))
+        print(report.round(1).to_string(index=False))
+    else:
+        for alarm_log in sorted(log_dir.glob("alarm_*.log")):
+            store.import_alarm_log(alarm_log.stem[len("alarm_"):], alarm_log)
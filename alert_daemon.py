@@ -0,0 +1,207 @@
+"""
+Long running alternative to the cron job running alert_dispatch.py. The G-Logs directories of the gliders and the
+sailbuoy nrt_proc directory are watched with inotify, and a platform is checked as soon as one of its files is
+written to. Comm log readers and the stat cache are kept in memory between checks. All platforms whose inputs have
+changed, or whose recheck time is due, are also swept periodically, which is all that runs if inotify is unavailable.
+Supervisor escalations are made as their deadlines pass.
+
+python alert_daemon.py --interval 60
+"""
+import argparse
+import datetime
+import logging
+import time
+from pathlib import Path
+from alert_utils import setup_logger, write_metrics, context, log_dir, mail_alarms_json
+from alert_dispatch import (
+    Dispatcher,
+    glider_platforms,
+    sailbuoy_files,
+    sailbuoy_dir,
+    sailbuoy_alerts,
+    run_platform,
+    record_summary,
+)
+from file_watch import Inotify, IN_CLOSE_WRITE, IN_MOVED_TO, IN_ONLYDIR, IN_ISDIR, IN_CREATE
+from stat_cache import StatCache
+from escalation import EscalationScheduler
+
+_log = logging.getLogger(name="core_log")
+
+
+class AlertDaemon:
+    def __init__(self, fake=False, interval=60, settle=1.0, timeout=300, use_inotify=True):
+        self.fake = fake
+        self.use_inotify = use_inotify
+        # seconds between sweeps of all platforms
+        self.interval = interval
+        # seconds to wait for a burst of writes to finish before checking
+        self.settle = settle
+        self.timeout = timeout
+        self.base_dir = Path(context.secrets_dict["base_data_dir"])
+        self.stat_cache = StatCache()
+        self.comm_logs = {}
+        self.watcher = None
+        self.platforms = glider_platforms()
+        self.dirty = set()
+        self.handover = None
+        self.contacts_version = None
+        self.escalations = EscalationScheduler(context.alarm_store, fake=fake)
+
+    def start_watching(self):
+        if not self.use_inotify:
+            return
+        try:
+            self.watcher = Inotify()
+            self.watch_tree()
+        except OSError as e:
+            _log.warning(f"could not watch files with inotify: {e}. Poll every {self.interval} seconds")
+            self.stop_watching()
+
+    def stop_watching(self):
+        if self.watcher is not None:
+            self.watcher.close()
+        self.watcher = None
+
+    def watch_tree(self):
+        """Watch the directories new comm logs and sailbuoy files appear in, including any created since last time"""
+        directories = [self.base_dir]
+        self.platforms = glider_platforms()
+        for platform in self.platforms:
+            # the platform directory, its latest mission and the G-Logs the active comm log is in
+            directories += context.discovery.directories(platform)
+        if sailbuoy_dir.is_dir():
+            directories.append(sailbuoy_dir)
+        for directory in directories:
+            if directory.is_dir():
+                self.watcher.add_watch(directory)
+        # the mail alarms json is replaced, not appended to. Log files written by this process are ignored
+        self.watcher.add_watch(log_dir, IN_CLOSE_WRITE | IN_MOVED_TO | IN_ONLYDIR)
+
+    def job_key(self, path):
+        """The platform a changed path belongs to: a glider name or a sailbuoy file. None if it is not an input"""
+        path = Path(path)
+        if path.parent == sailbuoy_dir:
+            return str(path) if path.suffix == ".nc" else None
+        try:
+            platform = path.relative_to(self.base_dir).parts[0]
+        except (ValueError, IndexError):
+            return None
+        if platform in self.platforms:
+            return platform
+        return None
+
+    def handle_events(self, events):
+        rescan = False
+        for path, mask in events:
+            if path is None:
+                _log.warning("inotify event queue overflowed. Sweep all platforms")
+                rescan = True
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                rescan = True
+            if Path(path) == mail_alarms_json:
+                self.dirty.update(self.platforms)
+                continue
+            key = self.job_key(path)
+            if key is not None:
+                self.dirty.add(key)
+        if rescan:
+            self.watch_tree()
+            self.dirty.update(self.platforms)
+            self.dirty.update(str(nc) for nc in sailbuoy_files())
+
+    def glider_alerts(self, platform):
+        dispatch = Dispatcher(platform)
+        dispatch.dummy_calls = self.fake
+        dispatch.comm_log = self.comm_logs.get(platform)
+        result = dispatch.execute()
+        self.comm_logs[platform] = dispatch.comm_log
+        return result
+
+    def check(self, key):
+        if key.endswith(".nc"):
+            summary = run_platform(key, sailbuoy_alerts, (Path(key), self.fake), self.timeout)
+        else:
+            summary = run_platform(key, self.glider_alerts, (key,), self.timeout)
+        record_summary(self.stat_cache, summary)
+        return summary
+
+    def sweep(self):
+        """Check every platform whose inputs have changed or whose recheck is due"""
+        self.platforms = glider_platforms()
+        keys = self.platforms + [str(nc) for nc in sailbuoy_files()]
+        self.dirty.update(key for key in keys if not self.stat_cache.unchanged(key))
+
+    def refresh_schedule(self):
+        now = datetime.datetime.now()
+        contacts_version = context.contacts_version()
+        if self.handover is None or now >= self.handover or contacts_version != self.contacts_version:
+            context.refresh_duty()
+            self.contacts_version = contacts_version
+            self.handover = context.schedule_index.next_handover(now)
+
+    def wait_time(self, next_sweep):
+        """Seconds until the next sweep, or the next escalation if that is sooner"""
+        timeout = next_sweep - time.monotonic()
+        next_due = self.escalations.next_due()
+        if next_due is not None:
+            timeout = min(timeout, (next_due - datetime.datetime.now()).total_seconds() + self.escalations.wheel.tick)
+        return max(0.0, timeout)
+
+    def wait(self, timeout):
+        """Wait for changes to the watched files for up to timeout seconds, or just sleep if not watching"""
+        if self.watcher is None:
+            time.sleep(timeout)
+            return
+        try:
+            events = self.watcher.read(timeout)
+            # let a burst of writes finish, so the platform is checked once, but don't wait on a steady stream
+            settled_by = time.monotonic() + 5 * self.settle
+            while events:
+                self.handle_events(events)
+                if time.monotonic() >= settled_by:
+                    break
+                events = self.watcher.read(self.settle)
+        except OSError as e:
+            _log.error(f"lost inotify watches: {e}. Poll every {self.interval} seconds")
+            self.stop_watching()
+
+    def run(self):
+        _log.info("******** START DAEMON **********")
+        context.outbox_sender.start()
+        self.start_watching()
+        next_sweep = time.monotonic()
+        while True:
+            if time.monotonic() >= next_sweep:
+                if self.watcher is None:
+                    self.start_watching()
+                self.sweep()
+                next_sweep = time.monotonic() + self.interval
+            if self.dirty:
+                self.refresh_schedule()
+                for key in sorted(self.dirty):
+                    self.dirty.discard(key)
+                    summary = self.check(key)
+                    _log.debug(f"{key} {summary['status']} in {summary['seconds']:.2f} seconds")
+                self.stat_cache.save()
+                context.discovery.save()
+                write_metrics("daemon")
+            # pick up deadlines set by the checks, or by the cron job, and escalate any that are due
+            self.escalations.run_due()
+            self.wait(self.wait_time(next_sweep))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="watch comm logs and sailbuoy files and alert on alarms")
+    parser.add_argument("--interval", type=int, default=60, help="seconds between sweeps of all platforms")
+    parser.add_argument("--poll", action="store_true", help="do not use inotify, only sweep periodically")
+    args = parser.parse_args()
+    setup_logger("core_log", log_dir / "alarms.log", level=logging.DEBUG)
+    daemon = AlertDaemon(
+        fake=context.secrets_dict["dummy_calls"] == "True",
+        interval=args.interval,
+        timeout=int(context.secrets_dict.get("dispatch_timeout", 300)),
+        use_inotify=not args.poll,
+    )
+    daemon.run()
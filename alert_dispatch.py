@@ -1,121 +1,165 @@
+import os
 import pandas as pd
-import numpy as np
 import xarray as xr
 from pathlib import Path
 import datetime
 import json
 import logging
+import signal
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from alert_utils import (
     setup_logger,
-    format_alarm,
-    secrets_dict,
+    write_metrics,
+    context,
     contact_pilot,
     contact_supervisor,
-    find_previous_action,
-    parse_mrs,
     mail_alarms_json,
+    schedule_csv,
     parse_mail_alarms,
     surfacing_alerts,
-    mail_recipient, slack_mail,
     mailer,
-    sailbuoy_alert
+    sailbuoy_alert,
+    log_dir,
 )
+from comm_log import CommLogStream
+from stat_cache import StatCache, input_signature
+from escalation import EscalationScheduler
+import metrics
 
-_log = setup_logger("core_log", "/data/log/alarms.log", level=logging.DEBUG)
+_log = logging.getLogger(name="core_log")
+
+sailbuoy_dir = Path(os.environ.get("ALERTS_SAILBUOY_DIR", "/data/sailbuoy/nrt_proc"))
 
 
 class Dispatcher:
-    def __init__(self, platform_id):
+    # comm logs with no lines newer than this are not checked for alarms
+    stale_limit = datetime.timedelta(hours=6)
+    # alarms are escalated to the supervisor if still active this long after the pilot was contacted
+    escalation_delay = datetime.timedelta(minutes=30)
+    # alarm code raised for a glider on the surface for longer than surface_limit
+    surface_alarm = 1048576
+    # a glider that has been at the surface for longer than this in one cycle raises an alarm
+    surface_limit = datetime.timedelta(minutes=45)
+
+    def __init__(self, platform_id, store=None, clock=None, utc_clock=None):
         self.platform_num = int(platform_id[-3:])
         self.platform_id = platform_id
-        schedule = pd.read_csv(
-            "/data/log/schedule.csv", parse_dates=True, index_col=0, sep=";", dtype=str
-        )
-        now = datetime.datetime.now()
-        row = schedule[schedule.index < now].iloc[-1]
-        self.pilot_phone = row["pilot"]
-        self.supervisor_phone = row["supervisor"]
-        self.slack_mail = slack_mail
-        self.alarm_log = f"/data/log/alarm_{platform_id}.log"
-        self.df_alarm = pd.DataFrame()
-        self.base_dir = Path(secrets_dict["base_data_dir"]) / self.platform_id
+        self.alarm_log = log_dir / f"alarm_{platform_id}.log"
+        self.store = store or context.alarm_store
+        # the local time and the UTC time now, as naive datetimes. replay.py runs the checks on a simulated clock
+        self.clock = clock or datetime.datetime.now
+        self.utc_clock = utc_clock or (lambda: datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None))
+        self.comm_log_file = None
+        self.previous_comm_log_file = None
+        # the CommLogStream reader can be handed over from a previous Dispatcher to keep its state in memory
+        self.comm_log = None
         self.df_mrs = pd.DataFrame()
+        self.escalation_due = None
         self.alarm_dict = {}
         self.dummy_calls = False
         self.alarm_source = None
-        setup_logger(
-            platform_id, self.alarm_log, formatter=format_alarm, level=logging.INFO
-        )
+
+    @property
+    def base_dir(self):
+        return Path(context.secrets_dict["base_data_dir"]) / self.platform_id
+
+    @property
+    def slack_mail(self):
+        return context.slack_mail
 
     def load_alarm_log(self):
-        if Path(self.alarm_log).exists():
-            self.df_alarm = pd.read_csv(
-                self.alarm_log,
-                names=[
-                    "datetime",
-                    "glider",
-                    "mission",
-                    "cycle",
-                    "security_level",
-                    "action",
-                    "alarm_source",
-                ],
-                parse_dates=["datetime"],
-            )
+        # actions are read from the alarm store, which takes over the CSV alarm log the first time it is used
+        self.store.ensure_imported(self.platform_id, self.alarm_log)
+
+    def find_comm_log(self):
+        self.comm_log_file, self.previous_comm_log_file = context.discovery.comm_logs(self.platform_id)
 
     def load_comm_log(self):
         _log.info(f"Check {self.platform_id}")
-        comm_log_files = list(self.base_dir.glob("0*/G-Logs/*com.raw.log"))
-        comm_log_files.sort()
-        if len(comm_log_files) == 0:
+        if self.comm_log_file is None:
+            self.find_comm_log()
+        if self.comm_log_file is None:
             _log.warning(f"No comm log file found in {self.base_dir}")
             return
-        comm_log_file = comm_log_files[-1]
-        self.df_mrs = parse_mrs(comm_log_file)
+        if (
+            self.comm_log is None
+            or self.comm_log.comm_log_file != Path(self.comm_log_file)
+            or self.comm_log.previous_file != self.previous_comm_log_file
+        ):
+            self.comm_log = CommLogStream(
+                self.comm_log_file, self.previous_comm_log_file, window=self.stale_limit, clock=self.clock
+            )
+        self.df_mrs = self.comm_log.read()
+
+    def archive_comm_log(self):
+        # the archive is for analysis, so a failure to write to it does not stop the alarm checks
+        try:
+            context.mrs_archive.update(self.platform_id, self.comm_log_file)
+        except Exception as e:
+            _log.error(f"could not archive MRS lines of {self.comm_log_file}: {e}")
+
+    def input_files(self):
+        """Files and directories that execute reads, or that change when a new comm log file is started"""
+        paths = [self.alarm_log, schedule_csv, mail_alarms_json] + context.discovery.directories(self.platform_id)
+        if self.comm_log_file is not None:
+            paths.append(self.comm_log_file)
+        return paths
 
     def check_comm_log(self):
         df = self.df_mrs
         if df.empty:
             return False
         self.alarm_dict = df.iloc[-1].to_dict()
-        if df.iloc[-1]["datetime"] < datetime.datetime.now() - datetime.timedelta(
-            hours=6
-        ):
+        if df.iloc[-1]["datetime"] < self.clock() - self.stale_limit:
             _log.info(f"Stale log from {self.platform_id}")
             return False
-        if not self.df_alarm.empty:
-            last_action = self.df_alarm["datetime"].values[-1]
+        last_action = self.store.last_action_time(self.platform_id)
+        if last_action is not None:
             df = df[df.datetime > last_action]
         if df.empty:
             _log.info(f"no new lines from {self.platform_id}")
             return False
         self.alarm_dict = df.iloc[-1].to_dict()
+        # the lines from the end of the previous mission are not part of the latest cycle
+        df = df[df.mission == df.mission.values[-1]]
         df = df[df.cycle == df.cycle.max()]
         surface_time = df.datetime.max() - df.datetime.min()
         _log.info(f"surface-check cycle {df.cycle.max()} glider surface for {str(surface_time)[7:15]} {str(df.datetime.values[0])[:19]} - {str(df.datetime.values[-1])[:19]}")
-        if surface_time > np.timedelta64(45, 'm'):
+        if surface_time > self.surface_limit:
             self.alarm_source = "Glider on surface for too long"
             _log.info(f"glider at surface for {surface_time}. will alarm")
-            self.alarm_dict["security_level"] = 1048576
+            self.alarm_dict["security_level"] = self.surface_alarm
+            self.alarm_dict["event_time"] = (df.datetime.min() + self.surface_limit).to_pydatetime()
             return True
+        ddict = self.alarm_dict
         if df[df.alarm].empty:
             _log.info(f"No alarms for {self.platform_id}")
+            self.cancel_escalations()
             return False
-        ddict = self.alarm_dict
         if not ddict["alarm"]:
             _log.info(
                 f"Alarm cleared {self.platform_id} M{ddict['mission']} cycle {ddict['cycle']}"
             )
+            self.cancel_escalations()
             return False
         self.alarm_source = "GLIMPSE comm log"
+        # the first MRS line of this cycle reporting the alarm
+        ddict["event_time"] = df[df.alarm].datetime.min().to_pydatetime()
         return True
 
-    def mail_alarm(self):
+    def mail_alerts(self):
+        """The latest alarm email from each glider, as recorded by parse_mail_alarms. None if there is no record"""
         if not Path(mail_alarms_json).exists():
             _log.warning("No email alerts json")
-            return False
+            return None
         with open(mail_alarms_json, "r") as f:
-            mail_alerts = json.load(f)
+            return json.load(f)
+
+    def mail_alarm(self):
+        mail_alerts = self.mail_alerts()
+        if mail_alerts is None:
+            return False
 
         if self.platform_id not in mail_alerts.keys():
             _log.debug(f"{self.platform_id} not in email alerts json")
@@ -128,6 +172,8 @@ class Dispatcher:
             "mission": alarm_tuple[0],
             "security_level": alarm_tuple[2],
             "alarm": True,
+            # when the email was sent. Not recorded by older versions of mail_alerts.py
+            "event_time": datetime.datetime.fromisoformat(alarm_tuple[3]) if len(alarm_tuple) > 3 and alarm_tuple[3] else None,
         }
 
         if not self.alarm_dict:
@@ -162,37 +208,257 @@ class Dispatcher:
         ddict = self.alarm_dict
         ddict["platform_id"] = self.platform_id
         ddict["alarm_source"] = self.alarm_source
-        df_action = find_previous_action(self.df_alarm, ddict)
-        if df_action.empty:
+        action = self.store.previous_action(
+            self.platform_id, ddict["mission"], ddict["cycle"], ddict["security_level"]
+        )
+        if action is None:
             previous_action = "None"
         else:
-            previous_action = df_action.iloc[-1].to_dict()["action"]
+            previous_action = action["action"]
         _log.warning(f"previous action: {previous_action}")
         if previous_action == "None":
-            contact_pilot(ddict, fake=self.dummy_calls)
+            self.contact_pilot(ddict)
+            due = self.clock() + self.escalation_delay
+            self.store.schedule_escalation(ddict, due)
+            self.set_escalation_due(due)
 
         if "pilot" in previous_action:
+            pilot_action_time = action["datetime"]
             _log.warning(
-                f"Will we escalate? {df_action.iloc[-1].to_dict()['datetime']} "
+                f"Will we escalate? {pilot_action_time} "
             )
-            if df_action.iloc[-1].to_dict()[
-                "datetime"
-            ] < datetime.datetime.now() - datetime.timedelta(minutes=30):
-                contact_supervisor(ddict, fake=self.dummy_calls)
+            if pilot_action_time < self.clock() - self.escalation_delay:
+                # normally the escalation scheduler has got there first. Alarms from before it have no deadline
+                state = self.store.claim_escalation(
+                    self.platform_id, ddict["mission"], ddict["cycle"], ddict["security_level"]
+                )
+                if state in ("claimed", "missing"):
+                    self.contact_supervisor(ddict)
+                else:
+                    _log.info(f"escalation already {state}")
+            else:
+                self.set_escalation_due(pilot_action_time + self.escalation_delay)
 
-    def execute(self):
-        self.load_alarm_log()
+    def contact_pilot(self, ddict):
+        ddict.setdefault("dispatch_time", self.clock())
+        return contact_pilot(ddict, fake=self.dummy_calls)
+
+    def contact_supervisor(self, ddict):
+        ddict.setdefault("dispatch_time", self.clock())
+        return contact_supervisor(ddict, fake=self.dummy_calls)
+
+    def cancel_escalations(self):
+        ddict = self.alarm_dict
+        cancelled = self.store.cancel_escalations(self.platform_id, ddict["mission"], ddict["cycle"])
+        if cancelled:
+            _log.info(f"cancelled {cancelled} escalations of {self.platform_id}")
+
+    def escalation_state(self, ddict):
+        """
+        Whether the alarm of a due escalation is still active, from the latest state of the platform. "active" if the
+        newest MRS line is still from its mission and cycle and in alarm with its alarm code, or the latest alarm email
+        is still about it. Otherwise "superseded" by a later cycle or mission, "stale" or "cleared".
+        """
+        position = (int(ddict["mission"]), int(ddict["cycle"]))
+        security_level = int(ddict["security_level"])
         self.load_comm_log()
-        if self.check_comm_log():
-            self.trigger_alarm()
+        df = self.df_mrs
+        if not df.empty:
+            latest = df.iloc[-1]
+            latest_position = (int(latest["mission"]), int(latest["cycle"]))
+            if latest_position > position:
+                return "superseded"
+            if latest_position == position:
+                if latest["datetime"] < self.clock() - self.stale_limit:
+                    return "stale"
+                # a glider on the surface for too long is in alarm for as long as it is in the same cycle
+                if security_level == self.surface_alarm or (
+                    latest["alarm"] and int(latest["security_level"]) == security_level
+                ):
+                    return "active"
+                return "cleared"
+        mail_alarm = (self.mail_alerts() or {}).get(self.platform_id)
+        if mail_alarm and (int(mail_alarm[0]), int(mail_alarm[1]), int(mail_alarm[2])) == (*position, security_level):
+            return "active"
+        return "cleared"
+
+    def escalate(self, ddict):
+        """
+        Contact the supervisor about a due escalation if its alarm is still active, else cancel it. Returns the state
+        of the alarm, or "escalated".
+        """
+        state = self.escalation_state(ddict)
+        if state != "active":
+            self.store.cancel_escalations(self.platform_id, ddict["mission"], ddict["cycle"])
+            return state
+        claim = self.store.claim_escalation(self.platform_id, ddict["mission"], ddict["cycle"], ddict["security_level"])
+        if claim != "claimed":
+            return f"already {claim}"
+        self.contact_supervisor(ddict)
+        return "escalated"
+
+    def set_escalation_due(self, due):
+        if self.escalation_due is None or due < self.escalation_due:
+            self.escalation_due = due
+
+    def execute(self):
+        """Check for alarms and act on them. Returns the signature of the inputs read and the result"""
+        platform = self.platform_id
+        with metrics.span("find_comm_log", platform=platform):
+            self.find_comm_log()
+            inputs = input_signature(self.input_files())
+        with metrics.span("load_alarm_log", platform=platform):
+            self.load_alarm_log()
+        with metrics.span("load_comm_log", platform=platform):
+            self.load_comm_log()
+        if context.mrs_archive is not None and self.comm_log_file is not None:
+            with metrics.span("archive_mrs", platform=platform):
+                self.archive_comm_log()
+        with metrics.span("check_comm_log", platform=platform):
+            alarm = self.check_comm_log()
+        if alarm:
+            with metrics.span("trigger_alarm", platform=platform):
+                self.trigger_alarm()
         _log.debug(f"{self.platform_id} check email")
-        if self.mail_alarm():
-            self.trigger_alarm()
+        with metrics.span("mail_alarm", platform=platform):
+            alarm = self.mail_alarm()
+        if alarm:
+            with metrics.span("trigger_alarm", platform=platform):
+                self.trigger_alarm()
+        return {
+            "inputs": inputs,
+            "alarm_source": self.alarm_source,
+            "escalation_due": None if self.escalation_due is None else self.escalation_due.isoformat(),
+        }
+
+
+class PlatformTimeout(BaseException):
+    # not an Exception, so the handlers in the platform code that catch Exception don't stop the timeout
+    pass
+
+
+def raise_timeout(signum, frame):
+    raise PlatformTimeout()
+
+
+def run_platform(name, func, args, timeout):
+    """
+    Run the alerts for one platform in a worker process. Errors are caught and reported in the returned summary, so
+    one platform can't stop the others. A SIGALRM interrupts a platform that runs for longer than timeout seconds.
+    """
+    start = datetime.datetime.now()
+    summary = {"platform": name, "status": "ok", "error": None, "result": None}
+    signal.signal(signal.SIGALRM, raise_timeout)
+    signal.alarm(timeout)
+    try:
+        with metrics.span("platform", platform=name):
+            summary["result"] = func(*args)
+    except PlatformTimeout:
+        summary["status"] = "timeout"
+        summary["error"] = f"timed out after {timeout} seconds"
+    except Exception as e:
+        summary["status"] = "failed"
+        summary["error"] = str(e)
+    finally:
+        signal.alarm(0)
+    summary["seconds"] = (datetime.datetime.now() - start).total_seconds()
+    metrics.count("alerts_platform_runs_total", platform=name, status=summary["status"])
+    return summary
+
+
+def run_platform_in_worker(name, func, args, timeout):
+    """run_platform in a pool worker, handing back the metrics of just this platform with the summary"""
+    metrics.registry.reset()
+    summary = run_platform(name, func, args, timeout)
+    summary["metrics"] = metrics.registry.take()
+    return summary
+
+
+def run_sender(stop):
+    context.outbox_sender.run(stop)
+    write_metrics("outbox")
+
+
+def glider_alerts(platform, fake):
+    dispatch = Dispatcher(platform)
+    dispatch.dummy_calls = fake
+    return dispatch.execute()
+
+
+def sailbuoy_alerts(nc, fake):
+    nc_inputs = input_signature([nc, schedule_csv])
+    # variables are read lazily, so only the slices sailbuoy_alert looks at are loaded, and the file is closed after
+    with metrics.span("sailbuoy_file", platform=Path(nc).stem), xr.open_dataset(nc, cache=False) as ds:
+        platform = ds.attrs['platform_serial']
+        dispatch = Dispatcher(platform)
+        dispatch.dummy_calls = fake
+        inputs = {**nc_inputs, **input_signature([dispatch.alarm_log])}
+        dispatch.load_alarm_log()
+        sailbuoy_alert(ds, dispatch)
+    return {"inputs": inputs, "alarm_source": None, "escalation_due": None}
+
+
+def dispatch_all(jobs, workers=4, timeout=300):
+    """Run the (name, func, args) jobs concurrently in a bounded pool of worker processes. Returns their summaries"""
+    summaries = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = {
+            executor.submit(run_platform_in_worker, name, func, args, timeout): name for name, func, args in jobs
+        }
+        for future in as_completed(futures):
+            try:
+                summary = future.result()
+            except Exception as e:
+                # e.g. BrokenProcessPool after a worker was killed, which fails every platform not yet finished
+                _log.error(f"worker for {futures[future]} failed: {e!r}")
+                metrics.count("alerts_platform_runs_total", platform=futures[future], status="failed")
+                summaries.append(
+                    {"platform": futures[future], "status": "failed", "error": repr(e), "result": None, "seconds": 0.0}
+                )
+                continue
+            metrics.registry.merge(summary.pop("metrics"))
+            summaries.append(summary)
+    return summaries
+
+
+def glider_platforms():
+    """Names of the gliders to check, from the directories in base_data_dir"""
+    platforms = []
+    for platform in context.discovery.platforms():
+        glider_num = int(platform[3:])
+        if glider_num in (57, 70):
+            _log.debug(f"Skip Bastiens glider {platform}")
+            continue
+        platforms.append(platform)
+    return platforms
+
+
+def sailbuoy_files():
+    return sorted(sailbuoy_dir.glob("*.nc"))
+
+
+def record_summary(stat_cache, summary):
+    """Cache the inputs of a platform that was processed, or report the failure"""
+    if summary["status"] == "ok":
+        _log.debug(f"{summary['platform']} processed in {summary['seconds']:.1f} seconds")
+        result = summary["result"]
+        escalation_due = result["escalation_due"]
+        stat_cache.update(
+            summary["platform"],
+            result["inputs"],
+            result,
+            recheck_at=None if escalation_due is None else datetime.datetime.fromisoformat(escalation_due),
+        )
+        return
+    stat_cache.remove(summary["platform"])
+    _log.error(f"failed to process alarms for {summary['platform']}: {summary['error']}")
+    mailer("failed alerts", f"Failed to execute alerts for {summary['platform']}. Error: {summary['error']}")
 
 
 if __name__ == "__main__":
+    setup_logger("core_log", log_dir / "alarms.log", level=logging.DEBUG)
     _log.info("******** START CHECK **********")
-    fail_file = Path("/data/log/alarm_fails.txt")
+    fail_file = log_dir / "alarm_fails.txt"
     if fail_file.exists():
         with open(fail_file) as fin:
             fail_count = int(fail_file.read_text())
@@ -202,48 +468,58 @@ if __name__ == "__main__":
             fout.write(str(fail_count))
     fail_count += 1
     if fail_count == 10:
-        mailer("failed-alerts", "automated alerts system has failed. Switch over to backup system e.g. IFTTT", mail_recipient)
+        mailer("failed-alerts", "automated alerts system has failed. Switch over to backup system e.g. IFTTT", context.mail_recipient)
     fail = False
     with open(fail_file, 'w') as fout:
         fout.write(str(fail_count))
 
-    base_dir = Path(secrets_dict["base_data_dir"])
-    all_glider_dirs = list(base_dir.glob("SEA*")) +  list(base_dir.glob("SHW*"))
-    all_glider_dirs.sort()
-    for glider_dir in all_glider_dirs:
-        platform = glider_dir.parts[-1]
-        glider_num = int(platform[3:])
-        if glider_num in (57, 70):
-            _log.debug(f"Skip Bastiens glider {platform}")
-            continue
-        dispatch = Dispatcher(platform)
-        if secrets_dict["dummy_calls"] == "True":
-            dispatch.dummy_calls = True
-        try:
-            dispatch.execute()
-        except Exception as e:
-            _log.error("failed to process glider alarms")
-            mailer("failed alerts", f"Failed to execute {platform}. Error: {e}")
-
     fake = False
-    if secrets_dict["dummy_calls"] == "True":
+    if context.secrets_dict["dummy_calls"] == "True":
         fake = True
 
-    ncs = Path("/data/sailbuoy/nrt_proc").glob("*.nc")
-    _log.info("START sailbuoy")
-    for nc in ncs:
-        try:
-            ds = xr.open_dataset(nc)
-            platform = ds.attrs['platform_serial']
-            dispatch = Dispatcher(platform)
-            if secrets_dict["dummy_calls"] == "True":
-                dispatch.dummy_calls = True
-            dispatch.load_alarm_log()
-            sailbuoy_alert(ds, dispatch)
-        except Exception as e:
-            _log.error("failed to process sailbuoy alarms")
-            mailer("failed alerts", f"Failed to execute alerts for {nc}. Error: {e}")
-    _log.info("END SAILBUOY")
+    # texts and calls are queued by the platform checks and sent from a separate process as they arrive, so no
+    # check waits on 46elks. It is forked before any threads or worker processes are started
+    sender_stop = multiprocessing.get_context("fork").Event()
+    sender = multiprocessing.get_context("fork").Process(
+        target=run_sender, args=(sender_stop,), name="outbox sender"
+    )
+    sender.start()
+
+    # brought up to date once here, so the worker processes inherit it and only stat the directories
+    context.discovery.refresh()
+    context.discovery.save()
+    stat_cache = StatCache()
+    jobs = []
+    for platform in glider_platforms():
+        if stat_cache.unchanged(platform):
+            _log.debug(f"No change to inputs of {platform}. Skip")
+            continue
+        jobs.append((platform, glider_alerts, (platform, fake)))
+    for nc in sailbuoy_files():
+        if stat_cache.unchanged(str(nc)):
+            _log.debug(f"No change to inputs of {nc}. Skip")
+            continue
+        jobs.append((str(nc), sailbuoy_alerts, (nc, fake)))
+    if jobs:
+        # looked up once here, so the workers inherit the extra recipients rather than each looking them up
+        _log.debug(f"extra alarm recipients: {context.extra_numbers}")
+
+    summaries = dispatch_all(
+        jobs,
+        workers=int(context.secrets_dict.get("dispatch_workers", 4)),
+        timeout=int(context.secrets_dict.get("dispatch_timeout", 300)),
+    )
+    for summary in summaries:
+        record_summary(stat_cache, summary)
+    # supervisor escalations that fell due since the last run, after the checks have cancelled any that cleared
+    EscalationScheduler(context.alarm_store, fake=fake).run_due()
+    failed = [summary["platform"] for summary in summaries if summary["status"] != "ok"]
+    _log.info(f"processed {len(summaries)} platforms. {len(failed)} failed: {failed}")
+    stat_cache.save()
+    metrics.gauge("alerts_platforms_skipped", len(glider_platforms()) + len(sailbuoy_files()) - len(jobs))
+    write_metrics("dispatch")
+    sender_stop.set()
+    sender.join()
 
     if not fail:
         fail_count = 0
@@ -1,23 +1,38 @@
+import os
 import json
+import atexit
+import queue
+import email.utils
 import pandas as pd
 from pathlib import Path
 import requests
 import logging
+import logging.handlers
+import multiprocessing.util
 import datetime
-import email
-import imaplib
 import sys
 import re
 import subprocess
 import numpy as np
 import pytz
+import threading
+from requests.adapters import HTTPAdapter
+from alarm_store import AlarmStore, sailbuoy_sources
+from outbox import Outbox, OutboxSender
+import metrics
+from schedule_index import ScheduleIndex
+from discovery import DiscoveryIndex
 
 _log = logging.getLogger(name="core_log")
 
 script_dir = Path(__file__).parent.absolute()
+# where the secrets files are read from, and where logs, caches and databases are written. Overridden by the
+# environment to run against another tree, e.g. the synthetic fleets of benchmark.py
+secrets_dir = Path(os.environ.get("ALERTS_SECRETS_DIR", script_dir))
+log_dir = Path(os.environ.get("ALERTS_LOG_DIR", "/data/log"))
 
 def mailer(subject, message, recipient="callum.rollo@voiceoftheocean.org"):
-    if "callum" in str(script_dir):
+    if "callum" in str(script_dir) or os.environ.get("ALERTS_MOCK_MAIL"):
         _log.error(f"Mock mail {subject}: {message} to {recipient}")
         return
     _log.warning(f"email: {subject}, {message}, {recipient}")
@@ -31,32 +46,210 @@ format_basic = logging.Formatter(
 )
 format_alarm = logging.Formatter("%(asctime)s,%(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 
-mail_alarms_json = Path("/data/log/mail_alarms.json")
-with open(script_dir / "alarm_secrets.json", "r") as secrets_file:
-    secrets_dict = json.load(secrets_file)
-with open(script_dir / "contacts_secrets.json", "r") as secrets_file:
-    contacts = json.load(secrets_file)
-mail_recipient = secrets_dict["schedule_mail"]
-slack_mail = secrets_dict["slack_mail"]
+# (connect, read) timeouts in seconds for requests to 46elks, so a hung request can't hold up a sender
+elks_timeout = (5, 30)
+
+mail_alarms_json = log_dir / "mail_alarms.json"
+comm_log_cache_dir = log_dir / "comm_log_cache"
+mail_sync_json = log_dir / "mail_sync.json"
+stat_cache_json = log_dir / "stat_cache.json"
+alarm_db = log_dir / "alarms.sqlite"
+outbox_db = log_dir / "outbox.sqlite"
+outbox_stats_json = log_dir / "outbox_stats.json"
+schedule_csv = log_dir / "schedule.csv"
+schedule_index_json = log_dir / "schedule_index.json"
+contacts_json = secrets_dir / "contacts_secrets.json"
+discovery_json = log_dir / "discovery.json"
+
+
+class lazy:
+    """Like functools.cached_property, but only ever computed once when several threads ask at the same time"""
+
+    def __init__(self, func):
+        self.func = func
+        self.lock = threading.RLock()
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        with self.lock:
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.func(instance)
+        return instance.__dict__[self.name]
+
+
+class AlertContext:
+    """
+    Secrets, contacts and the on-call schedule. Each is loaded the first time it is used and then cached for the
+    life of the process, so importing this module does no I/O.
+    """
+
+    @lazy
+    def secrets_dict(self):
+        with open(secrets_dir / "alarm_secrets.json", "r") as secrets_file:
+            return json.load(secrets_file)
+
+    @lazy
+    def contacts(self):
+        with open(contacts_json, "r") as secrets_file:
+            return json.load(secrets_file)
+
+    @lazy
+    def secrets(self):
+        with open(secrets_dir / "email_secrets.json") as json_file:
+            return json.load(json_file)
+
+    @property
+    def mail_recipient(self):
+        return self.secrets_dict["schedule_mail"]
+
+    @property
+    def slack_mail(self):
+        return self.secrets_dict["slack_mail"]
+
+    @lazy
+    @metrics.timed("schedule_read")
+    def schedule(self):
+        schedule = pd.read_csv(schedule_csv, parse_dates=True, index_col=0, sep=";", dtype=str)
+        return resolve_names(schedule, self.contacts)
+
+    @lazy
+    @metrics.timed("schedule_index_load")
+    def schedule_index(self):
+        # compiled by parse_schedule. Compile it here if it is missing, or older than the schedule or the contacts the
+        # names in the schedule are resolved to numbers from
+        try:
+            compiled_from = max(schedule_csv.stat().st_mtime_ns, contacts_json.stat().st_mtime_ns)
+            if schedule_index_json.stat().st_mtime_ns >= compiled_from:
+                return ScheduleIndex.load(schedule_index_json)
+        except (OSError, ValueError, KeyError):
+            pass
+        schedule_index = ScheduleIndex.from_schedule(self.schedule)
+        try:
+            schedule_index.save(schedule_index_json)
+        except OSError as e:
+            _log.warning(f"could not save schedule index: {e}")
+        return schedule_index
+
+    @property
+    def on_duty(self):
+        return self.schedule_index.on_duty(datetime.datetime.now())
+
+    @property
+    def pilot_phone(self):
+        return self.on_duty[0]
+
+    @property
+    def supervisor_phone(self):
+        return self.on_duty[1]
+
+    @lazy
+    def extra_numbers(self):
+        try:
+            return extra_alarm_recipients()
+        except Exception:
+            mailer("failed extra numbers", "Could not extract extra numbers")
+            return [], []
+
+    @property
+    def extra_alarm_numbers(self):
+        return self.extra_numbers[0]
+
+    @property
+    def extra_alarm_numbers_surface(self):
+        return self.extra_numbers[1]
+
+    @lazy
+    def elks_session(self):
+        # one keep-alive connection pool to 46elks per process, shared by all texts and calls
+        session = requests.Session()
+        session.auth = (self.secrets_dict["elks_username"], self.secrets_dict["elks_password"])
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=16)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @property
+    def elks_api(self):
+        return self.secrets_dict.get("elks_api", "https://api.46elks.com/a1")
+
+    @property
+    def elks_whenhangup(self):
+        # URL of the callback.py receiver that 46elks posts the outcome of each call to. None to not be told
+        return self.secrets_dict.get("elks_whenhangup")
+
+    @lazy
+    def alarm_store(self):
+        return AlarmStore(alarm_db)
+
+    @lazy
+    def outbox(self):
+        return Outbox(outbox_db)
+
+    @lazy
+    def discovery(self):
+        return DiscoveryIndex(self.secrets_dict["base_data_dir"], discovery_json)
+
+    @lazy
+    def mrs_archive(self):
+        # the decoded MRS lines are archived if mrs_archive_dir is set and pyarrow is installed
+        archive_dir = self.secrets_dict.get("mrs_archive_dir")
+        if not archive_dir:
+            return None
+        from mrs_archive import MrsArchive
+
+        try:
+            return MrsArchive(archive_dir)
+        except ImportError as e:
+            _log.warning(f"not archiving MRS lines: {e}")
+            return None
+
+    @lazy
+    def outbox_sender(self):
+        return OutboxSender(
+            self.outbox,
+            {"text": elks_text, "call": elks_call},
+            workers=int(self.secrets_dict.get("outbox_workers", 8)),
+            on_give_up=outbox_give_up,
+            still_active=outbox_still_active,
+            stats_file=outbox_stats_json,
+        )
+
+    def contacts_version(self):
+        """The mtime of the contacts file, to tell when a long running process must resolve the schedule again"""
+        try:
+            return contacts_json.stat().st_mtime_ns
+        except OSError:
+            return None
+
+    def refresh(self, *names):
+        """Drop cached values so they are loaded again on next use. Drops everything if no names are given"""
+        for name in names or list(self.__dict__):
+            self.__dict__.pop(name, None)
+
+    def refresh_duty(self):
+        """Drop everything that depends on who is on duty or on their numbers, at a handover or a contacts edit"""
+        # the extra recipients leave out the pilot on duty, so they change with the shift too
+        self.refresh("contacts", "schedule", "schedule_index", "extra_numbers")
+
+
+context = AlertContext()
 
-schedule = pd.read_csv(
-    "/data/log/schedule.csv", parse_dates=True, index_col=0, sep=";", dtype=str
-)
-for name, number in contacts.items():
-    schedule.replace(name, number, inplace=True)
-now = datetime.datetime.now()
-row = schedule[schedule.index < now].iloc[-1]
-pilot_phone = row["pilot"]
-supervisor_phone = row["supervisor"]
-if type(supervisor_phone) is float:
-    supervisor_phone = None
-if type(pilot_phone) is str:
-    pilot_phone = pilot_phone.replace(" ", "")
-if type(supervisor_phone) is str:
-    supervisor_phone = supervisor_phone.replace(" ", "")
 
+def __getattr__(name):
+    # module level access to the context, as in alert_utils.secrets_dict
+    if not name.startswith("_") and hasattr(AlertContext, name):
+        return getattr(context, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@metrics.timed("extra_alarm_recipients")
 def extra_alarm_recipients():
-    votoweb_dir = secrets_dict["votoweb_dir"]
+    votoweb_dir = context.secrets_dict["votoweb_dir"]
     sys.path.append(votoweb_dir)
     from voto.data.db_classes import User  # noqa
     from voto.bin.add_profiles import init_db  # noqa
@@ -64,6 +257,7 @@ def extra_alarm_recipients():
     init_db()
     users_to_alarm = User.objects(alarm=True)
     users_to_alarm_surface = User.objects(alarm_surface=True)
+    contacts = context.contacts
     numbers = []
     numbers_surface = []
     for user in users_to_alarm:
@@ -72,7 +266,7 @@ def extra_alarm_recipients():
             mailer("Missing number", f"Did not find user {user.name} in contacts")
             continue
         number = contacts[user.name]
-        if number == pilot_phone:
+        if number == context.pilot_phone:
             continue
         numbers.append(number)
     for user in users_to_alarm_surface:
@@ -85,83 +279,195 @@ def extra_alarm_recipients():
     return numbers, numbers_surface
 
 
-extra_alarm_numbers = []
-extra_alarm_numbers_surface = []
+def write_metrics(job):
+    """Write the metrics recorded by this process to metrics_<job>.prom and metrics_<job>.json in log_dir"""
+    try:
+        metrics.registry.write(log_dir / f"metrics_{job}.prom", log_dir / f"metrics_{job}.json")
+    except OSError as e:
+        _log.warning(f"could not write metrics: {e}")
+
+
+class LogFile:
+    """
+    Writes the records logged to a file from a background thread, so logging in the alert path only puts the record
+    on a queue. The loggers writing to the file share one QueueHandler, so each file is opened once per process.
+    """
+
+    def __init__(self, log_file, formatter):
+        self.log_file = log_file
+        self.formatter = formatter
+        self.queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+        self.start()
+
+    def start(self):
+        self.file_handler = logging.FileHandler(self.log_file)
+        self.file_handler.setFormatter(self.formatter)
+        self.listener = logging.handlers.QueueListener(self.queue_handler.queue, self.file_handler)
+        self.listener.start()
 
-try:
-    extra_alarm_numbers, extra_alarm_numbers_surface = extra_alarm_recipients()
-except:
-    mailer("failed extra numbers", "Could not extract extra numbers")
+    def stop(self):
+        """Write out the records still queued and close the file"""
+        if self.listener is None:
+            return
+        self.listener.stop()
+        self.listener = None
+        self.file_handler.close()
+
+    def restart_in_child(self):
+        # the writer thread is not copied into a forked process. Records queued before the fork are the parent's to
+        # write, so the child starts with an empty queue, its own thread and its own file handle
+        self.queue_handler.queue = queue.SimpleQueue()
+        self.start()
+
+
+log_files = {}
+
+
+def stop_logging():
+    for log_file in log_files.values():
+        log_file.stop()
+
+
+def restart_logging():
+    for log_file in log_files.values():
+        log_file.restart_in_child()
+
+
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=restart_logging)
+# multiprocessing children end with os._exit, which skips atexit but runs the multiprocessing finalizers
+multiprocessing.util.register_after_fork(
+    stop_logging, lambda stop: multiprocessing.util.Finalize(None, stop, exitpriority=0)
+)
 
 
 def setup_logger(name, log_file, level=logging.INFO, formatter=format_basic):
-    handler = logging.FileHandler(log_file)
-    handler.setFormatter(formatter)
+    """Send the records of the named logger to log_file. Each file gets one handler, however often this is called"""
+    key = str(Path(log_file).absolute())
+    if key not in log_files:
+        log_files[key] = LogFile(key, formatter)
+    handler = log_files[key].queue_handler
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    logger.addHandler(handler)
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
     return logger
 
 
-def find_previous_action(df, ddict):
-    df = df[~df.alarm_source.str.contains("surf")]
-    if df.empty:
-        return df
-    df = df[(df.mission == ddict["mission"]) & (df.cycle == ddict["cycle"])  & (df.security_level == ddict["security_level"])]
-    if df.empty:
+# timestamp, then the glider, mission, cycle and security level fields of the message in the 6th column
+mrs_pattern = re.compile(
+    r"^(?P<datetime>[^;]*);(?:[^;]*;){4}[^,;]*,(?P<glider>[^,;]*),(?P<mission>[^,;]*),(?P<cycle>[^,;]*)"
+    r"(?:,(?P<security_level>[^,;]*))?"
+)
+non_digits = re.compile(r"\D+")
+
+
+def split_lines(text):
+    """
+    The non-empty lines of a comm log. Only a newline ends a line, as for the pandas reader this replaced.
+    str.splitlines would also split on control characters that turn up in raw comm logs.
+    """
+    lines = [line.rstrip("\r") for line in text.split("\n")]
+    return [line for line in lines if line]
+
+
+def decode_mrs(lines):
+    """Decode the $SEAMRS lines from a sequence of raw comm log lines in one pass. Alarm masks are not applied"""
+    index, datetimes, gliders, missions, cycles, security_levels = [], [], [], [], [], []
+    for i, line in enumerate(lines):
+        # catch short, possibly malformed MRS strings
+        if "SEAMRS" not in line or len(line) <= 90:
+            continue
+        match = mrs_pattern.match(line)
+        if not match:
+            continue
+        glider, mission, cycle, security_level = (
+            non_digits.sub("", field or "0") for field in match.group("glider", "mission", "cycle", "security_level")
+        )
+        # the pandas parser raised on an empty field, which stopped the checks of the whole platform over one line
+        if not (glider and mission and cycle and security_level):
+            continue
+        index.append(i)
+        datetimes.append(match["datetime"][1:-1])
+        gliders.append(glider)
+        missions.append(mission)
+        cycles.append(cycle)
+        security_levels.append(security_level)
+    if not index:
         return pd.DataFrame()
-    df = df.sort_values("datetime")
-    return df
+    df_mrs = pd.DataFrame(
+        {
+            "cycle": np.array(cycles, dtype=int),
+            "datetime": pd.to_datetime(pd.Series(datetimes, index=index), dayfirst=True),
+            "glider": np.array(gliders, dtype=int),
+            "mission": np.array(missions, dtype=int),
+            "security_level": np.array(security_levels, dtype=int),
+        },
+        index=index,
+    )
+    df_mrs["alarm"] = df_mrs.security_level > 0
+    return df_mrs
 
 
-def parse_mrs(comm_log_file):
-    df_in = pd.read_csv(
-        comm_log_file,
-        names=["everything"],
-        sep="Neverin100years",
-        engine="python",
-        on_bad_lines="skip",
-        encoding="latin1",
+def last_alarm_mask(lines):
+    """Return the alarm mask of the last $SEAALR line in lines, or None if there is none"""
+    for line in reversed(lines):
+        if "SEAALR" in line:
+            alarm_string = line.split("$SEAALR,")[1]
+            alarm_parts = alarm_string.split(",")
+            return int(alarm_parts[1].split("*")[0])
+    return None
+
+
+def mask_alarms(df_mrs, alarm_mask):
+    if not alarm_mask or df_mrs.empty:
+        return df_mrs
+    _log.warning(
+        f"Masking alarm! Mask {alarm_mask} glider {df_mrs.glider.values[0]} mission {df_mrs.mission.values[0]} cycle {df_mrs.cycle.values[-1]}"
     )
-    if "trmId" in df_in.everything[0]:
+    df_mrs.loc[df_mrs.security_level == alarm_mask, "alarm"] = False
+    return df_mrs
+
+
+@metrics.timed("parse_mrs")
+def parse_mrs(comm_log_file):
+    with open(comm_log_file, encoding="latin1", newline="") as fin:
+        lines = split_lines(fin.read())
+    if not lines:
+        _log.warning(f"empty logfile {comm_log_file}")
+        return pd.DataFrame()
+    if "trmId" in lines[0]:
         _log.warning(f"old logfile type in {comm_log_file}. skipping")
         return pd.DataFrame()
-    df_mrs = df_in[df_in["everything"].str.contains("SEAMRS")].copy()
-    # catch short, possibly malformed MRS strings
-    df_mrs = df_mrs[df_mrs.everything.astype(str).str.len() > 90]
-    parts = df_mrs.everything.str.split(";", expand=True)
-    df_mrs["datetime"] = pd.to_datetime(parts[0].str[1:-1], dayfirst=True)
-    df_mrs["message"] = parts[5]
-    msg_parts = df_mrs.message.str.split(",", expand=True)
-    df_mrs = df_mrs[msg_parts[1].astype(str) != "None"]
-    msg_parts = df_mrs.message.str.split(",", expand=True)
-    df_mrs["glider"] = msg_parts[1].str.replace(r"\D+", "", regex=True).astype(int)
-    df_mrs["mission"] = msg_parts[2].str.replace(r"\D+", "", regex=True).astype(int)
-    df_mrs["cycle"] = msg_parts[3].str.replace(r"\D+", "", regex=True).astype(int)
-    df_mrs["security_level"] = (
-        msg_parts[4].str.replace(r"\D+", "", regex=True).fillna(0).astype(int)
-    )
-    df_mrs = df_mrs[["cycle", "datetime", "glider", "mission", "security_level"]]
-    df_mrs["alarm"] = False
-    df_mrs.loc[df_mrs.security_level > 0, "alarm"] = True
-    df_alm = df_in[df_in["everything"].str.contains("SEAALR")].copy()
-    if not df_alm.empty:
-        last_alarm = df_alm.tail(1).everything.values[0]
-        alarm_string = last_alarm.split("$SEAALR,")[1]
-        alarm_parts = alarm_string.split(",")
-        alarm_mask = int(alarm_parts[1].split("*")[0])
-        if alarm_mask != 0:
-            _log.warning(
-                f"Masking alarm! Mask {alarm_mask} glider {df_mrs.glider.values[0]} mission {df_mrs.mission.values[0]} cycle {df_mrs.cycle.values[-1]}"
-            )
-            df_mrs.loc[df_mrs.security_level == alarm_mask, "alarm"] = False
+    df_mrs = decode_mrs(lines)
+    if df_mrs.empty:
+        return df_mrs
+    df_mrs = mask_alarms(df_mrs, last_alarm_mask(lines))
     df_mrs = df_mrs.sort_values("datetime")
     return df_mrs
 
 
-def elks_text(ddict, recipient=pilot_phone, user="pilot", fake=True):
+def platform_logger(platform_id):
+    """The logger that writes the CSV alarm log of a platform, set up if this process has not done so yet"""
+    alarm_log = logging.getLogger(name=platform_id)
+    if not alarm_log.handlers:
+        setup_logger(platform_id, log_dir / f"alarm_{platform_id}.log", formatter=format_alarm, level=logging.INFO)
+    return alarm_log
+
+
+def record_action(ddict, action):
+    # Append the action to the CSV alarm log of the platform and the alarm store
+    alarm_log = platform_logger(ddict["platform_id"])
+    alarm_log.info(
+        f"{ddict['glider']},{ddict['mission']},{ddict['cycle']},{ddict['security_level']},{action},{ddict['alarm_source']}"
+    )
+    context.alarm_store.add_action(ddict, action)
+
+
+def elks_text(ddict, recipient=None, user="pilot", fake=True):
+    if recipient is None:
+        recipient = context.pilot_phone
     recipient = re.sub(r"[^0-9+]", "", recipient)
-    alarm_log = logging.getLogger(name=ddict["platform_id"])
     if "SB" in ddict['platform_id']:
         message = f"Sailbuoy warning {ddict['platform_id']} M{ddict['mission']}. Source: {ddict['alarm_source']}"
     elif ddict["security_level"] == 0:
@@ -175,59 +481,102 @@ def elks_text(ddict, recipient=pilot_phone, user="pilot", fake=True):
     }
     if fake:
         data["dryrun"] = "yes"
-    response = requests.post(
-        "https://api.46elks.com/a1/sms",
-        auth=(secrets_dict["elks_username"], secrets_dict["elks_password"]),
-        data=data,
-    )
+    response = context.elks_session.post(f"{context.elks_api}/sms", data=data, timeout=elks_timeout)
     _log.warning(f"ELKS SEND: {response.text}")
     if response.status_code == 200:
-        alarm_log.info(
-            f"{ddict['glider']},{ddict['mission']},{ddict['cycle']},{ddict['security_level']},text_{user},{ddict['alarm_source']}"
-        )
+        context.alarm_store.mark_sent(ddict, f"text_{user}")
     else:
         _log.error(
             f"failed elks text {response.text}  {response.text} to {recipient}. {ddict['glider']},{ddict['mission']},{ddict['cycle']},{ddict['security_level']},call_{user},{ddict['alarm_source']}"
         )
+    return response.status_code == 200
 
 
 def elks_call(
-    ddict, recipient=pilot_phone, user="pilot", fake=True, timeout_seconds=60
+    ddict, recipient=None, user="pilot", fake=True, timeout_seconds=60
 ):
+    if recipient is None:
+        recipient = context.pilot_phone
     recipient = re.sub(r"[^0-9+]", "", recipient)
-    alarm_log = logging.getLogger(name=ddict["platform_id"])
     if fake:
-        response = requests.post(
-            "https://api.46elks.com/a1/sms",
-            auth=(secrets_dict["elks_username"], secrets_dict["elks_password"]),
+        response = context.elks_session.post(
+            f"{context.elks_api}/sms",
             data={
                 "from": "GliderAlert",
                 "to": recipient,
                 "message": "this is a fake call",
                 "dryrun": "yes",
             },
+            timeout=elks_timeout,
         )
     else:
-        response = requests.post(
-            "https://api.46elks.com/a1/calls",
-            auth=(secrets_dict["elks_username"], secrets_dict["elks_password"]),
-            data={
-                "from": secrets_dict["elks_phone"],
-                "to": recipient,
-                "voice_start": '{"play":"https://callumrollo.com/files/frederik_short.mp3"}',
-                "timeout": timeout_seconds,
-            },
-        )
+        data = {
+            "from": context.secrets_dict["elks_phone"],
+            "to": recipient,
+            "voice_start": '{"play":"https://callumrollo.com/files/frederik_short.mp3"}',
+            "timeout": timeout_seconds,
+        }
+        if context.elks_whenhangup:
+            data["whenhangup"] = context.elks_whenhangup
+        response = context.elks_session.post(f"{context.elks_api}/calls", data=data, timeout=elks_timeout)
     _log.warning(f"ELKS CALL: {response.text}")
     if response.status_code == 200:
-        alarm_log.info(
-            f"{ddict['glider']},{ddict['mission']},{ddict['cycle']},{ddict['security_level']},call_{user},{ddict['alarm_source']}"
-        )
+        context.alarm_store.mark_sent(ddict, f"call_{user}")
     else:
         _log.error(
             f"failed elks call {response.text} to {recipient}. {ddict['glider']},{ddict['mission']},{ddict['cycle']},{ddict['security_level']},call_{user},{ddict['alarm_source']}"
         )
-        
+    return response.status_code == 200
+
+
+def notify(ddict, recipients, fake=True):
+    """
+    Queue a text and a call to each (number, user) recipient in the outbox and return straight away. The outbox
+    sender makes the requests to 46elks, with retries. Each action is recorded as it is queued, so later checks see
+    it before it is sent. Returns what was queued: a text or call that has already been queued for this alarm,
+    recipient and user is not queued again.
+    """
+    queued = []
+    # kept with each action to measure how long alerts take, see AlarmStore.latency_report
+    ddict.setdefault("dispatch_time", datetime.datetime.now())
+    for recipient, user in recipients:
+        recipient = re.sub(r"[^0-9+]", "", recipient)
+        for channel in ["text", "call"]:
+            new = context.outbox.enqueue(ddict, recipient, user, channel, fake=fake)
+            if new:
+                record_action(ddict, f"{channel}_{user}")
+            metrics.count("alerts_queued_total", channel=channel, user=user, queued=new)
+            _log.info(f"{channel} {user} {recipient} {'queued' if new else 'already queued'}")
+            queued.append({"channel": channel, "recipient": recipient, "user": user, "queued": new})
+    return queued
+
+
+def outbox_give_up(entry, error):
+    alarm = entry["alarm"]
+    message = (
+        f"Could not send {entry['channel']} to {entry['user']} {entry['recipient']} for {alarm['platform_id']} "
+        f"M{alarm['mission']} cycle {alarm['cycle']} after {entry['attempts'] + 1} attempts: {error}. "
+        f"Still trying every {context.outbox_sender.max_delay // 60} minutes until the alarm clears"
+    )
+    mailer("failed alert", message, recipient=context.mail_recipient)
+    if context.secrets_dict.get("slack_mail"):
+        mailer("failed alert", message, recipient=context.slack_mail)
+
+
+def outbox_still_active(entry):
+    """Whether the alarm of an outbox entry is still active, so a text or call that keeps failing is retried"""
+    alarm = entry["alarm"]
+    if alarm["alarm_source"] in sailbuoy_sources:
+        # a sailbuoy alarm is not cleared by later data. It is news for as long as sailbuoy_alert acts on it
+        event_time = alarm.get("event_time")
+        since = datetime.datetime.fromisoformat(event_time) if event_time else None
+        return since is None or datetime.datetime.now() - since < datetime.timedelta(hours=12)
+    # imported here as alert_dispatch imports this module
+    from alert_dispatch import Dispatcher
+
+    return Dispatcher(alarm["platform_id"]).escalation_state(alarm) == "active"
+
+
 def phone_test(recipient, fake=True, message="Hi this is a test message from VOTO alert system"):
     data = {
         "from": "VOTOalert",
@@ -236,18 +585,13 @@ def phone_test(recipient, fake=True, message="Hi this is a test message from VOT
     }
     if fake:
         data["dryrun"] = "yes"
-    response = requests.post(
-        "https://api.46elks.com/a1/sms",
-        auth=(secrets_dict["elks_username"], secrets_dict["elks_password"]),
-        data=data,
-    )
+    response = context.elks_session.post(f"{context.elks_api}/sms", data=data)
     print(response.text)
     if not fake:
-        response = requests.post(
-            "https://api.46elks.com/a1/calls",
-            auth=(secrets_dict["elks_username"], secrets_dict["elks_password"]),
+        response = context.elks_session.post(
+            f"{context.elks_api}/calls",
             data={
-                "from": secrets_dict["elks_phone"],
+                "from": context.secrets_dict["elks_phone"],
                 "to": recipient,
                 "voice_start": '{"play":"https://callumrollo.com/files/frederik_short.mp3"}',
                 "timeout": 60,
@@ -258,71 +602,58 @@ def phone_test(recipient, fake=True, message="Hi this is a test message from VOT
 
 def contact_pilot(ddict, fake=True):
     _log.warning("PILOT")
-    if "," in pilot_phone:
-        for phone_number in pilot_phone.split(","):
-            elks_text(ddict, recipient=phone_number, fake=fake)
-            elks_call(ddict, recipient=phone_number, fake=fake)
-    else:
-        elks_text(ddict, fake=fake)
-        elks_call(ddict, fake=fake)
-    if extra_alarm_numbers:
-        for extra_number in extra_alarm_numbers:
-            elks_text(ddict, recipient=extra_number, fake=fake, user="self-volunteered")
-            elks_call(ddict, recipient=extra_number, fake=fake, user="self-volunteered")
+    recipients = [(phone_number, "pilot") for phone_number in context.pilot_phone.split(",")]
+    for extra_number in context.extra_alarm_numbers:
+        recipients.append((extra_number, "self-volunteered"))
+    return notify(ddict, recipients, fake=fake)
 
 
 def contact_supervisor(ddict, fake=True):
-    if not supervisor_phone:
+    if not context.supervisor_phone:
         _log.warning("No supervisor on duty: no action")
         return
     _log.warning("ESCALATE")
-    elks_text(ddict, recipient=supervisor_phone, user="supervisor", fake=fake)
-    elks_call(ddict, recipient=supervisor_phone, user="supervisor", fake=fake)
-
-
-with open(script_dir / "email_secrets.json") as json_file:
-    secrets = json.load(json_file)
-
-
-def check_if_new_mail():
-    # Check gmail account for any new emails
-    subject_file = Path("/data/log/last_mail_subject.txt")
-    if subject_file.exists():
-        subject = subject_file.read_text()
-    else:
-        with open(subject_file, 'w') as fout:
-            fout.write(str("nothing"))
-        return True
-    mail = imaplib.IMAP4_SSL("imap.gmail.com")
-    mail.login(secrets["email_username"], secrets["email_password"])
-    mail.select("inbox")
-    result, data = mail.search(None, 'ALL')
-    mail_id = data[0].split()[-1]
-    __, data = mail.fetch(mail_id, "(RFC822)")
-    email_subject = "willnevermatch"
-    for response_part in data:
-        if isinstance(response_part, tuple):
-            msg = email.message_from_bytes(response_part[1])
-            email_subject = msg["subject"]
-    if subject == email_subject:
-        return False
-    with open(subject_file, 'w') as fout:
-        _log.info(f"Most recent email: {email_subject}")
-        fout.write(email_subject)
-    return True
-
-
-def parse_mail_alarms():
-    # Check gmail account for emails
+    return notify(ddict, [(context.supervisor_phone, "supervisor")], fake=fake)
+
+
+def mail_date(msg):
+    """When the email was sent, from its Date header, as a naive local time like datetime.now(). None if unknown"""
+    try:
+        return email.utils.parsedate_to_datetime(msg["date"]).astimezone().replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return None
+
+
+def mail_subject(msg):
+    email_subject = msg["subject"] or ""
+    if email_subject.lower()[:2] == "fw":
+        email_subject = email_subject[4:]
+    return email_subject
+
+
+def alarm_email(msg):
+    """The glider, mission, cycle and alarm of an alseamar alarm email. None for any other email"""
+    email_subject = mail_subject(msg)
+    email_from = msg["from"] or ""
+    # If email is from alseamar and subject contains ALARM, make some noise
+    if "ALARM" in email_subject and (
+        "administrateur@alseamar-cloud.com" in email_from
+        or "calglider" in email_from
+    ):
+        _log.debug(f"email alarm parsed {email_subject}")
+        parts = email_subject.split(" ")
+        glider = parts[0][1:-1]
+        mission = int(parts[1][1:])
+        cycle = int(parts[3][1:])
+        alarm = int(parts[4][6:-1])
+        return glider, mission, cycle, alarm
+    return None
+
+
+@metrics.timed("parse_mail_alarms")
+def parse_mail_alarms(messages):
+    # Record the latest alarm from each glider in the emails. Returns the gliders with new alarms
     start = datetime.datetime.now()
-    mail = imaplib.IMAP4_SSL("imap.gmail.com")
-    mail.login(secrets["email_username"], secrets["email_password"])
-    mail.select("inbox")
-    result, data = mail.search(None, '(SUBJECT "ALARM")')
-    mail_ids = data[0]
-
-    id_list = mail_ids.split()
-
     # read in previous alarms record
     if mail_alarms_json.exists():
         with open(mail_alarms_json, "r") as f:
@@ -330,161 +661,108 @@ def parse_mail_alarms():
     else:
         glider_alerts = {}
 
-    # Check 3 newest emails
-    for i in id_list[-3:]:
-        result, data = mail.fetch(i, "(RFC822)")
-        for response_part in data:
-            if isinstance(response_part, tuple):
-                msg = email.message_from_bytes(response_part[1])
-                email_subject = msg["subject"]
-                if "fw" in email_subject.lower():
-                    email_subject = email_subject[4:]
-                email_from = msg["from"]
-                # If email is from alseamar and subject contains ALARM, make some noise
-                if (
-                    "administrateur@alseamar-cloud.com" in email_from
-                    or "calglider" in email_from
-                    and "ALARM" in email_subject
-                ):
-                    _log.debug(f"email alarm parsed {email_subject}")
-                    parts = email_subject.split(" ")
-                    glider = parts[0][1:-1]
-                    mission = int(parts[1][1:])
-                    cycle = int(parts[3][1:])
-                    alarm = int(parts[4][6:-1])
-                    glider_alerts[glider] = (mission, cycle, alarm)
+    new_alarms = set()
+    for msg in messages:
+        try:
+            fields = alarm_email(msg)
+        except (ValueError, IndexError):
+            # an unexpected subject must not stop the alarms in the other emails, nor be retried forever
+            _log.error(f"could not parse alarm email {mail_subject(msg)}")
+            continue
+        if fields is None:
+            continue
+        glider, mission, cycle, alarm = fields
+        if glider_alerts.get(glider, [])[:3] == [mission, cycle, alarm]:
+            # keep the date of the first email about this alarm
+            continue
+        new_alarms.add(glider)
+        sent = mail_date(msg)
+        glider_alerts[glider] = [mission, cycle, alarm, None if sent is None else sent.isoformat()]
     with open(mail_alarms_json, "w") as f:
         json.dump(glider_alerts, f, indent=4)
     elapsed = datetime.datetime.now() - start
     _log.info(f"Completed mail check in {elapsed.seconds} seconds")
+    metrics.count("alerts_mail_alarms_total", value=len(new_alarms))
+    return new_alarms
 
 
-def surfacing_alerts(fake=True):
-    # check what time email was last checked
-    timefile = Path("lastcheck_surface.txt")
-    if timefile.exists():
-        with open(timefile, "r") as variable_file:
-            for line in variable_file.readlines():
-                last_check = datetime.datetime.fromisoformat((line.strip()))
-    else:
-        last_check = datetime.datetime(1970, 1, 1)
-
+@metrics.timed("surfacing_alerts")
+def surfacing_alerts(messages, fake=True):
     _log.info("Check for surfacing emails")
-    # Check gmail account for emails
-    mail = imaplib.IMAP4_SSL("imap.gmail.com")
-    mail.login(secrets["email_username"], secrets["email_password"])
-    mail.select("inbox")
-
-    result, data = mail.search(None, "ALL")
-    mail_ids = data[0]
-
-    id_list = mail_ids.split()
-    first_email_id = int(id_list[0])
-    latest_email_id = int(id_list[-1])
-    # Cut to last 3 emails
-    if len(id_list) > 3:
-        first_email_id = int(id_list[-3])
-
-    # Check which emails have arrived since the last run of this script
-    unread_emails = []
-    for i in range(first_email_id, latest_email_id + 1):
-        result, data = mail.fetch(str(i), "(RFC822)")
-
-        for response_part in data:
-            if isinstance(response_part, tuple):
-                msg = email.message_from_bytes(response_part[1])
-                date_tuple = email.utils.parsedate_tz(msg["Date"])
-                if date_tuple:
-                    local_date = datetime.datetime.fromtimestamp(
-                        email.utils.mktime_tz(date_tuple),
-                    )
-                    if local_date > last_check:
-                        unread_emails.append(i)
-                        last_check = local_date
-
-    # Write the time of the most recently received surfacing email
-    with open(timefile, "w") as f:
-        f.write(str(last_check))
-    if not extra_alarm_numbers_surface:
+    if not context.extra_alarm_numbers_surface:
         _log.info("no one signed up for surfacing alerts")
         return
 
-    # Exit if no new emails
-    if not unread_emails:
-        _log.info("No new mail")
-        return
-    _log.debug("New emails")
-
-    # Check new emails
-    for i in unread_emails:
-        _log.debug(f"open mail {i}")
-        result, data = mail.fetch(str(i), "(RFC822)")
-        for response_part in data:
-            if isinstance(response_part, tuple):
-                msg = email.message_from_bytes(response_part[1])
-                email_subject = msg["subject"]
-                if email_subject.lower()[:2] == "fw":
-                    email_subject = email_subject[4:]
-                email_from = msg["from"]
-                # If email is from alseamar and subject contains ALARM, make some noise
-                if (
-                    "administrateur@alseamar-cloud.com" in email_from
-                    and "ALARM" not in email_subject
-                ):
-                    _log.warning(f"Surface {email_subject}")
-                    parts = email_subject.split(" ")
-                    glider = parts[0][1:-1]
-                    mission = int(parts[1][1:])
-                    cycle = int(parts[3][1:])
-                    ddict = {
-                        "glider": int(glider[3:]),
-                        "platform_id": glider,
-                        "mission": mission,
-                        "cycle": cycle,
-                        "security_level": 0,
-                        "alarm_source": "surfacing email",
-                    }
-                    for surface_number in extra_alarm_numbers_surface:
-                        elks_text(ddict, recipient=surface_number, fake=fake)
-                        elks_call(ddict, recipient=surface_number, fake=fake)
-
-
+    for msg in messages:
+        email_subject = mail_subject(msg)
+        email_from = msg["from"] or ""
+        # If email is from alseamar and subject does not contain ALARM, it is a surfacing
+        if (
+            "administrateur@alseamar-cloud.com" in email_from
+            and "ALARM" not in email_subject
+        ):
+            _log.warning(f"Surface {email_subject}")
+            parts = email_subject.split(" ")
+            try:
+                glider = parts[0][1:-1]
+                mission = int(parts[1][1:])
+                cycle = int(parts[3][1:])
+                glider_number = int(glider[3:])
+            except (ValueError, IndexError):
+                _log.error(f"could not parse surfacing email {email_subject}")
+                continue
+            ddict = {
+                "glider": glider_number,
+                "platform_id": glider,
+                "mission": mission,
+                "cycle": cycle,
+                "security_level": 0,
+                "alarm_source": "surfacing email",
+                "event_time": mail_date(msg),
+            }
+            notify(ddict, [(surface_number, "pilot") for surface_number in context.extra_alarm_numbers_surface], fake=fake)
+
+
+@metrics.timed("sailbuoy_alert")
 def sailbuoy_alert(ds, dispatch, t_step=15):
+    # ds may be opened lazily. Only the time coordinate and the last t_step samples of each variable are read
     platform_serial = ds.attrs["platform_serial"]
     mission = ds.attrs["deployment_id"]
-    if np.datetime64("now") - ds.time.values.max() > np.timedelta64(12, "h"):
+    times = ds.time.values
+    time_max = times.max()
+    # the sailbuoy times are in UTC
+    if np.datetime64(dispatch.utc_clock()) - time_max > np.timedelta64(12, "h"):
         _log.info(f"old news from SB{platform_serial} M{mission}. No warnings")
         return
     _log.info(f"process alerts for {platform_serial} M{mission}")
-    df_alarm = dispatch.df_alarm.copy()
-    df_alarm = df_alarm[df_alarm['glider'] == platform_serial]
-    df_alarm = df_alarm[df_alarm['mission'] == mission]
+    store = dispatch.store
     ddict = {'glider': platform_serial, 'mission': mission, 'cycle': 0, 'security_level': 1, 'alarm_source': 'sailbuoy nav', 'platform_id': platform_serial}
+    # the sailbuoy files are only checked as a whole, so the latest sample is taken as the time of the event. It is
+    # stored in local time, like the dispatch and action times it is compared with
+    ddict['event_time'] = pd.Timestamp(time_max).tz_localize("UTC").to_pydatetime().astimezone().replace(tzinfo=None)
     for var in ["Leak", "BigLeak", "SailRotation"]:
         if var not in list(ds):
             continue
-        ds[var] = ds[var].fillna(0)
-        if ds[var][-t_step:].any():
+        tail = ds[var][-t_step:].fillna(0).values
+        if tail.any():
             ddict['alarm_source'] = var
-            df = df_alarm[df_alarm['alarm_source'] == var]
-            if df.empty:
-                contact_pilot(ddict, fake=dispatch.dummy_calls)
-                contact_supervisor(ddict, fake=dispatch.dummy_calls)
+            if not store.has_action(platform_serial, mission, var):
+                dispatch.contact_pilot(ddict)
+                dispatch.contact_supervisor(ddict)
             else:
                 _log.info(f"Already logged Sailbuoy warning {ddict['platform_id']} M{ddict['mission']}. Source: {ddict['alarm_source']}")
 
     # Only alarm on warnings / off track after mission has run for 24 hours
-    if (ds.time.values.max() - ds.time.values.min()) / np.timedelta64(1, "h") < 24:
+    if (time_max - times.min()) / np.timedelta64(1, "h") < 24:
         _log.info(f"SB{platform_serial} M{mission} has just been deployed. Only leak emails")
         return
     var = "Warning"
-    ds[var] = ds[var].fillna(0)
-    if ds[var][-t_step:].any():
-        if not len(np.unique(ds[var][-t_step:])) == 1:
+    tail = ds[var][-t_step:].fillna(0).values
+    if tail.any():
+        if not len(np.unique(tail)) == 1:
             ddict['alarm_source'] = var
-            df = df_alarm[df_alarm['alarm_source'] == var]
-            if df.empty:
-                contact_pilot(ddict, fake=dispatch.dummy_calls)
+            if not store.has_action(platform_serial, mission, var):
+                dispatch.contact_pilot(ddict)
             else:
                 _log.info(f"Already logged Sailbuoy warning {ddict['platform_id']} M{ddict['mission']}. Source: {ddict['alarm_source']}")
     return  # no track radius checks for now
@@ -492,9 +770,9 @@ def sailbuoy_alert(ds, dispatch, t_step=15):
     ds[var] = ds[var].fillna(1)
     if not ds.WithinTrackRadius[-3].any():
         ddict['alarm_source'] = var
-        df = df_alarm[df_alarm['alarm_source'] == var]
-        df = df[df.datetime > datetime.datetime.now() - datetime.timedelta(hours=3)]
-        if df.empty:
+        if not store.has_action(
+            platform_serial, mission, var, since=datetime.datetime.now() - datetime.timedelta(hours=3)
+        ):
             mailer("Sailbuoy-off-track", f"Sailbuoy {ddict['platform_id']} off track", recipient=dispatch.slack_mail)
             contact_pilot(ddict, fake=True) # Just to log this event! Never sends a call/text
         else:
@@ -502,20 +780,42 @@ def sailbuoy_alert(ds, dispatch, t_step=15):
                 f"Already warned for off track in last 3 hours {ddict['platform_id']} M{ddict['mission']}. Source: {ddict['alarm_source']}")
 
 
-def parse_schedule():
-    schedule = pd.read_csv(
+@metrics.timed("schedule_sheet_read")
+def read_schedule_sheet():
+    """The on-call schedule as entered in the Google sheet, one row per day"""
+    # schedule_sheet_url points at another copy of the sheet, e.g. a local CSV file
+    url = context.secrets_dict.get("schedule_sheet_url") or (
         "https://docs.google.com/spreadsheets/d/"
-        + secrets_dict["google_sheet_id"]
-        + "/export?gid=722590891&format=csv",
-        index_col=0,
-    ).rename(
+        + context.secrets_dict["google_sheet_id"]
+        + "/export?gid=722590891&format=csv"
+    )
+    return pd.read_csv(url, index_col=0)
+
+
+def resolve_names(schedule, contacts, columns=("pilot", "supervisor")):
+    """Replace whole cell names with phone numbers, in one mapping pass over the unique cells of each column"""
+    for column in columns:
+        if column not in schedule.columns:
+            continue
+        values = schedule[column]
+        lookup = {cell: contacts.get(cell, cell) for cell in values.dropna().unique()}
+        schedule[column] = values.map(lookup)
+    return schedule
+
+
+def build_schedule(sheet, contacts, utc_offset=0):
+    """
+    Turn the rows of the schedule sheet into a table of shifts, indexed by the start time of each shift. Returns the
+    table and a list of the names that are not in contacts, which are blanked out.
+    """
+    schedule = sheet.rename(
         {
             "handover-am (UTC)": "handover-am-raw",
             "handover-pm (UTC)": "handover-pm-raw",
         },
         axis=1,
     )
-    schedule.dropna(subset="pilot-day", inplace=True)
+    schedule = schedule.dropna(subset="pilot-day").copy()
     schedule.index = pd.to_datetime(schedule.index)
     for shift in ["am", "pm"]:
         schedule[f"handover-{shift}"] = schedule[f"handover-{shift}-raw"]
@@ -530,64 +830,57 @@ def parse_schedule():
 
         schedule.loc[schedule[f"handover-{shift}"] > 24, f"handover-{shift}"] = np.nan
         schedule.loc[schedule[f"handover-{shift}"] < 0, f"handover-{shift}"] = np.nan
-    local_now = datetime.datetime.now().astimezone(pytz.timezone("Europe/Stockholm"))
-    offset_dt = local_now.utcoffset()
-    offset = int(offset_dt.seconds / 3600)
 
-    schedule["handover-am"] = schedule["handover-am"].fillna(9 - offset)
-    schedule["handover-pm"] = schedule["handover-pm"].fillna(17 - offset)
-
-    df = pd.DataFrame({"pilot": ["Callum"]}, index=[pd.to_datetime("1970-01-01")])
-    for i, row in schedule.iterrows():
-        day_start = i + np.timedelta64(int(60 * row["handover-am"]), "m")
-        day_row = pd.DataFrame(
-            {
-                "pilot": [row["pilot-day"]],
-                "supervisor": [row["on-call"]],
-                #'surface-text': [row['surface-text-day']],
-            },
-            index=[day_start],
-        )
-        df = pd.concat([df, day_row])
-
-        night_start = i + np.timedelta64(int(60 * row["handover-pm"]), "m")
-        night_row = pd.DataFrame(
-            {
-                "pilot": [row["pilot-night"]],
-                "supervisor": [row["on-call"]],
-                #'surface-text': [row['surface-text-night']],
-            },
-            index=[night_start],
+    schedule["handover-am"] = schedule["handover-am"].fillna(9 - utc_offset)
+    schedule["handover-pm"] = schedule["handover-pm"].fillna(17 - utc_offset)
+
+    shifts = [pd.DataFrame({"pilot": ["Callum"]}, index=[pd.to_datetime("1970-01-01")])]
+    for shift, pilot_column in [("am", "pilot-day"), ("pm", "pilot-night")]:
+        minutes = (60 * schedule[f"handover-{shift}"]).astype(int)
+        shifts.append(
+            pd.DataFrame(
+                {
+                    "pilot": schedule[pilot_column].values,
+                    "supervisor": schedule["on-call"].values,
+                },
+                index=schedule.index + pd.to_timedelta(minutes.values, unit="m"),
+            )
         )
-        df = pd.concat([df, night_row])
-
-    strings = list(pd.unique(df[df.columns].values.ravel("K")))
-    names = []
-    for name_str in strings:
-        if type(name_str) is not str:
+    # stable sort keeps the day shift before the night shift when handovers clash
+    df = pd.concat(shifts).sort_index(kind="stable")
+
+    # check each distinct cell once. Cells can hold several names, separated by commas
+    cleaned = {}
+    bad_names = set()
+    for cell in pd.unique(df[["pilot", "supervisor"]].values.ravel("K")):
+        if type(cell) is not str:
             continue
-        name_str = name_str.replace(" ", "")
-        if "," in name_str:
-            parts = name_str.split(",")
-            for part in parts:
-                names.append(part)
-        else:
-            names.append(name_str)
+        names = cell.replace(" ", "").split(",")
+        bad = {name for name in names if name not in contacts}
+        if bad:
+            bad_names.update(bad)
+            cleaned[cell] = ",".join(name for name in names if name not in bad)
+    for column in ["pilot", "supervisor"]:
+        df[column] = df[column].replace(cleaned)
+    return df, sorted(bad_names)
+
 
-    bad_names = []
-    for name in set(names):
-        if name not in contacts.keys():
-            df.replace(name, "", inplace=True, regex=True)
-            bad_names.append(name)
+def parse_schedule():
+    local_now = datetime.datetime.now().astimezone(pytz.timezone("Europe/Stockholm"))
+    offset_dt = local_now.utcoffset()
+    offset = int(offset_dt.seconds / 3600)
+    df, bad_names = build_schedule(read_schedule_sheet(), context.contacts, utc_offset=offset)
     if len(bad_names) > 0:
         mailer(
             "bad names in schedule",
             f"The following names have been ignored: {bad_names}. Using the last good schedule",
-            recipient=mail_recipient,
+            recipient=context.mail_recipient,
         )
-    df.to_csv("/data/log/schedule.csv", sep=";")
+    df.to_csv(schedule_csv, sep=";")
+    ScheduleIndex.from_schedule(resolve_names(df.copy(), context.contacts)).save(schedule_index_json)
+    context.refresh("schedule", "schedule_index", "extra_numbers")
     raw_date = datetime.datetime.now()
     date_string = raw_date.isoformat().replace(":", "").split('.')[0]
     fn = f"schedule_{date_string}.csv"
-    df.to_csv(f"/data/log/old_schedules/{fn}", sep=";")
+    df.to_csv(log_dir / "old_schedules" / fn, sep=";")
 
@@ -0,0 +1,593 @@
+"""
+Offline benchmarks for the alerts system. Run with e.g.
+
+python benchmark.py parse_mrs --lines 100000
+python benchmark.py parse_mrs --megabytes 1 10 100 1000 --no-reference
+python benchmark.py import
+python benchmark.py schedule --days 365
+python benchmark.py fleet --gliders 10 50 200 --output fleet.json --baseline fleet_last_week.json
+
+The fleet benchmark generates a whole synthetic tree: glider directories with live comm logs, sailbuoy files, secrets,
+a schedule sheet, an IMAP stand-in holding alarm emails and a 46elks stand-in. The scripts run against it in fresh
+interpreters, pointed at it through the ALERTS_* environment variables read by alert_utils. Generated data is the
+same from run to run, apart from being dated relative to now, so results can be compared between commits.
+"""
+import os
+import json
+import argparse
+import datetime
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import email.utils
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import xarray as xr
+import alert_utils
+from stand_ins import FakeElks, FakeImapServer
+
+
+def mrs_line(timestamp, glider, mission, cycle, security_level):
+    return (
+        f"[{timestamp:%d/%m/%Y %H:%M:%S}];GLIMPSE;comm;rx;0;$SEAMRS,SEA{glider:03d},M{mission},C{cycle},"
+        f"{security_level},5812.3456,N,01123.4567,E,12.3,45.6,78.9*5A;\n"
+    )
+
+
+def alr_line(timestamp, glider, alarm_mask):
+    return f"[{timestamp:%d/%m/%Y %H:%M:%S}];GLIMPSE;comm;rx;0;$SEAALR,SEA{glider:03d},{alarm_mask}*3F;\n"
+
+
+def nav_line(timestamp):
+    return f"[{timestamp:%d/%m/%Y %H:%M:%S}];GLIMPSE;comm;rx;0;$SEANAV,nothing to see here;\n"
+
+
+def lines_for_megabytes(megabytes):
+    """Number of MRS lines for write_comm_log to write a comm log of about this size"""
+    timestamp = datetime.datetime(2024, 1, 1)
+    line_bytes = len(mrs_line(timestamp, 63, 34, 1000, 0)) + len(nav_line(timestamp))
+    return max(1, int(megabytes * 1e6 / line_bytes))
+
+
+def write_comm_log(path, n_lines, glider=63, mission=34, start=datetime.datetime(2024, 1, 1), alarm_at_end=False):
+    """
+    Write a comm log of n_lines MRS lines two minutes apart, interleaved with other traffic and the odd SEAALR line.
+    With alarm_at_end, the last lines of the final cycle report an alarm.
+    """
+    timestamp = start
+    with open(path, "w", encoding="latin1") as fout:
+        for i in range(n_lines):
+            security_level = 4 if i % 97 == 0 or (alarm_at_end and i >= n_lines - 3) else 0
+            fout.write(mrs_line(timestamp, glider, mission, i // 10, security_level))
+            fout.write(nav_line(timestamp))
+            if i % 1000 == 500:
+                fout.write(alr_line(timestamp, glider, 0))
+            timestamp += datetime.timedelta(minutes=2)
+    return Path(path)
+
+
+def parse_mrs_pandas(comm_log_file):
+    """parse_mrs as it was before the single pass decoder, kept as a reference"""
+    df_in = pd.read_csv(
+        comm_log_file,
+        names=["everything"],
+        sep="Neverin100years",
+        engine="python",
+        on_bad_lines="skip",
+        encoding="latin1",
+    )
+    if "trmId" in df_in.everything[0]:
+        return pd.DataFrame()
+    df_mrs = df_in[df_in["everything"].str.contains("SEAMRS")].copy()
+    df_mrs = df_mrs[df_mrs.everything.astype(str).str.len() > 90]
+    parts = df_mrs.everything.str.split(";", expand=True)
+    df_mrs["datetime"] = pd.to_datetime(parts[0].str[1:-1], dayfirst=True)
+    df_mrs["message"] = parts[5]
+    msg_parts = df_mrs.message.str.split(",", expand=True)
+    df_mrs = df_mrs[msg_parts[1].astype(str) != "None"]
+    msg_parts = df_mrs.message.str.split(",", expand=True)
+    df_mrs["glider"] = msg_parts[1].str.replace(r"\D+", "", regex=True).astype(int)
+    df_mrs["mission"] = msg_parts[2].str.replace(r"\D+", "", regex=True).astype(int)
+    df_mrs["cycle"] = msg_parts[3].str.replace(r"\D+", "", regex=True).astype(int)
+    df_mrs["security_level"] = (
+        msg_parts[4].str.replace(r"\D+", "", regex=True).fillna(0).astype(int)
+    )
+    df_mrs = df_mrs[["cycle", "datetime", "glider", "mission", "security_level"]]
+    df_mrs["alarm"] = False
+    df_mrs.loc[df_mrs.security_level > 0, "alarm"] = True
+    df_alm = df_in[df_in["everything"].str.contains("SEAALR")].copy()
+    if not df_alm.empty:
+        last_alarm = df_alm.tail(1).everything.values[0]
+        alarm_mask = int(last_alarm.split("$SEAALR,")[1].split(",")[1].split("*")[0])
+        if alarm_mask != 0:
+            df_mrs.loc[df_mrs.security_level == alarm_mask, "alarm"] = False
+    df_mrs = df_mrs.sort_values("datetime")
+    return df_mrs
+
+
+def time_call(func, *args, repeat=3):
+    """Return the best wall clock time of repeat calls to func and the result of the last call"""
+    best = float("inf")
+    result = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_parse_mrs(n_lines, repeat=3, reference=True):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        comm_log_file = write_comm_log(Path(tmp_dir) / "sea063.34.com.raw.log", n_lines)
+        megabytes = comm_log_file.stat().st_size / 1e6
+        with open(comm_log_file, encoding="latin1") as fin:
+            total_lines = sum(1 for __ in fin)
+        t_regex, df_regex = time_call(alert_utils.parse_mrs, comm_log_file, repeat=repeat)
+        results = {
+            "lines": total_lines,
+            "megabytes": megabytes,
+            "regex_lines_per_second": total_lines / t_regex,
+            "regex_megabytes_per_second": megabytes / t_regex,
+        }
+        if reference:
+            t_pandas, df_pandas = time_call(parse_mrs_pandas, comm_log_file, repeat=repeat)
+            pd.testing.assert_frame_equal(df_pandas, df_regex)
+            results["pandas_lines_per_second"] = total_lines / t_pandas
+            results["speedup"] = t_pandas / t_regex
+    message = (
+        f"parse_mrs {total_lines} lines, {megabytes:.1f} MB: regex {results['regex_lines_per_second']:.0f} lines/s, "
+        f"{results['regex_megabytes_per_second']:.1f} MB/s"
+    )
+    if reference:
+        message += f", pandas {results['pandas_lines_per_second']:.0f} lines/s, speedup {results['speedup']:.1f}x"
+    print(message)
+    return results
+
+
+def time_subprocess(code, repeat=5, env=None):
+    """Best wall clock time of running code in a fresh interpreter, or None if it fails"""
+    best = float("inf")
+    for i in range(repeat):
+        start = time.perf_counter()
+        try:
+            subprocess.run(
+                [sys.executable, "-c", code], cwd=alert_utils.script_dir, env=env, check=True, capture_output=True
+            )
+        except subprocess.CalledProcessError:
+            return None
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+# the loads alert_utils used to do on import. extra_numbers is left out as it queries the user database
+deferred_loads = ["secrets_dict", "contacts", "secrets", "schedule", "schedule_index"]
+
+deferred_loads_code = f"""
+import json, time, alert_utils
+results = {{}}
+for name in {deferred_loads!r}:
+    start = time.perf_counter()
+    try:
+        getattr(alert_utils.context, name)
+    except Exception:
+        results[name] = None
+        continue
+    results[name] = time.perf_counter() - start
+print(json.dumps(results))
+"""
+
+
+def bench_import(repeat=5):
+    """
+    Time a bare import of alert_utils, and each load that import used to do up front and is now deferred. Run
+    against a synthetic fleet, so nothing is read from or sent by the real deployment.
+    """
+    with FleetEnvironment(n_gliders=1, n_lines=10, n_sailbuoys=0) as fleet:
+        fleet.run(parse_schedule_code)
+        results = {"import_seconds": time_subprocess("import alert_utils", repeat=repeat, env=fleet.env)}
+        print(f"import alert_utils: {results['import_seconds']:.3f} s")
+        runs = [fleet.run(deferred_loads_code) for i in range(repeat)]
+    for name in deferred_loads:
+        seconds = [run[name] for run in runs if run[name] is not None]
+        results[f"{name}_seconds"] = min(seconds) if seconds else None
+        if seconds:
+            print(f"deferred from import: {name} {min(seconds):.3f} s")
+        else:
+            print(f"could not load {name}")
+    return results
+
+
+def schedule_sheet(n_days, n_pilots=40, start="2024-01-01"):
+    """A synthetic schedule sheet of n_days rows, as read from Google, and the contacts it refers to"""
+    pilots = [f"Pilot{i:02d}" for i in range(n_pilots)]
+    contacts = {name: f"+4670{i:07d}" for i, name in enumerate(pilots)}
+    days = pd.date_range(start, periods=n_days, freq="D")
+    sheet = pd.DataFrame(
+        {
+            "pilot-day": [pilots[i % n_pilots] for i in range(n_days)],
+            "pilot-night": [pilots[(i + 7) % n_pilots] for i in range(n_days)],
+            "on-call": [pilots[(i * 3) % n_pilots] for i in range(n_days)],
+            "handover-am (UTC)": ["7:30" if i % 5 == 0 else None for i in range(n_days)],
+            "handover-pm (UTC)": [np.nan] * n_days,
+        },
+        index=days.strftime("%Y-%m-%d"),
+    )
+    # the odd shared shift and a name that is not in the contacts
+    sheet.iloc[10, 0] = f"{pilots[1]}, {pilots[2]}"
+    sheet.iloc[20, 1] = "Nobody"
+    return sheet, contacts
+
+
+def build_schedule_legacy(sheet, contacts, utc_offset=0):
+    """parse_schedule and the name replacement as they were before vectorizing, kept as a reference"""
+    schedule = sheet.rename(
+        {"handover-am (UTC)": "handover-am-raw", "handover-pm (UTC)": "handover-pm-raw"}, axis=1
+    )
+    schedule.dropna(subset="pilot-day", inplace=True)
+    schedule.index = pd.to_datetime(schedule.index)
+    for shift in ["am", "pm"]:
+        schedule[f"handover-{shift}"] = schedule[f"handover-{shift}-raw"]
+        if pd.api.types.is_object_dtype(schedule[f"handover-{shift}-raw"]):
+            time_parts = schedule[f"handover-{shift}-raw"].str.split(":", expand=True)
+            if time_parts.shape[1] == 2:
+                time_parts[1] = time_parts[1].replace({None: 0})
+                schedule[f"handover-{shift}"] = time_parts[0].astype(float) + time_parts[1].astype(float) / 60
+        schedule.drop(f"handover-{shift}-raw", axis=1, inplace=True)
+        schedule.loc[schedule[f"handover-{shift}"] > 24, f"handover-{shift}"] = np.nan
+        schedule.loc[schedule[f"handover-{shift}"] < 0, f"handover-{shift}"] = np.nan
+    schedule["handover-am"] = schedule["handover-am"].fillna(9 - utc_offset)
+    schedule["handover-pm"] = schedule["handover-pm"].fillna(17 - utc_offset)
+    df = pd.DataFrame({"pilot": ["Callum"]}, index=[pd.to_datetime("1970-01-01")])
+    for i, row in schedule.iterrows():
+        day_start = i + np.timedelta64(int(60 * row["handover-am"]), "m")
+        df = pd.concat([df, pd.DataFrame({"pilot": [row["pilot-day"]], "supervisor": [row["on-call"]]}, index=[day_start])])
+        night_start = i + np.timedelta64(int(60 * row["handover-pm"]), "m")
+        df = pd.concat(
+            [df, pd.DataFrame({"pilot": [row["pilot-night"]], "supervisor": [row["on-call"]]}, index=[night_start])]
+        )
+    names = []
+    for name_str in pd.unique(df[df.columns].values.ravel("K")):
+        if type(name_str) is not str:
+            continue
+        names.extend(name_str.replace(" ", "").split(","))
+    for name in set(names):
+        if name not in contacts.keys():
+            df.replace(name, "", inplace=True, regex=True)
+    for name, number in contacts.items():
+        df.replace(name, number, inplace=True)
+    return df
+
+
+def build_schedule_vectorized(sheet, contacts, utc_offset=0):
+    df, bad_names = alert_utils.build_schedule(sheet, contacts, utc_offset)
+    return alert_utils.resolve_names(df, contacts)
+
+
+def bench_schedule(n_days, repeat=3):
+    sheet, contacts = schedule_sheet(n_days)
+    t_legacy, df_legacy = time_call(build_schedule_legacy, sheet, contacts, repeat=repeat)
+    t_vectorized, df_vectorized = time_call(build_schedule_vectorized, sheet, contacts, repeat=repeat)
+    pd.testing.assert_frame_equal(df_legacy, df_vectorized)
+    results = {
+        "days": n_days,
+        "contacts": len(contacts),
+        "legacy_seconds": t_legacy,
+        "vectorized_seconds": t_vectorized,
+        "speedup": t_legacy / t_vectorized,
+    }
+    print(
+        f"schedule {n_days} days, {len(contacts)} contacts: legacy {t_legacy:.3f} s, "
+        f"vectorized {t_vectorized:.4f} s, speedup {results['speedup']:.0f}x"
+    )
+    return results
+
+
+def glider_name(i):
+    return f"SEA{100 + i:03d}"
+
+
+def write_fleet(base_dir, n_gliders, n_lines, mission=34, alarm_every=5, now=None):
+    """
+    A base_data_dir of n_gliders gliders, each with a live comm log of n_lines MRS lines ending now and an older
+    comm log in the previous mission. The final cycle of every alarm_every-th glider is in alarm.
+    """
+    now = now or datetime.datetime.now()
+    start = now - datetime.timedelta(minutes=2 * n_lines)
+    platforms = []
+    for i in range(n_gliders):
+        platform = glider_name(i)
+        glider = int(platform[3:])
+        for mission_number, end in [(mission - 1, start), (mission, now)]:
+            log_dir = Path(base_dir) / platform / f"{mission_number:06d}" / "G-Logs"
+            log_dir.mkdir(parents=True, exist_ok=True)
+            write_comm_log(
+                log_dir / f"{platform.lower()}.{mission_number}.com.raw.log",
+                n_lines,
+                glider=glider,
+                mission=mission_number,
+                start=end - datetime.timedelta(minutes=2 * n_lines),
+                alarm_at_end=mission_number == mission and i % alarm_every == 0,
+            )
+        platforms.append(platform)
+    return platforms
+
+
+def write_sailbuoy(path, serial, mission, n_samples=576, leak=False, now=None):
+    """A sailbuoy nrt_proc file of n_samples five minute samples ending now, with a leak at the end if leak"""
+    now = now or datetime.datetime.now()
+    times = pd.date_range(end=now, periods=n_samples, freq="5min")
+    flags = {var: np.zeros(n_samples) for var in ["Leak", "BigLeak", "SailRotation", "Warning"]}
+    if leak:
+        flags["Leak"][-3:] = 1
+    ds = xr.Dataset(
+        {**{var: ("time", values) for var, values in flags.items()}, "WithinTrackRadius": ("time", np.ones(n_samples))},
+        coords={"time": times},
+        attrs={"platform_serial": serial, "deployment_id": mission},
+    )
+    ds.to_netcdf(path)
+    return Path(path)
+
+
+def alarm_subject(platform, mission, cycle, security_level=None):
+    """The subject of an alseamar email: an alarm, or a surfacing if security_level is None"""
+    subject = f"[{platform}] M{mission} surfaced C{cycle}"
+    if security_level is not None:
+        subject += f" ALARM({security_level})"
+    return subject
+
+
+class FleetEnvironment:
+    """
+    A synthetic deployment in a temporary directory, with the stand-in IMAP and 46elks servers running in this
+    process. run() times code in a fresh interpreter pointed at it.
+    """
+
+    def __init__(self, n_gliders=10, n_lines=2000, n_sailbuoys=2, n_days=365, mission=34):
+        self.n_gliders = n_gliders
+        self.n_lines = n_lines
+        self.n_sailbuoys = n_sailbuoys
+        self.n_days = n_days
+        self.mission = mission
+        self.tmp_dir = None
+        self.elks = None
+        self.imap = None
+
+    def __enter__(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        root = Path(self.tmp_dir.name)
+        self.base_dir = root / "base"
+        self.log_dir = root / "log"
+        self.sailbuoy_dir = root / "sailbuoy"
+        self.secrets_dir = root / "secrets"
+        for directory in [self.base_dir, self.log_dir / "old_schedules", self.sailbuoy_dir, self.secrets_dir]:
+            directory.mkdir(parents=True)
+        self.elks = FakeElks().start()
+        self.imap = FakeImapServer().start()
+        now = datetime.datetime.now()
+        self.platforms = write_fleet(self.base_dir, self.n_gliders, self.n_lines, mission=self.mission, now=now)
+        for i in range(self.n_sailbuoys):
+            write_sailbuoy(self.sailbuoy_dir / f"SB21{i:02d}.nc", f"SB21{i:02d}", 5, leak=i == 0, now=now)
+        sheet, contacts = schedule_sheet(self.n_days, start=(now - datetime.timedelta(days=self.n_days // 2)).date())
+        sheet.to_csv(root / "schedule_sheet.csv")
+        secrets = {
+            "schedule_mail": "schedule@example.com",
+            "slack_mail": "slack@example.com",
+            "votoweb_dir": str(root / "no_votoweb"),
+            "elks_username": "bench",
+            "elks_password": "bench",
+            "elks_phone": "+46700000000",
+            "elks_api": self.elks.api,
+            "base_data_dir": str(self.base_dir),
+            "dummy_calls": "True",
+            "google_sheet_id": "none",
+            "schedule_sheet_url": str(root / "schedule_sheet.csv"),
+        }
+        email_secrets = {
+            "email_username": "bench",
+            "email_password": "bench",
+            "imap_host": "127.0.0.1",
+            "imap_port": self.imap.port,
+            "imap_ssl": False,
+        }
+        for name, values in [("alarm", secrets), ("contacts", contacts), ("email", email_secrets)]:
+            with open(self.secrets_dir / f"{name}_secrets.json", "w") as fout:
+                json.dump(values, fout, indent=4)
+        self.env = {
+            **os.environ,
+            "ALERTS_LOG_DIR": str(self.log_dir),
+            "ALERTS_SECRETS_DIR": str(self.secrets_dir),
+            "ALERTS_SAILBUOY_DIR": str(self.sailbuoy_dir),
+            "ALERTS_MOCK_MAIL": "1",
+        }
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for server in [self.elks, self.imap]:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+        self.tmp_dir.cleanup()
+
+    def add_emails(self, n_emails):
+        """Alarm emails for the gliders in turn, with a surfacing email after each"""
+        date = email.utils.formatdate(localtime=True)
+        for i in range(n_emails):
+            platform = self.platforms[i % len(self.platforms)]
+            cycle = self.n_lines // 10 + 1 + i // len(self.platforms)
+            if i % 2:
+                self.imap.add_message(alarm_subject(platform, self.mission, cycle), date=date)
+            else:
+                self.imap.add_message(alarm_subject(platform, self.mission, cycle, 512), date=date)
+        # process all of them, rather than the newest few as on a first sync
+        with open(self.log_dir / "mail_sync.json", "w") as fout:
+            json.dump({"uidvalidity": self.imap.uidvalidity, "last_uid": 0}, fout)
+
+    def run(self, code):
+        """Run code in a fresh interpreter. Returns the JSON it prints last, with the wall time of the whole run"""
+        start = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, "-c", code], cwd=alert_utils.script_dir, env=self.env, capture_output=True, text=True
+        )
+        seconds = time.perf_counter() - start
+        if completed.returncode:
+            raise RuntimeError(f"benchmark step failed:\n{completed.stderr}")
+        lines = completed.stdout.strip().splitlines()
+        result = json.loads(lines[-1]) if lines else {}
+        result["process_seconds"] = seconds
+        return result
+
+    def run_script(self, script):
+        return self.run(f"import runpy, sys; sys.argv = [{script!r}]; runpy.run_path({script!r}, run_name='__main__')")
+
+
+parse_schedule_code = """
+import json, time, alert_utils
+start = time.perf_counter()
+alert_utils.parse_schedule()
+print(json.dumps({"seconds": time.perf_counter() - start}))
+"""
+
+dispatcher_code = """
+import json, time
+from alert_dispatch import Dispatcher, glider_platforms
+seconds = []
+for platform in glider_platforms():
+    start = time.perf_counter()
+    dispatch = Dispatcher(platform)
+    dispatch.dummy_calls = True
+    dispatch.execute()
+    seconds.append(time.perf_counter() - start)
+print(json.dumps({"platforms": len(seconds), "seconds": sum(seconds), "max_platform_seconds": max(seconds)}))
+"""
+
+
+def bench_fleet(n_gliders, n_lines=2000, n_sailbuoys=2, n_days=365, n_emails=50, repeat=3):
+    """Time each stage of the alerts system against a synthetic fleet"""
+    results = {"gliders": n_gliders, "lines": n_lines, "sailbuoys": n_sailbuoys, "days": n_days, "emails": n_emails}
+    with FleetEnvironment(n_gliders, n_lines, n_sailbuoys, n_days) as fleet:
+        results["comm_log_megabytes"] = sum(
+            path.stat().st_size for path in fleet.base_dir.glob("*/*/G-Logs/*com.raw.log")
+        ) / 1e6
+        comm_log_file = next(fleet.base_dir.glob(f"{fleet.platforms[0]}/{fleet.mission:06d}/G-Logs/*com.raw.log"))
+        results["parse_mrs_seconds"], __ = time_call(alert_utils.parse_mrs, comm_log_file, repeat=repeat)
+        results["parse_schedule_seconds"] = min(fleet.run(parse_schedule_code)["seconds"] for i in range(repeat))
+        # the first pass reads every comm log and sends the alarms, later ones find nothing new
+        passes = [fleet.run(dispatcher_code) for i in range(repeat)]
+        results["dispatcher_execute_first_seconds"] = passes[0]["seconds"]
+        results["dispatcher_execute_repeat_seconds"] = min(run["seconds"] for run in passes[1:] or passes)
+        results["dispatcher_execute_max_platform_seconds"] = passes[0]["max_platform_seconds"]
+        for stat_cache in fleet.log_dir.glob("stat_cache.json"):
+            stat_cache.unlink()
+        passes = [fleet.run_script("alert_dispatch.py") for i in range(repeat)]
+        results["alert_dispatch_cold_seconds"] = passes[0]["process_seconds"]
+        results["alert_dispatch_warm_seconds"] = min(run["process_seconds"] for run in passes[1:] or passes)
+        fleet.add_emails(n_emails)
+        results["mail_alerts_seconds"] = fleet.run_script("mail_alerts.py")["process_seconds"]
+        results["mail_alerts_idle_seconds"] = min(
+            fleet.run_script("mail_alerts.py")["process_seconds"] for i in range(repeat)
+        )
+        results["elks_requests"] = len(fleet.elks.requests)
+    print(
+        f"fleet of {n_gliders} gliders, {results['comm_log_megabytes']:.0f} MB of comm logs: "
+        f"Dispatcher.execute {results['dispatcher_execute_first_seconds']:.2f} s first, "
+        f"{results['dispatcher_execute_repeat_seconds']:.2f} s repeat. alert_dispatch.py "
+        f"{results['alert_dispatch_cold_seconds']:.2f} s cold, {results['alert_dispatch_warm_seconds']:.2f} s warm. "
+        f"mail_alerts.py {results['mail_alerts_seconds']:.2f} s for {n_emails} emails. "
+        f"parse_schedule {results['parse_schedule_seconds']:.3f} s. {results['elks_requests']} requests to 46elks"
+    )
+    return results
+
+
+def compare(results, baseline):
+    """Print how each timing and rate in results compares to the same one in a baseline results file"""
+    with open(baseline) as fin:
+        baseline_runs = json.load(fin)["results"]
+    for run, baseline_run in zip(results, baseline_runs):
+        for key, value in run.items():
+            old = baseline_run.get(key)
+            if not isinstance(value, (int, float)) or not old:
+                continue
+            if key.endswith("per_second"):
+                slower = old / value
+            elif key.endswith("seconds"):
+                slower = value / old
+            else:
+                continue
+            flag = "  REGRESSION" if slower > 1.2 else ""
+            print(f"{key}: {old:.4g} -> {value:.4g}, {slower:.2f}x the time{flag}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=alert_utils.script_dir, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the alerts system")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the timings with those in this results file")
+    # the same options after the benchmark name. Suppressed defaults don't overwrite those given before it
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--output", default=argparse.SUPPRESS, help="write the results to this JSON file")
+    common.add_argument("--baseline", default=argparse.SUPPRESS, help="compare the timings with those in this file")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    parser_mrs = subparsers.add_parser("parse_mrs", help="decode a synthetic comm log", parents=[common])
+    parser_mrs.add_argument("--lines", type=int, default=100000, help="number of MRS lines to generate")
+    parser_mrs.add_argument(
+        "--megabytes", type=float, nargs="+", help="sizes of the comm logs to generate, instead of --lines"
+    )
+    parser_mrs.add_argument("--no-reference", action="store_true", help="do not time the old pandas decoder")
+    parser_mrs.add_argument("--repeat", type=int, default=3)
+    parser_import = subparsers.add_parser("import", help="time a cold import of alert_utils", parents=[common])
+    parser_import.add_argument("--repeat", type=int, default=5)
+    parser_schedule = subparsers.add_parser(
+        "schedule", help="build the shift table from a synthetic sheet", parents=[common]
+    )
+    parser_schedule.add_argument("--days", type=int, default=365, help="number of days in the sheet")
+    parser_schedule.add_argument("--repeat", type=int, default=3)
+    parser_fleet = subparsers.add_parser(
+        "fleet", help="run the alerts system against synthetic fleets", parents=[common]
+    )
+    parser_fleet.add_argument("--gliders", type=int, nargs="+", default=[10], help="sizes of the fleets")
+    parser_fleet.add_argument("--lines", type=int, default=2000, help="MRS lines in each comm log")
+    parser_fleet.add_argument("--sailbuoys", type=int, default=2)
+    parser_fleet.add_argument("--days", type=int, default=365, help="number of days in the schedule sheet")
+    parser_fleet.add_argument("--emails", type=int, default=50, help="number of emails in the inbox")
+    parser_fleet.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    started = datetime.datetime.now()
+    if args.benchmark == "parse_mrs":
+        sizes = [lines_for_megabytes(megabytes) for megabytes in args.megabytes] if args.megabytes else [args.lines]
+        results = [bench_parse_mrs(n_lines, repeat=args.repeat, reference=not args.no_reference) for n_lines in sizes]
+    elif args.benchmark == "import":
+        results = [bench_import(repeat=args.repeat)]
+    elif args.benchmark == "schedule":
+        results = [bench_schedule(args.days, repeat=args.repeat)]
+    elif args.benchmark == "fleet":
+        results = [
+            bench_fleet(n_gliders, args.lines, args.sailbuoys, args.days, args.emails, repeat=args.repeat)
+            for n_gliders in args.gliders
+        ]
+    if args.baseline:
+        compare(results, args.baseline)
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump(
+                {
+                    "benchmark": args.benchmark,
+                    "arguments": vars(args),
+                    "started": started.isoformat(),
+                    "commit": git_commit(),
+                    "python": platform.python_version(),
+                    "results": results,
+                },
+                fout,
+                indent=4,
+            )
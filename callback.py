@@ -1,65 +1,199 @@
+import csv
+import hmac
 import json
-import requests
-import pandas as pd
-from pathlib import Path
+import argparse
 import datetime
 import logging
+import threading
 import time
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
 from alert_utils import (
-    secrets_dict, setup_logger
+    context, setup_logger, log_dir, elks_timeout
 )
 
-_log = setup_logger("core_log", "/data/log/redial.log", level=logging.DEBUG)
+_log = logging.getLogger(name="core_log")
 
+redial_csv = log_dir / "redial.csv"
 
-def redial():
-    redial_file = Path('/data/log/redial.csv')
-    if redial_file.exists():
-        df_redial = pd.read_csv(redial_file)
-    else:
-        df_redial = pd.DataFrame()
 
-    response = requests.get(
-        "https://api.46elks.com/a1/calls",
-        auth=(secrets_dict["elks_username"], secrets_dict["elks_password"]),
-    )
-    calls_dict = json.loads(response.text)
-    df = pd.DataFrame(calls_dict['data'])
-    df = df[[
-         'to',
-         'created',
-         'state',
-        'id'
-         ]]
-    df['created'] = pd.to_datetime(df['created'])
-    df = df[df['created'] > datetime.datetime.now() - datetime.timedelta(days=1)]
-    failed = df[df.state=='failed']
-    if failed.empty:
-        return
-
-    for i, row in failed.iterrows():
-        time.sleep(5)
-        if not df_redial.empty:
-            if row.id in df_redial.original_id.values:
-                continue
-        response = requests.post(
-            "https://api.46elks.com/a1/calls",
-            auth=(secrets_dict["elks_username"], secrets_dict["elks_password"]),
-            data={
-                "from": secrets_dict["elks_phone"],
-                "to": row['to'],
-                "voice_start": '{"play":"https://callumrollo.com/files/frederik_short.mp3"}',
-                "timeout": 60,
-            },
-        )
-        response_dict = json.loads(response.text)
-        response_dict['original_id'] = row.id
-        _log.warn(f"REDIAL {str(response_dict)}")
-        df_redial = pd.concat((df_redial, pd.DataFrame(data=response_dict, index=[(len(df_redial)+1)])))
-        df_redial.to_csv(redial_file, index=False)
+class RedialLog:
+    """
+    Calls that have been redialled, appended to redial_csv one line per redial. The ids of the failed calls and of
+    the redials are held in sets, so a call is redialled at most once and a failed redial is not redialled again.
+    """
+
+    default_columns = ["id", "original_id", "to", "from", "state", "direction", "created"]
+
+    def __init__(self, redial_file=redial_csv):
+        self.redial_file = Path(redial_file)
+        self.lock = threading.Lock()
+        self.original_ids = set()
+        self.redial_ids = set()
+        self.columns = self.default_columns
+        if self.redial_file.exists():
+            with open(self.redial_file, newline="") as fin:
+                reader = csv.DictReader(fin)
+                self.columns = reader.fieldnames or self.default_columns
+                for row in reader:
+                    self.original_ids.add(row.get("original_id"))
+                    self.redial_ids.add(row.get("id"))
+
+    def seen(self, call_id):
+        return call_id in self.original_ids or call_id in self.redial_ids
+
+    def claim(self, call_id):
+        """Returns True the first time it is called for call_id, so the caller should redial it"""
+        with self.lock:
+            if self.seen(call_id):
+                return False
+            self.original_ids.add(call_id)
+            return True
+
+    def append(self, response_dict):
+        with self.lock:
+            self.redial_ids.add(response_dict.get("id"))
+            new_file = not self.redial_file.exists()
+            with open(self.redial_file, "a", newline="") as fout:
+                writer = csv.DictWriter(fout, fieldnames=self.columns, extrasaction="ignore")
+                if new_file:
+                    writer.writeheader()
+                writer.writerow(response_dict)
+
+
+def redial_call(call, redial_log):
+    """Call the number of a failed call again, unless it has already been redialled or is a redial itself"""
+    if not redial_log.claim(call["id"]):
+        _log.debug(f"call {call['id']} already redialled")
+        return None
+    data = {
+        "from": context.secrets_dict["elks_phone"],
+        "to": call["to"],
+        "voice_start": '{"play":"https://callumrollo.com/files/frederik_short.mp3"}',
+        "timeout": 60,
+    }
+    if context.elks_whenhangup:
+        data["whenhangup"] = context.elks_whenhangup
+    response = context.elks_session.post(f"{context.elks_api}/calls", data=data, timeout=elks_timeout)
+    response_dict = json.loads(response.text)
+    response_dict['original_id'] = call["id"]
+    _log.warning(f"REDIAL {str(response_dict)}")
+    redial_log.append(response_dict)
+    return response_dict
+
+
+def recent_calls(since):
+    """The calls made since a time, following the pages of the 46elks call history"""
+    calls = []
+    params = {}
+    while True:
+        response = context.elks_session.get(f"{context.elks_api}/calls", params=params, timeout=elks_timeout)
+        page = json.loads(response.text)
+        for call in page["data"]:
+            if pd.to_datetime(call["created"]).tz_localize(None) < since:
+                return calls
+            calls.append(call)
+        if not page.get("next"):
+            return calls
+        params = {"end": page["next"]}
+
+
+def lookup_call(call_id):
+    """The record 46elks holds of a call, or None if it has none"""
+    response = context.elks_session.get(f"{context.elks_api}/calls/{call_id}", timeout=elks_timeout)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return json.loads(response.text)
+
+
+def redial(redial_log=None):
+    # Poll the call history for failed calls. The callback server makes this unnecessary
+    redial_log = redial_log or RedialLog()
+    for call in recent_calls(datetime.datetime.now() - datetime.timedelta(days=1)):
+        if call.get("direction", "outgoing") == "outgoing" and call["state"] == "failed":
+            redial_call(call, redial_log)
+
+
+class CallbackHandler(BaseHTTPRequestHandler):
+    """
+    Receives the whenhangup posts 46elks makes when a call ends, and redials the call if it failed. The post only
+    names the call: its number and outcome are read back from 46elks, so a forged post cannot make the account call
+    anyone the system has not called itself.
+    """
+
+    def authorised(self):
+        url = urlparse(self.path)
+        token = parse_qs(url.query).get("token", [""])[0]
+        return url.path == self.server.path and hmac.compare_digest(token.encode(), self.server.token.encode())
+
+    def do_POST(self):
+        if not self.authorised():
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        fields = parse_qs(self.rfile.read(length).decode())
+        call_id = fields.get("id", [None])[0]
+        # answer straight away, 46elks does not wait on the redial
+        self.send_response(204)
+        self.end_headers()
+        if not call_id:
+            return
+        try:
+            call = lookup_call(call_id)
+            if call is None:
+                _log.warning(f"whenhangup post for unknown call {call_id}")
+                return
+            _log.info(f"call {call_id} to {call.get('to')} ended: {call.get('state')}")
+            if call.get("direction", "outgoing") == "outgoing" and call.get("state") == "failed":
+                redial_call(call, self.server.redial_log)
+        except Exception as e:
+            _log.error(f"failed to redial {call_id}: {e}")
+
+    def log_message(self, format, *args):
+        _log.debug(format % args)
+
+
+class CallbackServer(ThreadingHTTPServer):
+    """
+    Listens for whenhangup posts on path. Only posts that carry token as their token query parameter are acted on,
+    so elks_whenhangup should be e.g. https://example.org/whenhangup?token=<callback_token>
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 8080), path="/whenhangup", token=None, redial_log=None):
+        if not token:
+            raise ValueError("the callback server needs a secret token")
+        super().__init__(address, CallbackHandler)
+        self.path = path
+        self.token = token
+        self.redial_log = redial_log or RedialLog()
+
 
 if __name__ == '__main__':
-    time.sleep(30)
-    _log.info("START")
-    redial()
-    _log.info("END")
+    parser = argparse.ArgumentParser(description="redial failed alarm calls")
+    parser.add_argument(
+        "--serve", action="store_true", help="receive the outcome of each call from 46elks and redial failures at once"
+    )
+    args = parser.parse_args()
+    setup_logger("core_log", log_dir / "redial.log", level=logging.DEBUG)
+    if args.serve:
+        # listen on localhost behind a reverse proxy unless callback_host says otherwise
+        host = context.secrets_dict.get("callback_host", "127.0.0.1")
+        address = (host, int(context.secrets_dict.get("callback_port", 8080)))
+        server = CallbackServer(
+            address,
+            path=context.secrets_dict.get("callback_path", "/whenhangup"),
+            token=context.secrets_dict.get("callback_token"),
+        )
+        _log.info(f"START callback server on {server.server_address[0]} port {server.server_address[1]}")
+        server.serve_forever()
+    else:
+        # give the calls of the last alert time to end
+        time.sleep(30)
+        _log.info("START")
+        redial()
+        _log.info("END")
@@ -0,0 +1,298 @@
+import os
+import mmap
+import pickle
+import hashlib
+import logging
+from pathlib import Path
+import pandas as pd
+import datetime
+import metrics
+from alert_utils import (
+    comm_log_cache_dir,
+    decode_mrs,
+    last_alarm_mask,
+    mask_alarms,
+    mrs_pattern,
+    non_digits,
+    split_lines,
+)
+
+_log = logging.getLogger(name="core_log")
+
+# bytes before a cached offset that must be unchanged for a file to count as appended to
+check_bytes = 256
+
+
+def read_checksum(fin, offset):
+    """Checksum of the check_bytes before offset in an open file, to tell a file appended to from one rewritten"""
+    start = max(0, offset - check_bytes)
+    fin.seek(start)
+    return hashlib.md5(fin.read(offset - start)).hexdigest()
+
+
+def parse_timestamp(timestamp):
+    try:
+        return datetime.datetime.strptime(timestamp, "%d/%m/%Y %H:%M:%S")
+    except ValueError:
+        return pd.to_datetime(timestamp, dayfirst=True)
+
+
+@metrics.timed("comm_log_tail")
+def read_tail(comm_log_file, since):
+    """
+    Read a comm log backwards from the last complete line until an MRS line older than since and the start of the most
+    recent cycle have both been passed, so the lines needed to check the latest state of the glider are read without
+    touching the rest of the mission. If there was no $SEAALR line among them, the last one before is found with a
+    byte search and put first, so the alarm mask is still known. Returns the lines in file order and the byte offset
+    of the end of the last complete line.
+    """
+    with open(comm_log_file, "rb") as fin:
+        if os.fstat(fin.fileno()).st_size == 0:
+            return [], 0
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = mm.rfind(b"\n") + 1
+            lines = []
+            found_alarm_mask = False
+            passed_since = False
+            latest_cycle = None
+            line_end = end
+            while line_end > 0:
+                line_start = mm.rfind(b"\n", 0, line_end - 1) + 1
+                line = mm[line_start:line_end].decode("latin1").rstrip("\r\n")
+                line_end = line_start
+                if not line:
+                    continue
+                lines.append(line)
+                if "SEAALR" in line:
+                    found_alarm_mask = True
+                    continue
+                match = mrs_pattern.match(line) if "SEAMRS" in line else None
+                if not match:
+                    continue
+                try:
+                    cycle = int(non_digits.sub("", match["cycle"]))
+                    timestamp = parse_timestamp(match["datetime"][1:-1])
+                except ValueError:
+                    continue
+                if latest_cycle is None:
+                    latest_cycle = cycle
+                passed_since = passed_since or timestamp < since
+                if passed_since and cycle < latest_cycle:
+                    break
+            if not found_alarm_mask:
+                alarm_start = mm.rfind(b"$SEAALR", 0, line_end)
+                if alarm_start >= 0:
+                    line_start = mm.rfind(b"\n", 0, alarm_start) + 1
+                    line_end = mm.find(b"\n", alarm_start)
+                    lines.append(mm[line_start:line_end].decode("latin1").rstrip("\r"))
+    lines.reverse()
+    return lines, end
+
+
+class CommLog:
+    """
+    Incremental reader for a single *com.raw.log file. The byte offset and inode of the file are cached along with
+    the MRS lines decoded so far, so each read only parses the bytes appended since the last one. If the file is
+    truncated or replaced, it is parsed again from the start.
+
+    If a window is given, only the MRS lines from the last window of time, plus the whole of the latest cycle, are
+    kept. A file seen for the first time is then read backwards from the end with read_tail instead of in full.
+    """
+
+    def __init__(self, comm_log_file, window=None, cache_dir=comm_log_cache_dir, clock=None):
+        self.comm_log_file = Path(comm_log_file)
+        self.window = window
+        # the window ends at the time of the Dispatcher clock
+        self.clock = clock or datetime.datetime.now
+        key = hashlib.md5(str(self.comm_log_file).encode()).hexdigest()
+        self.cache_file = Path(cache_dir) / f"{key}.pkl"
+        # a reader kept between reads, as by the alert daemon, only loads the cache once
+        self.loaded = False
+        self.reset()
+
+    def reset(self):
+        self.inode = None
+        self.offset = 0
+        self.checksum = None
+        self.old_format = False
+        self.alarm_mask = None
+        self.df_mrs = pd.DataFrame()
+        # a trailing line without a newline is parsed, but not cached, as it may still be written to
+        self.pending_mrs = pd.DataFrame()
+        self.pending_mask = None
+
+    def load_state(self):
+        if not self.cache_file.exists():
+            return
+        try:
+            with open(self.cache_file, "rb") as fin:
+                state = pickle.load(fin)
+        except Exception as e:
+            _log.warning(f"could not read comm log cache {self.cache_file}: {e}")
+            return
+        if state["comm_log_file"] != str(self.comm_log_file):
+            return
+        self.inode = state["inode"]
+        self.offset = state["offset"]
+        self.checksum = state["checksum"]
+        self.old_format = state["old_format"]
+        self.alarm_mask = state["alarm_mask"]
+        self.df_mrs = state["df_mrs"]
+
+    def save_state(self):
+        state = {
+            "comm_log_file": str(self.comm_log_file),
+            "inode": self.inode,
+            "offset": self.offset,
+            "checksum": self.checksum,
+            "old_format": self.old_format,
+            "alarm_mask": self.alarm_mask,
+            "df_mrs": self.df_mrs,
+        }
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.cache_file.with_suffix(".tmp")
+        with open(tmp_file, "wb") as fout:
+            pickle.dump(state, fout)
+        os.replace(tmp_file, self.cache_file)
+
+    def decode(self, chunk):
+        lines = split_lines(chunk.decode("latin1"))
+        if not lines:
+            return pd.DataFrame(), None
+        return decode_mrs(lines), last_alarm_mask(lines)
+
+    @metrics.timed("comm_log_update")
+    def update(self):
+        """Parse any bytes appended since the last update. Returns True if the cached state has changed"""
+        changed = False
+        with open(self.comm_log_file, "rb") as fin:
+            stat = os.fstat(fin.fileno())
+            if self.inode is not None and stat.st_ino != self.inode:
+                _log.info(f"{self.comm_log_file} has been replaced. Parse from start")
+                self.reset()
+            elif self.inode is not None and (
+                stat.st_size < self.offset or read_checksum(fin, self.offset) != self.checksum
+            ):
+                _log.info(f"{self.comm_log_file} has been truncated. Parse from start")
+                self.reset()
+            if self.inode is None:
+                self.inode = stat.st_ino
+                self.checksum = read_checksum(fin, 0)
+                changed = True
+                if self.window is not None:
+                    self.seed(fin)
+                    stat = os.fstat(fin.fileno())
+            self.pending_mrs, self.pending_mask = pd.DataFrame(), None
+            if stat.st_size == self.offset:
+                return changed
+            fin.seek(self.offset)
+            chunk = fin.read(stat.st_size - self.offset)
+            end = chunk.rfind(b"\n") + 1
+            if end:
+                self.checksum = read_checksum(fin, self.offset + end)
+        if self.offset == 0 and b"trmId" in chunk.split(b"\n", 1)[0]:
+            self.old_format = True
+        if self.old_format:
+            self.offset += end
+            return True
+        metrics.count("alerts_comm_log_bytes_total", value=len(chunk))
+        if end:
+            df_new, alarm_mask = self.decode(chunk[:end])
+            self.offset += end
+            changed = True
+            if alarm_mask is not None:
+                self.alarm_mask = alarm_mask
+            if self.df_mrs.empty:
+                self.df_mrs = df_new
+            elif not df_new.empty:
+                self.df_mrs = pd.concat([self.df_mrs, df_new], ignore_index=True)
+        self.pending_mrs, self.pending_mask = self.decode(chunk[end:])
+        if changed:
+            self.prune()
+        return changed
+
+    def seed(self, fin):
+        """Start from the tail of the file rather than parsing it from the start"""
+        fin.seek(0)
+        if b"trmId" in fin.readline():
+            return
+        lines, end = read_tail(self.comm_log_file, self.clock() - self.window)
+        self.offset = end
+        self.checksum = read_checksum(fin, end)
+        if lines:
+            self.df_mrs, self.alarm_mask = self.decode("\n".join(lines).encode("latin1"))
+
+    def prune(self):
+        """Drop MRS lines that are outside the window and not part of the latest cycle"""
+        if self.window is None or self.df_mrs.empty:
+            return
+        keep = (self.df_mrs.datetime >= self.clock() - self.window) | (
+            self.df_mrs.cycle == self.df_mrs.cycle.values[-1]
+        )
+        keep.iloc[-1] = True
+        if not keep.all():
+            self.df_mrs = self.df_mrs[keep].reset_index(drop=True)
+
+    def read(self):
+        """Return the decoded MRS lines of the whole file, as parse_mrs would"""
+        if not self.loaded:
+            self.load_state()
+            self.loaded = True
+        if self.update():
+            self.save_state()
+        if self.old_format:
+            _log.warning(f"old logfile type in {self.comm_log_file}. skipping")
+            return pd.DataFrame()
+        df_mrs = self.df_mrs
+        if df_mrs.empty:
+            df_mrs = self.pending_mrs
+        elif not self.pending_mrs.empty:
+            df_mrs = pd.concat([df_mrs, self.pending_mrs], ignore_index=True)
+        if df_mrs.empty:
+            return df_mrs
+        alarm_mask = self.alarm_mask if self.pending_mask is None else self.pending_mask
+        df_mrs = mask_alarms(df_mrs.copy(), alarm_mask)
+        return df_mrs.sort_values("datetime")
+
+
+class CommLogStream:
+    """
+    The active comm log of a platform and the one before it, read as one time ordered stream of MRS lines, so the
+    recent history is not lost when a new mission or log file is started. Only the lines of the previous file within
+    the window are added, read with a windowed CommLog so only its tail is parsed, and once the file was last written
+    before the window it is not opened at all. If the active file has no MRS lines yet, or is in the old trmId format,
+    the latest state of the glider is that of the previous file.
+    """
+
+    def __init__(self, comm_log_file, previous_file, window, cache_dir=comm_log_cache_dir, clock=None):
+        self.comm_log_file = Path(comm_log_file)
+        self.previous_file = None if previous_file is None else Path(previous_file)
+        self.window = window
+        self.clock = clock or datetime.datetime.now
+        self.active = CommLog(self.comm_log_file, window=window, cache_dir=cache_dir, clock=self.clock)
+        self.previous = None
+        if previous_file is not None:
+            self.previous = CommLog(self.previous_file, window=window, cache_dir=cache_dir, clock=self.clock)
+
+    def previous_in_window(self, since):
+        try:
+            return datetime.datetime.fromtimestamp(self.previous_file.stat().st_mtime) >= since
+        except FileNotFoundError:
+            return False
+
+    def read(self):
+        df_mrs = self.active.read()
+        if self.previous is None:
+            return df_mrs
+        if df_mrs.empty:
+            return self.previous.read()
+        since = self.clock() - self.window
+        if not self.previous_in_window(since):
+            return df_mrs
+        df_previous = self.previous.read()
+        if not df_previous.empty:
+            df_previous = df_previous[df_previous.datetime >= since]
+        if df_previous.empty:
+            return df_mrs
+        _log.debug(f"add {len(df_previous)} MRS lines from {self.previous_file}")
+        return pd.concat([df_previous, df_mrs], ignore_index=True).sort_values("datetime", kind="stable")
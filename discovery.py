@@ -0,0 +1,128 @@
+import os
+import json
+import logging
+from fnmatch import fnmatch
+from pathlib import Path
+
+_log = logging.getLogger(name="core_log")
+
+
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def subdirectories(path):
+    try:
+        with os.scandir(path) as entries:
+            return sorted(entry.name for entry in entries if entry.is_dir())
+    except FileNotFoundError:
+        return []
+
+
+class DiscoveryIndex:
+    """
+    Where each platform's active comm log is: platform -> latest mission -> newest *com.raw.log. Each lookup is
+    stored with the mtimes of the directories it was read from. A directory's mtime changes whenever an entry is
+    added to or removed from it. So a platform is only looked up again when a new mission or comm log appears, and a
+    rollover to a new mission is seen on the first check after it. The index is saved to index_file between runs.
+    """
+
+    platform_patterns = ["SEA*", "SHW*"]
+
+    def __init__(self, base_dir, index_file=None):
+        self.base_dir = Path(base_dir)
+        self.index_file = index_file
+        self.platform_list = None
+        self.entries = {}
+        self.dirty = False
+        if index_file is not None and Path(index_file).exists():
+            try:
+                with open(index_file, "r") as f:
+                    index = json.load(f)
+                if index["base_dir"] == str(self.base_dir):
+                    self.platform_list = index["platforms"]
+                    self.entries = index["entries"]
+            except (ValueError, KeyError) as e:
+                _log.warning(f"could not read discovery index {index_file}: {e}. Rebuild it")
+
+    def save(self):
+        if self.index_file is None or not self.dirty:
+            return
+        index = {"base_dir": str(self.base_dir), "platforms": self.platform_list, "entries": self.entries}
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(index, f, indent=4)
+        os.replace(tmp_file, self.index_file)
+        self.dirty = False
+
+    @staticmethod
+    def unchanged(signature):
+        return all(mtime(path) == mtime_ns for path, mtime_ns in signature.items())
+
+    def platforms(self):
+        """The platform directories in base_dir, sorted"""
+        if self.platform_list is None or not self.unchanged(self.platform_list["signature"]):
+            names = [
+                name
+                for name in subdirectories(self.base_dir)
+                if any(fnmatch(name, pattern) for pattern in self.platform_patterns)
+            ]
+            self.platform_list = {"platforms": names, "signature": {str(self.base_dir): mtime(self.base_dir)}}
+            self.dirty = True
+        return list(self.platform_list["platforms"])
+
+    def scan(self, platform):
+        """Find the newest comm log and the one before it, perhaps in an earlier mission, noting the directories read"""
+        platform_dir = self.base_dir / platform
+        signature = {str(platform_dir): mtime(platform_dir)}
+        missions = [name for name in subdirectories(platform_dir) if name.startswith("0")]
+        comm_log_files = []
+        for i, mission in enumerate(reversed(missions)):
+            mission_dir = platform_dir / mission
+            g_logs = mission_dir / "G-Logs"
+            if i == 0:
+                # catches the G-Logs directory of a new mission being created
+                signature[str(mission_dir)] = mtime(mission_dir)
+            signature[str(g_logs)] = mtime(g_logs)
+            try:
+                comm_logs = sorted(name for name in os.listdir(g_logs) if name.endswith("com.raw.log"))
+            except (FileNotFoundError, NotADirectoryError):
+                comm_logs = []
+            comm_log_files = [str(g_logs / name) for name in comm_logs[-2:]] + comm_log_files
+            if len(comm_log_files) >= 2:
+                break
+        comm_log_files = [None, None] + comm_log_files
+        _log.debug(f"discovered {platform} comm log {comm_log_files[-1]} after {comm_log_files[-2]}")
+        return {"comm_log": comm_log_files[-1], "previous": comm_log_files[-2], "signature": signature}
+
+    def entry(self, platform):
+        entry = self.entries.get(platform)
+        if entry is None or not self.unchanged(entry["signature"]):
+            entry = self.scan(platform)
+            self.entries[platform] = entry
+            self.dirty = True
+        return entry
+
+    def comm_log(self, platform):
+        """The active comm log of a platform, or None if it has none"""
+        return self.comm_logs(platform)[0]
+
+    def comm_logs(self, platform):
+        """The active comm log of a platform and the one before it. Either may be None"""
+        entry = self.entry(platform)
+        return tuple(None if entry.get(key) is None else Path(entry[key]) for key in ("comm_log", "previous"))
+
+    def directories(self, platform):
+        """The directories whose changes can change the active comm log of a platform"""
+        return [Path(path) for path in self.entry(platform)["signature"]]
+
+    def refresh(self):
+        """Bring the whole index up to date"""
+        for platform in self.platforms():
+            self.entry(platform)
+        for platform in set(self.entries) - set(self.platform_list["platforms"]):
+            del self.entries[platform]
+            self.dirty = True
@@ -0,0 +1,122 @@
+import math
+import datetime
+import logging
+import metrics
+
+_log = logging.getLogger(name="core_log")
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel. Timers are kept in slots of tick seconds, so adding, cancelling and expiring a timer costs
+    the same however many are pending. Timers further ahead than one turn of the wheel wait in their slot for the
+    right turn.
+    """
+
+    def __init__(self, tick=1.0, slots=512, start=None):
+        self.tick = tick
+        self.slots = [dict() for i in range(slots)]
+        self.current = math.floor((start or datetime.datetime.now()).timestamp() / tick)
+        self.timers = {}
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def add(self, key, due, payload=None):
+        """Start a timer expiring at the datetime due, replacing any timer with the same key"""
+        self.cancel(key)
+        # a timer that is already due expires on the next advance
+        tick_number = max(math.ceil(due.timestamp() / self.tick), self.current)
+        slot = tick_number % len(self.slots)
+        self.slots[slot][key] = (tick_number, due, payload)
+        self.timers[key] = slot
+
+    def cancel(self, key):
+        slot = self.timers.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def advance(self, now=None):
+        """Move the wheel on to now. Returns the (key, due, payload) of the timers that expired, oldest first"""
+        target = math.floor((now or datetime.datetime.now()).timestamp() / self.tick)
+        expired = []
+        # after a long gap, one turn of the wheel visits every slot
+        steps = min(target - self.current + 1, len(self.slots))
+        for step in range(max(steps, 0)):
+            slot = self.slots[(self.current + step) % len(self.slots)]
+            for key, (tick_number, due, payload) in list(slot.items()):
+                if tick_number <= target:
+                    del slot[key]
+                    del self.timers[key]
+                    expired.append((key, due, payload))
+        self.current = max(self.current, target + 1)
+        return sorted(expired, key=lambda timer: timer[1])
+
+    def next_due(self):
+        """The earliest due time of the pending timers, or None"""
+        dues = [self.slots[slot][key][1] for key, slot in self.timers.items()]
+        return min(dues) if dues else None
+
+
+def escalation_key(ddict):
+    return str(ddict["platform_id"]), int(ddict["mission"]), int(ddict["cycle"]), int(ddict["security_level"])
+
+
+class EscalationScheduler:
+    """
+    Contacts the supervisor when an alarm is still active escalation_delay after the pilot was contacted. The
+    deadlines are kept in the alarm store, so they survive restarts and are shared by the cron job and the daemon.
+    A long running process holds them in a TimerWheel and escalates on time. The cron job catches up on any that
+    have passed with run_due. The platform is checked again before each escalation, so a supervisor is only
+    contacted about an alarm that is still active, and each escalation is claimed in the store first, so it is only
+    ever made once.
+    """
+
+    def __init__(self, store, fake=True, tick=1.0):
+        self.store = store
+        self.fake = fake
+        self.wheel = TimerWheel(tick=tick)
+
+    def sync(self):
+        """Load the pending deadlines from the store, and drop any that have been cancelled or made elsewhere"""
+        pending = {escalation_key(ddict): ddict for ddict in self.store.pending_escalations()}
+        for key in [key for key in self.wheel.timers if key not in pending]:
+            self.wheel.cancel(key)
+        for key, ddict in pending.items():
+            if key not in self.wheel:
+                self.wheel.add(key, ddict["due"], ddict)
+
+    def schedule(self, ddict, due):
+        self.store.schedule_escalation(ddict, due)
+        self.wheel.add(escalation_key(ddict), due, ddict)
+
+    def next_due(self):
+        return self.wheel.next_due()
+
+    def run_due(self, now=None):
+        """Escalate every alarm whose deadline has passed. Returns the number of supervisors contacted"""
+        self.sync()
+        escalated = 0
+        for key, due, ddict in self.wheel.advance(now):
+            if self.escalate(ddict):
+                escalated += 1
+        return escalated
+
+    def escalate(self, ddict):
+        # imported here as alert_dispatch imports this module
+        from alert_dispatch import Dispatcher
+
+        platform_id = ddict["platform_id"]
+        dispatch = Dispatcher(platform_id, store=self.store)
+        dispatch.dummy_calls = self.fake
+        state = dispatch.escalate(ddict)
+        if state != "escalated":
+            _log.info(f"escalation of {platform_id} M{ddict['mission']} cycle {ddict['cycle']} not made: {state}")
+            return False
+        lateness = datetime.datetime.now() - ddict["due"]
+        metrics.observe("alerts_escalation_lateness_seconds", lateness.total_seconds())
+        _log.warning(f"escalated {platform_id} M{ddict['mission']} cycle {ddict['cycle']}, {lateness} after deadline")
+        return True
@@ -0,0 +1,110 @@
+import os
+import ctypes
+import ctypes.util
+import select
+import struct
+import logging
+
+_log = logging.getLogger(name="core_log")
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# a file written to, or moved or created in, the watched directory
+watch_mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+event_header = struct.Struct("iIII")
+
+
+class Inotify:
+    """
+    Linux inotify on directories, through ctypes so no extra package is needed. read returns the paths that changed,
+    or raises OSError if inotify is not available, so callers can fall back to polling.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise self.error("inotify_init1")
+        self.watches = {}
+
+    @staticmethod
+    def error(call, path=""):
+        code = ctypes.get_errno()
+        return OSError(code, f"{call} failed: {os.strerror(code)}", str(path))
+
+    def add_watch(self, path, mask=watch_mask):
+        path = str(path)
+        if path in self.watches.values():
+            return
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            # ENOSPC means fs.inotify.max_user_watches has been reached
+            raise self.error("inotify_add_watch", path)
+        self.watches[wd] = path
+
+    def remove_watch(self, path):
+        for wd, watched in list(self.watches.items()):
+            if watched == str(path):
+                self._rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read(self, timeout=None):
+        """
+        Wait up to timeout seconds for events and return them as a list of (path, mask). If the kernel's event queue
+        overflowed, the list contains (None, IN_Q_OVERFLOW) and the caller should rescan everything.
+        """
+        readable, __, __ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        position = 0
+        while position + event_header.size <= len(data):
+            wd, mask, cookie, length = event_header.unpack_from(data, position)
+            position += event_header.size
+            name = data[position : position + length].rstrip(b"\0")
+            position += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            directory = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                # the watched directory was removed
+                self.watches.pop(wd, None)
+                continue
+            if directory is None:
+                continue
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            events.append((path, mask))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self.watches = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,18 +1,25 @@
-from pathlib import Path
+import argparse
+import datetime
+import imaplib
 import logging
+import time
 from alert_utils import (
     setup_logger,
-    secrets_dict,
+    write_metrics,
+    context,
     parse_mail_alarms,
     surfacing_alerts,
-    mail_recipient,
-    mailer, check_if_new_mail,
+    mailer,
+    log_dir,
 )
+from mail_sync import MailSync
+from alert_dispatch import Dispatcher
+
+_log = logging.getLogger(name="core_log")
 
-_log = setup_logger("core_log", "/data/log/mail_alarms.log", level=logging.DEBUG)
 
 def main():
-    fail_file = Path("/data/log/mail_alarm_fails.txt")
+    fail_file = log_dir / "mail_alarm_fails.txt"
     if fail_file.exists():
         with open(fail_file) as fin:
             fail_count = int(fail_file.read_text())
@@ -22,45 +29,127 @@ def main():
             fout.write(str(fail_count))
     fail_count += 1
     if fail_count == 10:
-        mailer("failed-alerts", "automated mail alerts system has failed. Switch over to backup system e.g. IFTTT", mail_recipient)
+        mailer("failed-alerts", "automated mail alerts system has failed. Switch over to backup system e.g. IFTTT", context.mail_recipient)
     fail = False
     with open(fail_file, 'w') as fout:
         fout.write(str(fail_count))
+    sync = MailSync()
     try:
-        new_mail = check_if_new_mail()
+        with sync:
+            uids, messages = sync.fetch_new()
     except:
-        new_mail = True
-    if not new_mail:
+        _log.error("failed to sync mail")
+        mailer("failed alerts", "Failed to sync mail")
+        return
+    if not messages:
         _log.info("No new mail. stop processing")
+        sync.commit(uids)
+        write_metrics("mail")
         with open(fail_file, 'w') as fout:
             fout.write(str(0))
         return
     try:
-        parse_mail_alarms()
+        parse_mail_alarms(messages)
     except:
         _log.error("failed to process mail alarms")
         fail = True
         mailer("failed alerts", "Failed to execute mail alarms")
-    base_dir = Path(secrets_dict["base_data_dir"])
-    all_glider_dirs = list(base_dir.glob("SEA*")) +  list(base_dir.glob("SHW*"))
-    all_glider_dirs.sort()
     fake = False
-    if secrets_dict["dummy_calls"] == "True":
+    if context.secrets_dict["dummy_calls"] == "True":
         fake = True
     try:
-        surfacing_alerts(fake=fake)
+        surfacing_alerts(messages, fake=fake)
     except:
         _log.error("failed to process surfacing alarms")
         mailer("failed alerts", "Failed to execute surfacing alerts")
         fail = True
+    context.outbox_sender.drain()
+    write_metrics("mail")
 
     if not fail:
+        # a batch that failed is fetched and processed again on the next run
+        sync.commit(uids)
         fail_count = 0
     with open(fail_file, 'w') as fout:
         fout.write(str(fail_count))
 
 
+def handle_new_mail(messages, fake):
+    # Act on new mail straight away, rather than waiting for the next run of alert_dispatch
+    try:
+        new_alarms = parse_mail_alarms(messages)
+    except:
+        _log.error("failed to process mail alarms")
+        mailer("failed alerts", "Failed to execute mail alarms")
+        new_alarms = set()
+    for platform in sorted(new_alarms):
+        dispatch = Dispatcher(platform)
+        dispatch.dummy_calls = fake
+        try:
+            dispatch.execute()
+        except Exception as e:
+            _log.error(f"failed to process email alarm for {platform}")
+            mailer("failed alerts", f"Failed to execute {platform}. Error: {e}")
+    try:
+        surfacing_alerts(messages, fake=fake)
+    except:
+        _log.error("failed to process surfacing alarms")
+        mailer("failed alerts", "Failed to execute surfacing alerts")
+
+
+def listen(idle_timeout=600, max_backoff=300):
+    # Hold an IMAP IDLE connection and process each new email as it arrives. Reconnect with backoff on errors
+    fake = context.secrets_dict["dummy_calls"] == "True"
+    # texts and calls are sent from a background thread as they are queued
+    context.outbox_sender.start()
+    backoff = 1
+    while True:
+        try:
+            with MailSync() as sync:
+                _log.info("listening for new mail")
+                uids, messages = sync.fetch_new()
+                handover = context.schedule_index.next_handover()
+                contacts_version = context.contacts_version()
+                while True:
+                    handover_passed = handover and datetime.datetime.now() >= handover
+                    if handover_passed or context.contacts_version() != contacts_version:
+                        # pick up schedule and contacts changes made since the last handover
+                        context.refresh_duty()
+                        handover = context.schedule_index.next_handover()
+                        contacts_version = context.contacts_version()
+                    if messages:
+                        handle_new_mail(messages, fake)
+                        write_metrics("mail_listener")
+                    sync.commit(uids)
+                    # only reset once mail has been processed, so an error on every pass still backs off
+                    backoff = 1
+                    if not sync.idle(timeout=idle_timeout):
+                        break
+                    uids, messages = sync.fetch_new()
+        except (imaplib.IMAP4.error, OSError) as e:
+            _log.error(f"mail listener lost connection: {e}. Reconnect in {backoff} seconds")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, max_backoff)
+        except Exception as e:
+            # anything else, e.g. from reading the schedule, must not stop the listener for good
+            _log.exception(f"mail listener failed: {e}. Reconnect in {backoff} seconds")
+            if backoff == 1:
+                mailer("failed alerts", f"Mail listener failed, restarting. Error: {e}")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, max_backoff)
+
+
 if __name__ == "__main__":
-    _log.info("******** START CHECK **********")
-    main()
-    _log.info("******** COMPLETE CHECK *********")
+    parser = argparse.ArgumentParser(description="check email for glider alarms and surfacings")
+    parser.add_argument(
+        "--listen", action="store_true", help="run continuously, processing emails as they arrive"
+    )
+    args = parser.parse_args()
+    setup_logger("core_log", log_dir / "mail_alarms.log", level=logging.DEBUG)
+    if args.listen:
+        _log.info("******** START LISTENER **********")
+        listen()
+    else:
+        _log.info("******** START CHECK **********")
+        main()
+        _log.info("******** COMPLETE CHECK *********")
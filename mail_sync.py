@@ -0,0 +1,169 @@
+import re
+import json
+import email
+import imaplib
+import logging
+import metrics
+from alert_utils import context, mail_sync_json
+
+_log = logging.getLogger(name="core_log")
+
+uid_pattern = re.compile(rb"UID (\d+)")
+
+
+def start_idle(mail):
+    """
+    Send IDLE on an imaplib connection and return its tag. imaplib has no IDLE command before Python 3.14, so this
+    takes the next command tag with the private IMAP4._new_tag, which has kept its name and behaviour from Python 3.0
+    to 3.13. It is the only private part of imaplib used here.
+    """
+    if not hasattr(mail, "_new_tag"):
+        raise imaplib.IMAP4.error("this imaplib has no IMAP4._new_tag. Update start_idle for it")
+    tag = mail._new_tag()
+    mail.send(tag + b" IDLE\r\n")
+    return tag
+
+
+class MailSync:
+    """
+    A single IMAP session shared by all mail checks. The UIDVALIDITY of the inbox and the last UID processed are kept
+    in mail_sync_json, so each sync only fetches the Subject, From and Date headers of messages that arrived since the
+    last one. The UID is only moved on by commit, once the messages have been acted on, so a batch that fails is
+    fetched again.
+    """
+
+    header_fields = "(UID BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)])"
+
+    def __init__(self, state_file=mail_sync_json, first_sync=3):
+        self.state_file = state_file
+        # number of the newest messages, and of the newest alarm messages, to process when there is no record of
+        # previous syncs
+        self.first_sync = first_sync
+        self.mail = None
+        self.uidvalidity = None
+        self.last_uid = None
+        if self.state_file.exists():
+            with open(self.state_file, "r") as f:
+                state = json.load(f)
+            self.uidvalidity = state["uidvalidity"]
+            self.last_uid = state["last_uid"]
+
+    @metrics.timed("imap_connect")
+    def connect(self):
+        secrets = context.secrets
+        host = secrets.get("imap_host", "imap.gmail.com")
+        if secrets.get("imap_ssl", True):
+            self.mail = imaplib.IMAP4_SSL(host, secrets.get("imap_port", 993))
+        else:
+            # e.g. a local stand-in server from stand_ins.py
+            self.mail = imaplib.IMAP4(host, secrets.get("imap_port", 143))
+        self.mail.login(secrets["email_username"], secrets["email_password"])
+        self.select()
+
+    def select(self):
+        self.mail.select("inbox")
+        __, data = self.mail.response("UIDVALIDITY")
+        uidvalidity = int(data[0])
+        if uidvalidity != self.uidvalidity:
+            if self.uidvalidity is not None:
+                _log.warning(f"inbox UIDVALIDITY changed from {self.uidvalidity} to {uidvalidity}. Resync")
+            self.uidvalidity = uidvalidity
+            self.last_uid = None
+
+    def close(self):
+        if self.mail is None:
+            return
+        try:
+            self.mail.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+        self.mail = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def save_state(self):
+        with open(self.state_file, "w") as f:
+            json.dump({"uidvalidity": self.uidvalidity, "last_uid": self.last_uid}, f, indent=4)
+
+    def search(self, criteria):
+        __, data = self.mail.uid("SEARCH", None, criteria)
+        return [int(uid) for uid in data[0].split()]
+
+    def new_uids(self):
+        if self.last_uid is None:
+            uids = self.search("ALL")[-self.first_sync:] + self.search('(SUBJECT "ALARM")')[-self.first_sync:]
+            return sorted(set(uids))
+        __, data = self.mail.uid("SEARCH", None, f"UID {self.last_uid + 1}:*")
+        # n:* always matches the newest message, even if its UID is below n
+        return [int(uid) for uid in data[0].split() if int(uid) > self.last_uid]
+
+    @metrics.timed("imap_fetch")
+    def fetch_new(self):
+        """
+        Return the UIDs of the messages that arrived since the last commit, and their headers as
+        email.message.Message, oldest first. Pass the UIDs to commit once the messages have been processed.
+        """
+        uids = self.new_uids()
+        messages = []
+        if uids:
+            __, data = self.mail.uid("FETCH", ",".join(str(uid) for uid in uids), self.header_fields)
+            messages = self.parse_fetch(data)
+        metrics.count("alerts_emails_total", value=len(messages))
+        _log.info(f"{len(messages)} new emails")
+        return uids, [msg for uid, msg in sorted(messages, key=lambda item: item[0])]
+
+    def commit(self, uids):
+        """Record the messages as processed, so the next sync starts after them"""
+        if uids and (self.last_uid is None or max(uids) > self.last_uid):
+            self.last_uid = max(uids)
+        self.save_state()
+
+    def idle(self, timeout=600):
+        """
+        Wait in IMAP IDLE until the server reports a new message, and return True. If nothing arrives within timeout
+        seconds, the connection is closed and False is returned, as servers drop idle connections after 30 minutes.
+        """
+        mail = self.mail
+        tag = start_idle(mail)
+        line = mail.readline()
+        if not line.startswith(b"+"):
+            raise imaplib.IMAP4.error(f"IDLE refused: {line}")
+        mail.sock.settimeout(timeout)
+        try:
+            while True:
+                line = mail.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("connection closed during IDLE")
+                if line.rstrip().endswith(b"EXISTS"):
+                    break
+        except TimeoutError:
+            # a timed out socket file can't be read again
+            mail.shutdown()
+            self.mail = None
+            return False
+        mail.sock.settimeout(None)
+        mail.send(b"DONE\r\n")
+        while not line.startswith(tag):
+            line = mail.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed during IDLE")
+        return True
+
+    @staticmethod
+    def parse_fetch(data):
+        messages = []
+        for response_part in data:
+            if isinstance(response_part, tuple):
+                match = uid_pattern.search(response_part[0])
+                messages.append([int(match[1]) if match else None, email.message_from_bytes(response_part[1])])
+            elif messages and messages[-1][0] is None and response_part:
+                # some servers send the UID after the message literal
+                match = uid_pattern.search(response_part)
+                if match:
+                    messages[-1][0] = int(match[1])
+        return [(uid or 0, msg) for uid, msg in messages]
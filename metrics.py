@@ -0,0 +1,193 @@
+"""
+Timings and counts of what the alerts system does, kept in memory per process and written out at the end of each
+run as a Prometheus textfile, for the node exporter textfile collector, and as JSON.
+
+with metrics.span("parse_mrs", platform="SEA063"):
+    ...
+metrics.count("alerts_sent_total", channel="text")
+"""
+import os
+import json
+import time
+import datetime
+import functools
+import threading
+from contextlib import contextmanager
+
+# upper bounds in seconds of the histogram buckets
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+stage_seconds = "alerts_stage_seconds"
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metrics:
+    """Counters, gauges and histograms, each identified by a name and a set of labels"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def count(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """Time the block and add it to the histogram of the stage. Errors are counted and raised"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count("alerts_stage_errors_total", stage=stage, **labels)
+            raise
+        finally:
+            self.observe(stage_seconds, time.perf_counter() - start, stage=stage, **labels)
+
+    def snapshot(self):
+        """Everything recorded so far, in a form that can be pickled, merged and written as JSON"""
+        with self.lock:
+            return {
+                "counters": [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                "gauges": [[name, list(labels), value] for (name, labels), value in self.gauges.items()],
+                "histograms": [
+                    [name, list(labels), {**histogram, "buckets": list(histogram["buckets"])}]
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+            }
+
+    def take(self):
+        """Snapshot and reset, e.g. to hand the metrics of a worker process back to the parent"""
+        snapshot = self.snapshot()
+        self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, value in snapshot["gauges"]:
+                self.gauges[(name, tuple(tuple(pair) for pair in labels))] = value
+            for name, labels, other in snapshot["histograms"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                histogram = self.histograms.setdefault(key, {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0})
+                histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], other["buckets"])]
+                histogram["sum"] += other["sum"]
+                histogram["count"] += other["count"]
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for kind, series in [("counter", self.counters), ("gauge", self.gauges)]:
+                for name in sorted({name for name, labels in series}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (series_name, labels), value in sorted(series.items()):
+                        if series_name == name:
+                            lines.append(f"{name}{format_labels(labels)} {value}")
+            for name in sorted({name for name, labels in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (series_name, labels), histogram in sorted(self.histograms.items()):
+                    if series_name != name:
+                        continue
+                    for bound, bucket_count in zip(buckets, histogram["buckets"]):
+                        lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {bucket_count}")
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Per series totals, with the mean and bucket estimated p95 of each histogram"""
+        snapshot = self.snapshot()
+        histograms = []
+        for name, labels, histogram in snapshot["histograms"]:
+            p95 = None
+            for bound, bucket_count in zip(buckets, histogram["buckets"]):
+                if bucket_count >= 0.95 * histogram["count"]:
+                    p95 = bound
+                    break
+            histograms.append(
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram["count"],
+                    "sum": histogram["sum"],
+                    "mean": histogram["sum"] / histogram["count"] if histogram["count"] else None,
+                    "p95_upper_bound": p95,
+                }
+            )
+        return {
+            "generated": datetime.datetime.now().isoformat(),
+            "counters": [{"name": name, "labels": dict(labels), "value": value} for name, labels, value in snapshot["counters"]],
+            "gauges": [{"name": name, "labels": dict(labels), "value": value} for name, labels, value in snapshot["gauges"]],
+            "histograms": histograms,
+        }
+
+    def write(self, prom_file, json_file=None):
+        """Write the textfile and JSON summary, each replaced in one step so no reader sees half a file"""
+        outputs = [(prom_file, self.prometheus())]
+        if json_file is not None:
+            outputs.append((json_file, json.dumps(self.summary(), indent=4)))
+        for path, text in outputs:
+            tmp_file = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                f.write(text)
+            os.replace(tmp_file, path)
+
+
+registry = Metrics()
+span = registry.span
+count = registry.count
+gauge = registry.gauge
+observe = registry.observe
+
+
+def timed(stage):
+    """Decorator form of span, timing every call of a function"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with registry.span(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
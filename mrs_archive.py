@@ -0,0 +1,286 @@
+"""
+Archive of every MRS and $SEAALR line decoded from the comm logs, as Parquet partitioned by platform and mission, so
+questions about surfacing intervals, alarm frequency or mask history don't mean parsing the raw logs again. Each
+check appends the lines written since the last one as a part, and the parts of a comm log are merged into one file
+once a newer comm log is being archived. Needs pyarrow.
+
+python mrs_archive.py backfill
+python mrs_archive.py query --platform SEA063 --mission 34 --columns datetime cycle security_level
+python mrs_archive.py alarms --since 2024-01-01
+"""
+import os
+import json
+import fcntl
+import argparse
+import datetime
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+import pandas as pd
+from alert_utils import decode_mrs, split_lines
+from comm_log import parse_timestamp, read_checksum
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pads
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+_log = logging.getLogger(name="core_log")
+
+tables = {
+    "mrs": ["datetime", "glider", "cycle", "security_level", "alarm"],
+    "alr": ["datetime", "alarm_mask"],
+}
+
+
+def decode_alr(lines):
+    """The time and alarm mask of each $SEAALR line"""
+    records = []
+    for line in lines:
+        if "SEAALR" not in line:
+            continue
+        try:
+            timestamp = parse_timestamp(line.split(";")[0][1:-1])
+            alarm_mask = int(line.split("$SEAALR,")[1].split(",")[1].split("*")[0])
+        except (ValueError, IndexError):
+            continue
+        records.append((timestamp, alarm_mask))
+    return pd.DataFrame(records, columns=tables["alr"])
+
+
+class MrsArchive:
+    """
+    Parquet datasets of MRS and $SEAALR lines under root, in root/<table>/platform_id=<platform>/mission=<mission>.
+    The byte offset reached in each comm log is kept per platform in root/_state, so each platform can be updated
+    by a separate worker process. The parts of a platform are only written or merged with its lock held.
+    """
+
+    def __init__(self, root):
+        if pa is None:
+            raise ImportError("the MRS archive needs pyarrow")
+        self.root = Path(root)
+
+    def state_file(self, platform_id):
+        return self.root / "_state" / f"{platform_id}.json"
+
+    def load_state(self, platform_id):
+        try:
+            with open(self.state_file(platform_id)) as fin:
+                return json.load(fin)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self, platform_id, state):
+        state_file = self.state_file(platform_id)
+        state_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = state_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, "w") as fout:
+            json.dump(state, fout, indent=4)
+        os.replace(tmp_file, state_file)
+
+    @contextmanager
+    def lock(self, platform_id):
+        lock_file = self.root / "_state" / f"{platform_id}.lock"
+        lock_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(lock_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def partition(self, table, platform_id, mission):
+        return self.root / table / f"platform_id={platform_id}" / f"mission={int(mission)}"
+
+    def remove_parts(self, platform_id, file_key):
+        for part in self.root.glob(f"*/platform_id={platform_id}/mission=*/{file_key}-*.parquet"):
+            part.unlink()
+
+    def write_part(self, table, platform_id, mission, file_key, start, df):
+        """Write the lines of one comm log from byte offset start. A retry from the same offset replaces the part"""
+        partition = self.partition(table, platform_id, mission)
+        partition.mkdir(parents=True, exist_ok=True)
+        part = partition / f"{file_key}-{start:012d}.parquet"
+        # hidden from queries until it is complete
+        tmp_file = partition / f".{part.name}.{os.getpid()}.tmp"
+        pq.write_table(pa.Table.from_pandas(df[tables[table]], preserve_index=False), tmp_file)
+        os.replace(tmp_file, part)
+
+    def update(self, platform_id, comm_log_file):
+        """
+        Archive the complete lines appended to a comm log since the last update, then merge the parts of the
+        platform's earlier comm logs. Returns the number of MRS lines
+        """
+        with self.lock(platform_id):
+            n_mrs = self.append(platform_id, comm_log_file)
+            self.compact_platform(platform_id)
+        return n_mrs
+
+    def append(self, platform_id, comm_log_file):
+        comm_log_file = Path(comm_log_file)
+        file_key = comm_log_file.name.split(".com.raw.log")[0]
+        state = self.load_state(platform_id)
+        entry = state.get(str(comm_log_file), {"inode": None, "offset": 0})
+        with open(comm_log_file, "rb") as fin:
+            stat = os.fstat(fin.fileno())
+            # a file rewritten in place is caught by the bytes before the offset changing, as in CommLog. Entries
+            # archived before the checksum was kept are taken to have been appended to
+            rewritten = "checksum" in entry and read_checksum(fin, entry["offset"]) != entry["checksum"]
+            if entry["inode"] != stat.st_ino or stat.st_size < entry["offset"] or rewritten:
+                if entry["inode"] is not None:
+                    _log.info(f"{comm_log_file} replaced or rewritten. Archive from the start")
+                self.remove_parts(platform_id, file_key)
+                entry = {"inode": stat.st_ino, "offset": 0}
+            start = entry["offset"]
+            fin.seek(start)
+            chunk = fin.read(stat.st_size - start)
+            end = chunk.rfind(b"\n") + 1
+            if not end:
+                return 0
+            entry["checksum"] = read_checksum(fin, start + end)
+        lines = split_lines(chunk[:end].decode("latin1"))
+        n_mrs = 0
+        if not (start == 0 and lines and "trmId" in lines[0]):
+            df_mrs = decode_mrs(lines)
+            df_alr = decode_alr(lines)
+            # the $SEAALR lines belong to the mission of the MRS lines around them
+            mission = int(df_mrs.mission.values[-1]) if not df_mrs.empty else self.last_mission(platform_id, state)
+            for mission_number, df in df_mrs.groupby("mission") if not df_mrs.empty else []:
+                self.write_part("mrs", platform_id, mission_number, file_key, start, df)
+            if not df_alr.empty and mission is not None:
+                self.write_part("alr", platform_id, mission, file_key, start, df_alr)
+            n_mrs = len(df_mrs)
+            if mission is not None:
+                entry["mission"] = mission
+        entry["offset"] = start + end
+        entry["compacted"] = False
+        # the comm log updated last is the one being written to, and is not compacted
+        for other in state.values():
+            other.pop("current", None)
+        entry["current"] = True
+        state[str(comm_log_file)] = entry
+        self.save_state(platform_id, state)
+        return n_mrs
+
+    @staticmethod
+    def last_mission(platform_id, state):
+        missions = [entry["mission"] for entry in state.values() if entry.get("mission") is not None]
+        return max(missions) if missions else None
+
+    def query(self, table="mrs", columns=None, platforms=None, missions=None, since=None, until=None):
+        """
+        The archived lines as a DataFrame, reading only the partitions of the platforms and missions asked for and
+        only the columns asked for. platform_id and mission can be asked for as columns too.
+        """
+        path = self.root / table
+        if not path.exists():
+            return pd.DataFrame(columns=columns or tables[table] + ["platform_id", "mission"])
+        dataset = pads.dataset(
+            path,
+            format="parquet",
+            partitioning=pads.partitioning(
+                pa.schema([("platform_id", pa.string()), ("mission", pa.int64())]), flavor="hive"
+            ),
+        )
+        expression = None
+        conditions = []
+        if platforms is not None:
+            conditions.append(pads.field("platform_id").isin(list(platforms)))
+        if missions is not None:
+            conditions.append(pads.field("mission").isin([int(mission) for mission in missions]))
+        if since is not None:
+            conditions.append(pads.field("datetime") >= pa.scalar(pd.Timestamp(since), pa.timestamp("ns")))
+        if until is not None:
+            conditions.append(pads.field("datetime") < pa.scalar(pd.Timestamp(until), pa.timestamp("ns")))
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+        df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+        if "datetime" in df.columns:
+            df = df.sort_values("datetime", kind="stable").reset_index(drop=True)
+        return df
+
+    def compact_platform(self, platform_id):
+        """
+        Merge the parts of each closed comm log of a platform into one file per partition. The comm log updated last
+        is still being appended to and is left as it is. Parts from beyond the offset in the state were written by an
+        update that did not finish, and will be written again, so they are left too
+        """
+        state = self.load_state(platform_id)
+        for comm_log_file, entry in state.items():
+            if entry.get("current") or entry.get("compacted"):
+                continue
+            file_key = Path(comm_log_file).name.split(".com.raw.log")[0]
+            for table in tables:
+                for partition in sorted((self.root / table).glob(f"platform_id={platform_id}/mission=*")):
+                    parts = [
+                        part
+                        for part in sorted(partition.glob(f"{file_key}-*.parquet"))
+                        if int(part.stem.rsplit("-", 1)[1]) < entry["offset"]
+                    ]
+                    self.merge_parts(partition, parts)
+            entry["compacted"] = True
+            self.save_state(platform_id, state)
+
+    @staticmethod
+    def merge_parts(partition, parts):
+        if len(parts) < 2:
+            return
+        merged = pa.concat_tables([pq.read_table(part) for part in parts])
+        tmp_file = partition / f".{parts[0].name}.{os.getpid()}.tmp"
+        pq.write_table(merged, tmp_file)
+        os.replace(tmp_file, parts[0])
+        for part in parts[1:]:
+            part.unlink()
+
+    def compact(self):
+        """Merge the parts of the closed comm logs of every platform, as update does for the platform it updates"""
+        for state_file in sorted((self.root / "_state").glob("*.json")):
+            with self.lock(state_file.stem):
+                self.compact_platform(state_file.stem)
+
+
+def alarm_frequency(archive, since=None):
+    """Number of MRS lines and alarms per platform, mission and security level"""
+    df = archive.query(columns=["platform_id", "mission", "security_level", "alarm"], since=since)
+    return (
+        df.groupby(["platform_id", "mission", "security_level"])
+        .agg(lines=("alarm", "size"), alarms=("alarm", "sum"))
+        .reset_index()
+    )
+
+
+if __name__ == "__main__":
+    from alert_utils import context
+    from alert_dispatch import glider_platforms
+
+    parser = argparse.ArgumentParser(description="archive and query the decoded MRS lines")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("backfill", help="archive every comm log of every platform, as far as not yet archived")
+    subparsers.add_parser("compact", help="merge the parts of the closed comm logs, as each update does")
+    parser_query = subparsers.add_parser("query", help="print archived lines")
+    parser_query.add_argument("--table", choices=list(tables), default="mrs")
+    parser_query.add_argument("--platform", nargs="*")
+    parser_query.add_argument("--mission", type=int, nargs="*")
+    parser_query.add_argument("--columns", nargs="*")
+    parser_query.add_argument("--since", type=datetime.datetime.fromisoformat)
+    parser_alarms = subparsers.add_parser("alarms", help="alarm frequency per platform, mission and security level")
+    parser_alarms.add_argument("--since", type=datetime.datetime.fromisoformat)
+    args = parser.parse_args()
+    archive = context.mrs_archive
+    if archive is None:
+        raise SystemExit("no mrs_archive_dir in alarm_secrets.json, or pyarrow is not installed")
+    if args.command == "backfill":
+        base_dir = Path(context.secrets_dict["base_data_dir"])
+        for platform in glider_platforms():
+            for comm_log_file in sorted((base_dir / platform).glob("0*/G-Logs/*com.raw.log")):
+                print(f"{comm_log_file}: {archive.update(platform, comm_log_file)} MRS lines")
+    elif args.command == "compact":
+        archive.compact()
+    elif args.command == "query":
+        print(
+            archive.query(args.table, args.columns, args.platform, args.mission, since=args.since).to_string(index=False)
+        )
+    elif args.command == "alarms":
+        print(alarm_frequency(archive, since=args.since).to_string(index=False))
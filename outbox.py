@@ -0,0 +1,319 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+_log = logging.getLogger(name="core_log")
+
+# the fields of an alarm dict that are needed to send and record a text or call
+alarm_fields = ["platform_id", "glider", "mission", "cycle", "security_level", "alarm_source"]
+# when the alarm happened and when it was dispatched, if known, carried through to the recorded actions
+time_fields = ["event_time", "dispatch_time"]
+
+
+def outbox_key(ddict, recipient, user, channel):
+    """
+    Idempotency key: the same alarm is only ever sent once on each channel to each recipient in each role. The role
+    is part of the key, so escalating to a supervisor who is also the pilot on duty still calls them
+    """
+    return ":".join(
+        str(part)
+        for part in [
+            ddict["platform_id"],
+            int(ddict["mission"]),
+            int(ddict["cycle"]),
+            int(ddict["security_level"]),
+            ddict["alarm_source"],
+            recipient,
+            user,
+            channel,
+        ]
+    )
+
+
+class Outbox:
+    """
+    Texts and calls waiting to be sent, in an SQLite database so none are lost if a process dies. Entries are
+    claimed by a sender with a lease, so a sender that dies part way leaves them to be sent by another.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.RLock()
+        self.pid = None
+        self._connection = None
+
+    @property
+    def connection(self):
+        # sqlite connections can't be shared with forked worker processes
+        if self.pid != os.getpid():
+            self._connection = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self.create_tables(self._connection)
+            self.pid = os.getpid()
+        return self._connection
+
+    @staticmethod
+    def create_tables(connection):
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "key TEXT PRIMARY KEY, channel TEXT, recipient TEXT, user TEXT, alarm TEXT, fake INTEGER, "
+                "state TEXT, attempts INTEGER, created REAL, next_attempt REAL, lease_until REAL, claim TEXT, "
+                "sent_at REAL, send_seconds REAL, last_error TEXT)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, next_attempt)")
+            connection.execute("CREATE INDEX IF NOT EXISTS outbox_sent ON outbox (sent_at)")
+
+    def execute(self, sql, parameters=()):
+        with self.lock:
+            with self.connection as connection:
+                return connection.execute(sql, parameters).fetchall()
+
+    def enqueue(self, ddict, recipient, user, channel, fake=True):
+        """Add a text or call to the outbox. Returns False if it was already there"""
+        alarm = {field: ddict[field] for field in alarm_fields}
+        for field in ["mission", "cycle", "security_level"]:
+            alarm[field] = int(alarm[field])
+        alarm["glider"] = str(alarm["glider"])
+        for field in time_fields:
+            if ddict.get(field) is not None:
+                alarm[field] = ddict[field].isoformat()
+        now = time.time()
+        with self.lock:
+            with self.connection as connection:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO outbox VALUES (?, ?, ?, ?, ?, ?, 'pending', 0, ?, ?, NULL, NULL, NULL, "
+                    "NULL, NULL)",
+                    (outbox_key(ddict, recipient, user, channel), channel, recipient, user, json.dumps(alarm), int(fake), now, now),
+                )
+                return cursor.rowcount == 1
+
+    def claim(self, limit, lease=120):
+        """Take up to limit entries that are due, or whose sender's lease has run out"""
+        now = time.time()
+        claim = uuid.uuid4().hex
+        rows = []
+        with self.lock:
+            with self.connection as connection:
+                connection.execute(
+                    "UPDATE outbox SET state = 'sending', lease_until = ?, claim = ? WHERE key IN ("
+                    "SELECT key FROM outbox WHERE (state = 'pending' AND next_attempt <= ?) "
+                    "OR (state = 'sending' AND lease_until <= ?) ORDER BY next_attempt LIMIT ?)",
+                    (now + lease, claim, now, now, limit),
+                )
+                rows = connection.execute(
+                    "SELECT key, channel, recipient, user, alarm, fake, attempts, created FROM outbox WHERE claim = ?",
+                    (claim,),
+                ).fetchall()
+        entries = []
+        for key, channel, recipient, user, alarm, fake, attempts, created in rows:
+            entries.append(
+                {
+                    "key": key,
+                    "channel": channel,
+                    "recipient": recipient,
+                    "user": user,
+                    "alarm": json.loads(alarm),
+                    "fake": bool(fake),
+                    "attempts": attempts,
+                    "created": created,
+                }
+            )
+        return entries
+
+    def mark_sent(self, key, send_seconds):
+        self.execute(
+            "UPDATE outbox SET state = 'sent', attempts = attempts + 1, sent_at = ?, send_seconds = ?, claim = NULL "
+            "WHERE key = ?",
+            (time.time(), send_seconds, key),
+        )
+
+    def mark_failed(self, key, error, next_attempt=None):
+        """Record a failed attempt. The entry is retried at next_attempt, or given up on if that is None"""
+        state = "failed" if next_attempt is None else "pending"
+        self.execute(
+            "UPDATE outbox SET state = ?, attempts = attempts + 1, next_attempt = ?, last_error = ?, claim = NULL "
+            "WHERE key = ?",
+            (state, next_attempt, error, key),
+        )
+
+    def next_due(self):
+        """Seconds until the next pending entry is due, 0 if one is due now, None if there are none"""
+        rows = self.execute(
+            "SELECT MIN(CASE state WHEN 'sending' THEN lease_until ELSE next_attempt END) FROM outbox "
+            "WHERE state = 'pending' OR state = 'sending'"
+        )
+        if not rows or rows[0][0] is None:
+            return None
+        return max(0.0, rows[0][0] - time.time())
+
+    def stats(self, since=3600):
+        """Queue depth and the latency from enqueue to sent of the entries sent in the last since seconds"""
+        counts = dict(self.execute("SELECT state, COUNT(*) FROM outbox WHERE state != 'sent' GROUP BY state"))
+        oldest = self.execute("SELECT MIN(created) FROM outbox WHERE state = 'pending' OR state = 'sending'")[0][0]
+        latencies = sorted(
+            row[0]
+            for row in self.execute(
+                "SELECT sent_at - created FROM outbox WHERE state = 'sent' AND sent_at >= ?", (time.time() - since,)
+            )
+        )
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+        return {
+            "depth": counts.get("pending", 0) + counts.get("sending", 0),
+            "failed": counts.get("failed", 0),
+            "oldest_pending_seconds": None if oldest is None else time.time() - oldest,
+            "sent": len(latencies),
+            "latency_p50_seconds": percentile(0.5),
+            "latency_p95_seconds": percentile(0.95),
+            "latency_max_seconds": latencies[-1] if latencies else None,
+        }
+
+
+class OutboxSender:
+    """
+    Sends the entries of an Outbox with a pool of threads. channels maps each channel to the function that sends
+    it, called as func(alarm, recipient=, user=, fake=) and returning True on success. A failed send is retried
+    with exponential backoff. After max_attempts it is handed to on_give_up, once, and then retried every max_delay
+    seconds for as long as still_active(entry) says its alarm is active.
+    """
+
+    def __init__(
+        self,
+        outbox,
+        channels,
+        workers=8,
+        max_attempts=8,
+        base_delay=5,
+        max_delay=900,
+        lease=120,
+        on_give_up=None,
+        still_active=None,
+        stats_file=None,
+    ):
+        self.outbox = outbox
+        self.channels = channels
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self.on_give_up = on_give_up
+        self.still_active = still_active
+        # queue depth and send latency are written here after each drain, for monitoring
+        self.stats_file = stats_file
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def backoff(self, attempts):
+        return min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+
+    def active(self, entry):
+        """Whether the alarm of an entry is still active. When that can't be told, it is taken to be"""
+        if self.still_active is None:
+            return True
+        try:
+            return self.still_active(entry)
+        except Exception as e:
+            _log.error(f"could not tell if the alarm of {entry['key']} is still active: {e}")
+            return True
+
+    def send(self, entry):
+        start = time.perf_counter()
+        error = None
+        try:
+            success = self.channels[entry["channel"]](
+                entry["alarm"], recipient=entry["recipient"], user=entry["user"], fake=entry["fake"]
+            )
+        except Exception as e:
+            success = False
+            error = str(e)
+        send_seconds = time.perf_counter() - start
+        metrics.observe("alerts_send_seconds", send_seconds, channel=entry["channel"])
+        metrics.count("alerts_send_total", channel=entry["channel"], success=success)
+        if success:
+            self.outbox.mark_sent(entry["key"], send_seconds)
+            latency = time.time() - entry["created"]
+            metrics.observe("alerts_outbox_latency_seconds", latency, channel=entry["channel"])
+            _log.info(f"{entry['channel']} {entry['user']} {entry['recipient']} sent {latency:.2f} s after enqueue")
+            return True
+        error = error or f"{entry['channel']} not accepted"
+        attempts = entry["attempts"] + 1
+        if attempts == self.max_attempts:
+            _log.error(f"failed to send {entry['key']} after {attempts} attempts: {error}")
+            if self.on_give_up:
+                self.on_give_up(entry, error)
+        if attempts >= self.max_attempts and not self.active(entry):
+            self.outbox.mark_failed(entry["key"], error)
+            _log.warning(f"gave up on {entry['key']} after {attempts} attempts, its alarm is over: {error}")
+        else:
+            delay = self.backoff(attempts)
+            self.outbox.mark_failed(entry["key"], error, next_attempt=time.time() + delay)
+            _log.warning(f"failed to send {entry['key']}: {error}. Retry in {delay} s")
+        return False
+
+    def send_due(self):
+        """Send every entry that is due. Returns the number claimed"""
+        entries = self.outbox.claim(self.workers, lease=self.lease)
+        if not entries:
+            return 0
+        claimed = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while entries:
+                claimed += len(entries)
+                list(executor.map(self.send, entries))
+                entries = self.outbox.claim(self.workers, lease=self.lease)
+        return claimed
+
+    def drain(self, timeout=60):
+        """Send until nothing is due within timeout seconds. Entries backing off past that stay for the next run"""
+        deadline = time.monotonic() + timeout
+        while True:
+            self.send_due()
+            next_due = self.outbox.next_due()
+            if next_due is None or time.monotonic() + next_due >= deadline:
+                break
+            time.sleep(min(next_due, 1))
+        stats = self.outbox.stats()
+        _log.info(f"outbox: {stats}")
+        for name, value in stats.items():
+            if value is not None:
+                metrics.gauge(f"alerts_outbox_{name}", value)
+        if self.stats_file is not None:
+            tmp_file = self.stats_file.with_suffix(".tmp")
+            with open(tmp_file, "w") as f:
+                json.dump(stats, f, indent=4)
+            os.replace(tmp_file, self.stats_file)
+        return stats
+
+    def run(self, stop=None, interval=0.2, drain_timeout=60):
+        """Send entries as they are enqueued, until stop is set. Then drain what is left"""
+        stop = stop or self.stopping
+        while not stop.is_set():
+            if not self.send_due():
+                stop.wait(interval)
+        self.drain(drain_timeout)
+
+    def start(self, interval=0.2):
+        """Run the sender in a background thread of this process"""
+        if self.thread is None or not self.thread.is_alive():
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, kwargs={"interval": interval}, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self, timeout=60):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
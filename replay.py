@@ -0,0 +1,362 @@
+"""
+Replay archived comm logs, alarm emails and sailbuoy files through the decision logic of Dispatcher and
+sailbuoy_alert, on a simulated clock, with the texts and calls recorded in an in-memory alarm store instead of sent.
+This shows what a change to the surface limit, the staleness cutoff or the escalation delay would have done over
+whole past missions. Sweeps over the parameters run in parallel worker processes.
+
+python replay.py /data/base/SEA063/000034 --mail alarms.mbox
+python replay.py /data/base /data/sailbuoy/nrt_proc --surface-limit 30 45 60 --escalation-delay 15 30 --workers 8
+
+The checks are only run when they could decide something new: at the first run after each MRS line, alarm email or
+flagged sailbuoy sample arrives, and at the first run after each escalation deadline. Between those, a check finds
+the same state as the one before and does nothing.
+"""
+import json
+import bisect
+import heapq
+import logging
+import argparse
+import datetime
+import functools
+import itertools
+import mailbox
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import xarray as xr
+from alarm_store import AlarmStore
+from alert_utils import decode_mrs, split_lines, last_alarm_mask, mask_alarms, alarm_email, mail_date, sailbuoy_alert
+from alert_dispatch import Dispatcher
+from comm_log import parse_timestamp
+
+_log = logging.getLogger(name="core_log")
+
+sailbuoy_variables = ["Leak", "BigLeak", "SailRotation", "Warning"]
+
+
+class ReplayClock:
+    """A clock that only moves when it is set"""
+
+    def __init__(self, now=None):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def next_runs(times, interval):
+    """The time of the first run of the checks at or after each of times, with the checks run every interval"""
+    return pd.DatetimeIndex(times).ceil(pd.Timedelta(interval)).to_pydatetime()
+
+
+class CommLogHistory:
+    """
+    The MRS lines of the comm logs of a mission, and the $SEAALR alarm masks sent during it, to read back as they
+    stood at any time
+    """
+
+    def __init__(self, comm_log_files):
+        lines = []
+        for comm_log_file in comm_log_files:
+            with open(comm_log_file, encoding="latin1", newline="") as fin:
+                file_lines = split_lines(fin.read())
+            if file_lines and "trmId" in file_lines[0]:
+                continue
+            lines += file_lines
+        df = decode_mrs(lines)
+        if not df.empty:
+            df = df.sort_values("datetime", kind="stable").reset_index(drop=True)
+        self.df = df
+        self.times = df.datetime.values if not df.empty else np.array([], dtype="datetime64[ns]")
+        cycles = df.cycle.values if not df.empty else np.array([], dtype=int)
+        # position of the first line of the run of lines from the same cycle as each line
+        changes = np.r_[True, cycles[1:] != cycles[:-1]] if len(cycles) else np.array([], dtype=bool)
+        self.cycle_start = np.maximum.accumulate(np.where(changes, np.arange(len(cycles)), 0))
+        self.mask_times = []
+        self.masks = []
+        for line in lines:
+            if "SEAALR" in line:
+                try:
+                    self.mask_times.append(parse_timestamp(line.split(";")[0][1:-1]))
+                    self.masks.append(last_alarm_mask([line]))
+                except (ValueError, IndexError):
+                    continue
+
+    def __len__(self):
+        return len(self.df)
+
+    def as_of(self, when, window):
+        """
+        The MRS lines a CommLog with this window would have returned at when: those in the window, plus the whole of
+        the latest cycle, with the alarm mask in force applied
+        """
+        end = np.searchsorted(self.times, np.datetime64(when), side="right")
+        if end == 0:
+            return pd.DataFrame()
+        start = min(np.searchsorted(self.times, np.datetime64(when - window)), self.cycle_start[end - 1])
+        i = bisect.bisect_right(self.mask_times, when)
+        return mask_alarms(self.df.iloc[start:end].copy(), self.masks[i - 1] if i else None)
+
+
+def read_mail(paths):
+    """The alseamar alarm emails in mbox files, as (date, glider, mission, cycle, alarm), oldest first"""
+    events = []
+    for path in paths:
+        for msg in mailbox.mbox(path):
+            fields = alarm_email(msg)
+            sent = mail_date(msg)
+            if fields is not None and sent is not None:
+                events.append((sent, *fields))
+    return sorted(events)
+
+
+def mail_history(events, platform_id, mission=None):
+    """
+    The record parse_mail_alarms would have kept for the glider after each of its alarm emails, as (date, record).
+    A repeat of the same alarm keeps the date of the first email.
+    """
+    history = []
+    for sent, glider, email_mission, cycle, alarm in events:
+        if glider != platform_id or (mission is not None and email_mission != mission):
+            continue
+        if history and history[-1][1][:3] == [email_mission, cycle, alarm]:
+            continue
+        history.append((sent, [email_mission, cycle, alarm, sent.isoformat()]))
+    return history
+
+
+class ReplayDispatcher(Dispatcher):
+    """
+    A Dispatcher that reads the comm log and alarm emails as they stood at the time of the simulated clock, and
+    records the texts and calls it would have made in its store, rather than queueing them
+    """
+
+    def __init__(self, platform_id, store, clock, history=None, mail=(), **limits):
+        super().__init__(platform_id, store=store, clock=clock, utc_clock=clock)
+        self.history = history
+        self.mail_dates = [sent for sent, record in mail]
+        self.mail_records = [record for sent, record in mail]
+        # stale_limit, surface_limit and escalation_delay to try
+        for name, value in limits.items():
+            setattr(self, name, value)
+        self.actions = []
+
+    def load_comm_log(self):
+        if self.history is None:
+            self.df_mrs = pd.DataFrame()
+        else:
+            self.df_mrs = self.history.as_of(self.clock(), self.stale_limit)
+
+    def mail_alerts(self):
+        i = bisect.bisect_right(self.mail_dates, self.clock())
+        return {self.platform_id: self.mail_records[i - 1]} if i else {}
+
+    def notify(self, ddict, user):
+        now = self.clock()
+        ddict.setdefault("dispatch_time", now)
+        for channel in ["text", "call"]:
+            self.store.add_action(ddict, f"{channel}_{user}", when=now, sent_time=now)
+        self.actions.append(
+            {
+                "datetime": now.isoformat(),
+                "user": user,
+                "mission": int(ddict["mission"]),
+                "cycle": int(ddict["cycle"]),
+                "security_level": int(ddict["security_level"]),
+                "alarm_source": ddict["alarm_source"],
+            }
+        )
+
+    def contact_pilot(self, ddict):
+        self.notify(ddict, "pilot")
+
+    def contact_supervisor(self, ddict):
+        self.notify(ddict, "supervisor")
+
+    def check(self):
+        """One run of the checks, as Dispatcher.execute does them"""
+        self.alarm_dict = {}
+        self.alarm_source = None
+        self.escalation_due = None
+        self.load_comm_log()
+        if self.check_comm_log():
+            self.trigger_alarm()
+        if self.mail_alarm():
+            self.trigger_alarm()
+
+    def escalate_due(self, until, on_time=True):
+        """Contact the supervisor for the escalations due by until, at their deadline or at until"""
+        for ddict in self.store.pending_escalations():
+            if ddict["due"] > until:
+                break
+            self.clock.now = ddict["due"] if on_time else until
+            self.escalate(ddict)
+
+
+def summarise(target, dispatcher, parameters, runs, start):
+    actions = dispatcher.actions
+    return {
+        "target": str(target),
+        "platform_id": dispatcher.platform_id,
+        **{
+            name: value.total_seconds() / 60 if isinstance(value, datetime.timedelta) else value
+            for name, value in parameters.items()
+        },
+        "runs": runs,
+        "alarms": len({(action["mission"], action["cycle"], action["security_level"]) for action in actions}),
+        "pilot_contacts": sum(action["user"] == "pilot" for action in actions),
+        "supervisor_contacts": sum(action["user"] == "supervisor" for action in actions),
+        "seconds": time.perf_counter() - start,
+        "actions": actions,
+    }
+
+
+@functools.lru_cache(maxsize=4)
+def load_history(mission_dir):
+    return CommLogHistory(sorted(Path(mission_dir).glob("G-Logs/*com.raw.log")))
+
+
+def replay_mission(mission_dir, mail_events=(), interval=datetime.timedelta(minutes=5), escalate_on_time=True, **limits):
+    """
+    Replay the comm logs of a mission directory and the alarm emails, with the checks run every interval. The
+    escalation scheduler contacts supervisors at their deadline if escalate_on_time, else at the next run.
+    """
+    start = time.perf_counter()
+    mission_dir = Path(mission_dir)
+    platform_id = mission_dir.parent.name
+    history = load_history(mission_dir)
+    mail = mail_history(mail_events, platform_id, int(mission_dir.name))
+    clock = ReplayClock()
+    dispatcher = ReplayDispatcher(platform_id, AlarmStore(":memory:"), clock, history, mail, **limits)
+    runs = sorted(set(next_runs(history.times, interval)) | set(next_runs([sent for sent, record in mail], interval)))
+    last_run = None
+    n_runs = 0
+    while runs:
+        run = heapq.heappop(runs)
+        if run == last_run:
+            continue
+        last_run = run
+        n_runs += 1
+        dispatcher.escalate_due(run, on_time=escalate_on_time)
+        clock.now = run
+        dispatcher.check()
+        if dispatcher.escalation_due is not None:
+            heapq.heappush(runs, next_runs([dispatcher.escalation_due], interval)[0])
+    # deadlines that pass after the last of the input
+    dispatcher.escalate_due(datetime.datetime.max)
+    parameters = {"interval": interval, "escalate_on_time": escalate_on_time, **limits}
+    return summarise(mission_dir, dispatcher, parameters, n_runs, start)
+
+
+def replay_sailbuoy(nc, interval=datetime.timedelta(minutes=5), t_step=15, **limits):
+    """Replay a sailbuoy file through sailbuoy_alert, with the checks run every interval. Its times are UTC"""
+    start = time.perf_counter()
+    with xr.open_dataset(nc) as ds:
+        ds = ds.load()
+    times = ds.time.values
+    clock = ReplayClock()
+    dispatcher = ReplayDispatcher(str(ds.attrs["platform_serial"]), AlarmStore(":memory:"), clock, **limits)
+    # a check can only act while a flagged sample is among the last t_step
+    flagged = np.zeros(len(times), dtype=bool)
+    for var in sailbuoy_variables:
+        if var in ds:
+            flagged |= ds[var].fillna(0).values != 0
+    active = np.convolve(flagged, np.ones(t_step), mode="full")[: len(times)] > 0
+    runs = sorted(set(next_runs(times[active], interval)))
+    for run in runs:
+        end = np.searchsorted(times, np.datetime64(run), side="right")
+        # the first sample, for the time since deployment, and the tail the checks look at
+        samples = [0] + list(range(max(1, end - t_step), end))
+        clock.now = run
+        sailbuoy_alert(ds.isel(time=samples), dispatcher, t_step=t_step)
+    parameters = {"interval": interval, **limits}
+    return summarise(nc, dispatcher, parameters, len(runs), start)
+
+
+def replay(target, mail_events=(), **parameters):
+    if Path(target).suffix == ".nc":
+        parameters.pop("escalate_on_time", None)
+        return replay_sailbuoy(target, **parameters)
+    return replay_mission(target, mail_events, **parameters)
+
+
+def replay_targets(paths):
+    """
+    The mission directories and sailbuoy files to replay under each path, which may be a mission directory, a
+    platform directory, a base data directory, a sailbuoy file or a directory of them
+    """
+    targets = []
+    for path in map(Path, paths):
+        if path.suffix == ".nc":
+            targets.append(path)
+        elif (path / "G-Logs").is_dir():
+            targets.append(path)
+        else:
+            targets += sorted(path.glob("0*/G-Logs/.."))
+            targets += sorted(path.glob("*/0*/G-Logs/.."))
+            targets += sorted(path.glob("*.nc"))
+    return [target.resolve() for target in targets]
+
+
+def parameter_grid(**values):
+    """Every combination of the values given for each parameter"""
+    names = list(values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*values.values())]
+
+
+def replay_job(job):
+    target, mail_events, parameters = job
+    try:
+        return replay(target, mail_events, **parameters)
+    except Exception as e:
+        return {"target": str(target), "error": str(e)}
+
+
+def sweep(targets, grid, mail_events=(), workers=4):
+    """Replay each target with each set of parameters in grid, in a pool of worker processes"""
+    jobs = [(target, mail_events, parameters) for target in targets for parameters in grid]
+    if workers <= 1:
+        return [replay_job(job) for job in jobs]
+    # the jobs of a target are handed to one worker together, so it parses the comm logs once
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        return list(executor.map(replay_job, jobs, chunksize=len(grid)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay past missions through the alarm decisions")
+    parser.add_argument("paths", nargs="+", help="mission, platform or base data directories, or sailbuoy files")
+    parser.add_argument("--mail", nargs="*", default=[], help="mbox files of alarm emails")
+    parser.add_argument("--surface-limit", type=float, nargs="+", default=[45], help="minutes")
+    parser.add_argument("--stale-limit", type=float, nargs="+", default=[6], help="hours")
+    parser.add_argument("--escalation-delay", type=float, nargs="+", default=[30], help="minutes")
+    parser.add_argument("--interval", type=float, nargs="+", default=[5], help="minutes between runs of the checks")
+    parser.add_argument(
+        "--cron", action="store_true", help="escalate at the next run of the checks rather than on the deadline"
+    )
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--output", help="write the results, with every text and call, to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="log the decisions")
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+    else:
+        _log.addHandler(logging.NullHandler())
+        _log.propagate = False
+    grid = parameter_grid(
+        surface_limit=[datetime.timedelta(minutes=minutes) for minutes in args.surface_limit],
+        stale_limit=[datetime.timedelta(hours=hours) for hours in args.stale_limit],
+        escalation_delay=[datetime.timedelta(minutes=minutes) for minutes in args.escalation_delay],
+        interval=[datetime.timedelta(minutes=minutes) for minutes in args.interval],
+        escalate_on_time=[not args.cron],
+    )
+    start = time.perf_counter()
+    results = sweep(replay_targets(args.paths), grid, read_mail(args.mail), workers=args.workers)
+    table = pd.DataFrame([{key: value for key, value in result.items() if key != "actions"} for result in results])
+    print(table.to_string(index=False))
+    print(f"{len(results)} replays in {time.perf_counter() - start:.1f} seconds")
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump(results, fout, indent=4, default=str)
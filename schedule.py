@@ -1,5 +1,5 @@
 import pandas as pd
-from alert_utils import mailer, mail_recipient, parse_schedule, contacts
+from alert_utils import mailer, parse_schedule, resolve_names, context, schedule_csv
 
 if __name__ == "__main__":
     try:
@@ -8,13 +8,10 @@ if __name__ == "__main__":
         mailer(
             "schedule",
             "parsing the schedule failed! Using the last good one",
-            recipient=mail_recipient,
+            recipient=context.mail_recipient,
         )
-    schedule = pd.read_csv(
-        "/data/log/schedule.csv", parse_dates=True, index_col=0, sep=";", dtype=str
-    )
-    for name, number in contacts.items():
-        schedule.replace(name, number, inplace=True)
+    schedule = pd.read_csv(schedule_csv, parse_dates=True, index_col=0, sep=";", dtype=str)
+    schedule = resolve_names(schedule, context.contacts)
     schedule_pilot_numbers = set("".join(schedule.pilot.unique()))
     valid_chars = {'+', '0', '1', '2', '3', '4', '5', '6', '7', '8', '9'}
     if not schedule_pilot_numbers.issubset(valid_chars):
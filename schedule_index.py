@@ -0,0 +1,70 @@
+import os
+import json
+import bisect
+import datetime
+
+
+def clean_number(value):
+    """A phone number, or comma separated numbers, without spaces. None for empty cells"""
+    if not isinstance(value, str) or not value.strip():
+        return None
+    return value.replace(" ", "")
+
+
+class ScheduleIndex:
+    """
+    The on-call schedule compiled for lookups: shift start times in order, with the pilot and supervisor numbers of
+    each shift. Who is on duty at a time is found by binary search instead of scanning the schedule table.
+    """
+
+    def __init__(self, starts, pilots, supervisors):
+        self.starts = starts
+        self.pilots = pilots
+        self.supervisors = supervisors
+
+    @classmethod
+    def from_schedule(cls, schedule):
+        """Compile a shift table, indexed by shift start, whose names have already been replaced by numbers"""
+        schedule = schedule.sort_index(kind="stable")
+        starts = [timestamp.to_pydatetime() for timestamp in schedule.index]
+        pilots = [clean_number(value) for value in schedule["pilot"]]
+        supervisors = [clean_number(value) for value in schedule["supervisor"]]
+        return cls(starts, pilots, supervisors)
+
+    @classmethod
+    def load(cls, index_file):
+        with open(index_file, "r") as f:
+            compiled = json.load(f)
+        starts = [datetime.datetime.fromisoformat(start) for start in compiled["starts"]]
+        return cls(starts, compiled["pilots"], compiled["supervisors"])
+
+    def save(self, index_file):
+        tmp_file = index_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(
+                {
+                    "starts": [start.isoformat() for start in self.starts],
+                    "pilots": self.pilots,
+                    "supervisors": self.supervisors,
+                },
+                f,
+            )
+        os.replace(tmp_file, index_file)
+
+    def shift(self, when):
+        """Position of the shift running at when: the last one that started strictly before it. -1 if none has"""
+        return bisect.bisect_left(self.starts, when) - 1
+
+    def on_duty(self, when=None):
+        """(pilot, supervisor) numbers on duty at when, now by default"""
+        position = self.shift(when or datetime.datetime.now())
+        if position < 0:
+            raise LookupError(f"no shift in the schedule starts before {when}")
+        return self.pilots[position], self.supervisors[position]
+
+    def next_handover(self, when=None):
+        """Start of the first shift after when, or None if the schedule runs out"""
+        position = bisect.bisect_left(self.starts, when or datetime.datetime.now())
+        if position == len(self.starts):
+            return None
+        return self.starts[position]
@@ -0,0 +1,244 @@
+"""
+Local stand-ins for the external services the alerts system talks to, for trying it out and benchmarking without
+the real accounts. Point the system at them through the secrets files, e.g. for the IMAP server in email_secrets.json
+
+"imap_host": "127.0.0.1", "imap_port": 1143, "imap_ssl": false
+
+and for 46elks in alarm_secrets.json
+
+"elks_api": "http://127.0.0.1:8046/a1", "elks_whenhangup": "http://127.0.0.1:8080/whenhangup?token=<callback_token>",
+"callback_token": "<callback_token>"
+"""
+import re
+import json
+import datetime
+import threading
+import email
+import email.utils
+import socketserver
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+
+
+class ImapHandler(socketserver.StreamRequestHandler):
+    """Handles one client connection to FakeImapServer"""
+
+    def send(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        self.send("* OK [CAPABILITY IMAP4rev1 IDLE] stand-in ready")
+        for raw_line in self.rfile:
+            tag, command, *args = raw_line.decode().rstrip("\r\n").split(" ", 2)
+            command = command.upper()
+            args = args[0] if args else ""
+            if command == "CAPABILITY":
+                self.send("* CAPABILITY IMAP4rev1 IDLE")
+            elif command == "SELECT":
+                with server.lock:
+                    self.send(f"* {len(server.messages)} EXISTS")
+                self.send(f"* OK [UIDVALIDITY {server.uidvalidity}] UIDs valid")
+            elif command == "UID":
+                self.uid_command(args)
+            elif command == "IDLE":
+                self.idle()
+            elif command == "LOGOUT":
+                self.send("* BYE stand-in logging out")
+                self.send(f"{tag} OK LOGOUT completed")
+                return
+            elif command not in ("LOGIN", "NOOP", "CLOSE"):
+                self.send(f"{tag} BAD unknown command {command}")
+                continue
+            self.send(f"{tag} OK {command} completed")
+
+    def uid_command(self, args):
+        command, args = args.split(" ", 1)
+        server = self.server
+        with server.lock:
+            messages = list(server.messages)
+        if command.upper() == "SEARCH":
+            match = re.search(r"UID (\d+):\*", args)
+            uids = [uid for uid, __ in messages]
+            if match:
+                # as on a real server, n:* always includes the newest message
+                uids = [uid for uid in uids if uid >= int(match[1])] or uids[-1:]
+            match = re.search(r'SUBJECT "([^"]*)"', args)
+            if match:
+                subjects = {uid: email.message_from_bytes(headers)["subject"] or "" for uid, headers in messages}
+                uids = [uid for uid in uids if match[1].lower() in subjects[uid].lower()]
+            self.send("* SEARCH " + " ".join(str(uid) for uid in uids))
+        elif command.upper() == "FETCH":
+            wanted = {int(uid) for uid in args.split(" ", 1)[0].split(",")}
+            for number, (uid, headers) in enumerate(messages, start=1):
+                if uid not in wanted:
+                    continue
+                self.wfile.write(
+                    f"* {number} FETCH (UID {uid} BODY[HEADER.FIELDS (SUBJECT FROM DATE)] {{{len(headers)}}}\r\n".encode()
+                    + headers
+                    + b")\r\n"
+                )
+
+    def idle(self):
+        server = self.server
+        with server.lock:
+            server.idlers.add(self)
+        self.send("+ idling")
+        try:
+            for raw_line in self.rfile:
+                if raw_line.strip().upper() == b"DONE":
+                    return
+        finally:
+            with server.lock:
+                server.idlers.discard(self)
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """
+    A minimal plain text IMAP server holding a single inbox. It understands just the commands used by MailSync,
+    including IDLE. Messages added with add_message are pushed to idling clients straight away.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("127.0.0.1", 0), uidvalidity=1):
+        super().__init__(address, ImapHandler)
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.idlers = set()
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def add_message(self, subject, sender="administrateur@alseamar-cloud.com", date=None):
+        date = date or email.utils.formatdate(localtime=True)
+        headers = f"Subject: {subject}\r\nFrom: {sender}\r\nDate: {date}\r\n\r\n".encode()
+        with self.lock:
+            uid = self.messages[-1][0] + 1 if self.messages else 1
+            self.messages.append((uid, headers))
+            for idler in self.idlers:
+                idler.send(f"* {len(self.messages)} EXISTS")
+        return uid
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class ElksHandler(BaseHTTPRequestHandler):
+    """Handles one request to FakeElks"""
+
+    def reply(self, body, status=200):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        fields = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        path = urlparse(self.path).path
+        self.server.record(path, fields)
+        if path.endswith("/sms"):
+            self.reply(self.server.new_record("sms", fields))
+        elif path.endswith("/calls"):
+            self.reply(self.server.start_call(fields))
+        else:
+            self.reply({"error": f"no such endpoint {path}"}, status=404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        match = re.search(r"/calls/([^/]+)$", url.path)
+        if match:
+            call = self.server.find_call(match.group(1))
+            self.reply(call or {"error": "no such call"}, status=200 if call else 404)
+            return
+        if not url.path.endswith("/calls"):
+            self.reply({"error": f"no such endpoint {url.path}"}, status=404)
+            return
+        end = parse_qs(url.query).get("end", [None])[0]
+        self.reply(self.server.call_page(end))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeElks(ThreadingHTTPServer):
+    """
+    A stand-in for the 46elks API: texts, calls and the paged call history. Calls to numbers in failing end in
+    state failed, the rest in success, hangup_delay seconds after they are made. If the call was made with a
+    whenhangup URL, the outcome is posted to it as 46elks would.
+    """
+
+    daemon_threads = True
+    page_size = 100
+
+    def __init__(self, address=("127.0.0.1", 0), failing=(), hangup_delay=0.1):
+        super().__init__(address, ElksHandler)
+        self.failing = set(failing)
+        self.hangup_delay = hangup_delay
+        self.requests = []
+        self.calls = []
+        self.lock = threading.Lock()
+        self.count = 0
+
+    @property
+    def api(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/a1"
+
+    def record(self, path, fields):
+        with self.lock:
+            self.requests.append((path, fields))
+
+    def new_record(self, kind, fields):
+        with self.lock:
+            self.count += 1
+            created = datetime.datetime.now() + datetime.timedelta(microseconds=self.count)
+            return {
+                "id": f"{kind[0]}{self.count:08d}",
+                "direction": "outgoing",
+                "from": fields.get("from"),
+                "to": fields.get("to"),
+                "created": created.isoformat(),
+                "state": "ongoing" if kind == "call" else "sent",
+            }
+
+    def start_call(self, fields):
+        call = self.new_record("call", fields)
+        with self.lock:
+            self.calls.append(call)
+        timer = threading.Timer(self.hangup_delay, self.hang_up, (call, fields.get("whenhangup")))
+        timer.daemon = True
+        timer.start()
+        return call
+
+    def hang_up(self, call, whenhangup):
+        with self.lock:
+            call["state"] = "failed" if call["to"] in self.failing else "success"
+        if whenhangup:
+            requests.post(whenhangup, data=call, timeout=10)
+
+    def find_call(self, call_id):
+        with self.lock:
+            return next((dict(call) for call in self.calls if call["id"] == call_id), None)
+
+    def call_page(self, end=None):
+        """The newest calls created before end, and the value of end for the next page if there are more"""
+        with self.lock:
+            calls = sorted(self.calls, key=lambda call: call["created"], reverse=True)
+        if end:
+            calls = [call for call in calls if call["created"] < end]
+        page = {"data": calls[: self.page_size]}
+        if len(calls) > self.page_size:
+            page["next"] = page["data"][-1]["created"]
+        return page
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
@@ -0,0 +1,70 @@
+import os
+import json
+import datetime
+import logging
+from alert_utils import stat_cache_json
+
+_log = logging.getLogger(name="core_log")
+
+
+def input_signature(paths):
+    """(mtime, size, inode) of each path, None for paths that do not exist"""
+    signature = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            signature[str(path)] = None
+            continue
+        signature[str(path)] = [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+    return signature
+
+
+class StatCache:
+    """
+    Record of the inputs each platform was last evaluated from, and the result. A platform whose inputs are all
+    unchanged does not need evaluating again, until its recheck time falls due. The recheck time is the next
+    escalation deadline, and at most max_age after the last evaluation, so time dependent checks still run.
+    """
+
+    max_age = datetime.timedelta(hours=1)
+
+    def __init__(self, cache_file=stat_cache_json):
+        self.cache_file = cache_file
+        self.entries = {}
+        if self.cache_file.exists():
+            try:
+                with open(self.cache_file, "r") as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                _log.warning(f"could not read stat cache {self.cache_file}. Evaluate all platforms")
+
+    def unchanged(self, key, now=None):
+        now = now or datetime.datetime.now()
+        entry = self.entries.get(key)
+        if not entry:
+            return False
+        if now >= datetime.datetime.fromisoformat(entry["recheck_at"]):
+            return False
+        return input_signature(entry["inputs"]) == entry["inputs"]
+
+    def update(self, key, inputs, result, recheck_at=None, now=None):
+        now = now or datetime.datetime.now()
+        latest_recheck = now + self.max_age
+        if recheck_at is None or recheck_at > latest_recheck:
+            recheck_at = latest_recheck
+        self.entries[key] = {
+            "inputs": inputs,
+            "result": result,
+            "recheck_at": recheck_at.isoformat(),
+            "evaluated_at": now.isoformat(),
+        }
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+
+    def save(self):
+        tmp_file = self.cache_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(tmp_file, self.cache_file)
@@ -0,0 +1,115 @@
+"""
+Tests of the alerts system against a synthetic deployment. Each test runs its code in a fresh interpreter pointed at
+a FleetEnvironment, as the settings are read from the environment when alert_utils is imported.
+
+python -m pytest test_alerts.py
+"""
+import json
+import textwrap
+from pathlib import Path
+import pytest
+from benchmark import FleetEnvironment, parse_schedule_code
+
+# a stand-in for the votoweb user database, with every contact signed up for alarms
+voto_files = {
+    "voto/__init__.py": "",
+    "voto/data/__init__.py": "",
+    "voto/bin/__init__.py": "",
+    "voto/bin/add_profiles.py": "def init_db():\n    pass\n",
+    "voto/data/db_classes.py": textwrap.dedent(
+        """
+        import json, os
+
+
+        class User:
+            def __init__(self, name):
+                self.name = name
+
+            @classmethod
+            def objects(cls, **flags):
+                with open(os.path.join(os.environ["ALERTS_SECRETS_DIR"], "contacts_secrets.json")) as fin:
+                    return [cls(name) for name in sorted(json.load(fin))]
+        """
+    ),
+}
+
+
+@pytest.fixture
+def fleet():
+    with FleetEnvironment(n_gliders=2, n_lines=50, n_sailbuoys=0, n_days=30) as fleet:
+        fleet.run(parse_schedule_code)
+        yield fleet
+
+
+def run(fleet, code):
+    return fleet.run(textwrap.dedent(code))
+
+
+def test_extra_numbers_follow_the_pilot_on_duty(fleet):
+    with open(fleet.secrets_dir / "alarm_secrets.json") as fin:
+        votoweb_dir = Path(json.load(fin)["votoweb_dir"])
+    for name, source in voto_files.items():
+        (votoweb_dir / name).parent.mkdir(parents=True, exist_ok=True)
+        (votoweb_dir / name).write_text(source)
+    result = run(
+        fleet,
+        """
+        import sys, json, datetime, subprocess
+        import pandas as pd
+        from alert_utils import context
+        from alert_daemon import AlertDaemon
+
+        daemon = AlertDaemon(fake=True, use_inotify=False)
+        daemon.refresh_schedule()
+        before = (context.pilot_phone, list(context.extra_alarm_numbers))
+        # hand over to a pilot who was not on duty
+        url = context.secrets_dict["schedule_sheet_url"]
+        sheet = pd.read_csv(url, index_col=0)
+        on_duty = {number: name for name, number in context.contacts.items()}[before[0]]
+        new_pilot = next(name for name in sorted(context.contacts) if name != on_duty)
+        sheet["pilot-day"] = new_pilot
+        sheet["pilot-night"] = new_pilot
+        sheet.to_csv(url)
+        # the schedule is parsed by its own cron job
+        subprocess.run([sys.executable, "-c", "import alert_utils; alert_utils.parse_schedule()"], check=True)
+        daemon.handover = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        daemon.refresh_schedule()
+        after = (context.pilot_phone, list(context.extra_alarm_numbers))
+        print(json.dumps({"before": before, "after": after}))
+        """,
+    )
+    (old_pilot, old_extra), (new_pilot, new_extra) = result["before"], result["after"]
+    assert new_pilot != old_pilot
+    assert old_pilot not in old_extra and new_pilot in old_extra
+    assert new_pilot not in new_extra and old_pilot in new_extra
+
+
+def test_alarm_before_a_surfacing_action_is_acted_on(fleet):
+    result = run(
+        fleet,
+        """
+        import json
+        from alert_utils import context, record_action
+        from alert_dispatch import Dispatcher
+
+        dispatch = Dispatcher("SEA100")
+        dispatch.dummy_calls = True
+        dispatch.load_comm_log()
+        last = dispatch.df_mrs.iloc[-1]
+        # a surfacing email for the glider is handled after its last MRS line, which is in alarm
+        surfacing = {
+            "platform_id": "SEA100",
+            "glider": "100",
+            "mission": int(last.mission),
+            "cycle": int(last.cycle),
+            "security_level": 0,
+            "alarm_source": "surfacing email",
+        }
+        record_action(surfacing, "text_pilot")
+        dispatch.execute()
+        action = context.alarm_store.previous_action("SEA100", last.mission, last.cycle, last.security_level)
+        print(json.dumps({"alarm": bool(last.alarm), "action": action and action["action"]}))
+        """,
+    )
+    assert result["alarm"]
+    assert result["action"] in ("text_pilot", "call_pilot")